@@ -0,0 +1,382 @@
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from sql_queries import (song_table_insert, artist_table_insert, user_table_insert, time_table_insert,
+                         file_manifest_upsert, songplay_table_columns, staging_events_columns)
+from db import connect, get_dsn, database_url, numbered_params, pool_size
+from etl import (SONG_TABLES, LOG_TABLES, get_files, get_time_data, select_pending_files, read_json_lines,
+                 write_metrics)
+from manifest import file_stat, file_snapshot
+from bulk_load import dedupe_rows
+from song_index import SongIndex
+from partitions import partition_interval, log_months, ensure_partitions
+from dimension_keys import compact_songplays
+from rollups import refresh_rollups
+from queries import mark_changed
+import metrics
+
+
+# end-of-stream marker passed down the queues
+DONE = object()
+
+STAGES = ("parse", "transform", "resolve", "load")
+
+
+def timestamp(value):
+    return pd.Timestamp(value).to_pydatetime()
+
+
+# asyncpg encodes every parameter with the binary codec of its column type
+# instead of sending literals for the server to cast, so values are coerced
+# to the python type of their column first
+COLUMN_TYPES = {
+    "songs": (str, str, str, str, int, float),
+    "artists": (str, str, str, float, float),
+    "users": (int, str, str, str, str),
+    "time": (int, timestamp, int, int, int, int, int, int),
+    "songplays": (int, str, int, str, str, str, str, str),
+}
+
+# upsert statements with asyncpg's $n placeholders; rows are sorted by the
+# conflict key first, so concurrent loads lock rows in the same order
+UPSERTS = {
+    "songs": numbered_params(song_table_insert)[0],
+    "artists": numbered_params(artist_table_insert)[0],
+    "users": numbered_params(user_table_insert)[0],
+    "time": numbered_params(time_table_insert)[0],
+}
+
+file_manifest_upsert_numbered = numbered_params(file_manifest_upsert)[0]
+
+
+def typed_rows(table, rows):
+    """
+    Description: This function coerces rows to the python types asyncpg
+    expects for the table's columns.
+
+    Arguments:
+        table: star schema table name.
+        rows: list of row sequences in the table's insert column order.
+
+    Returns:
+        list of tuples, NaN / NA values as None.
+    """
+    types = COLUMN_TYPES[table]
+    return [tuple(None if value is None or pd.isna(value) else cast(value) for cast, value in zip(types, row))
+            for row in rows]
+
+
+async def run_stage(func, inbox, outbox, concurrency):
+    """
+    Description: This function runs one pipeline stage: `concurrency` tasks
+    take items from inbox, transform them with func and put the results in
+    outbox. Bounded queues make a fast stage wait for a slow one downstream.
+
+    Arguments:
+        func: coroutine function taking and returning one batch dict; a
+            None result is dropped.
+        inbox: asyncio queue the stage reads, ended by DONE.
+        outbox: asyncio queue the stage writes, or None for the last stage.
+        concurrency: number of tasks.
+
+    Returns:
+        None
+    """
+    async def worker():
+        while True:
+            batch = await inbox.get()
+            if batch is DONE:
+                # let the sibling tasks see the end of the stream too
+                await inbox.put(DONE)
+                return
+            result = await func(batch)
+            if result is not None and outbox is not None:
+                await outbox.put(result)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    if outbox is not None:
+        await outbox.put(DONE)
+
+
+class AsyncPipeline:
+    """
+    Asyncio ETL pipeline: file discovery, JSON parse, transform, song
+    resolution and load run as concurrent stages connected by bounded
+    queues, so file N+1 is parsed while file N is loaded. Parsing,
+    transforming and resolving run on a thread pool; loads use an asyncpg
+    connection pool, one transaction per file.
+    """
+
+    def __init__(self, pool, executor, cur, concurrency, queue_size=4, incremental=True):
+        """
+        Arguments:
+            pool: asyncpg connection pool.
+            executor: thread pool for the pandas work.
+            cur: psycopg2 cursor for the file manifest check.
+            concurrency: dict of stage name -> number of tasks.
+            queue_size: batches buffered between two stages.
+            incremental: only load new and changed files according to the file manifest.
+        """
+        self.pool = pool
+        self.executor = executor
+        self.cur = cur
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.incremental = incremental
+        self.song_index = None
+        self.failures = []
+
+    async def run_in_executor(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def guarded(self, func):
+        """
+        Description: This function wraps a stage so a failing file is
+        reported and dropped instead of stopping the pipeline.
+        """
+        async def run(batch):
+            try:
+                return await func(batch)
+            except Exception as e:
+                self.failures.append((batch["datafile"], "{}: {}".format(type(e).__name__, e)))
+                print('failed to process {}: {}'.format(batch["datafile"], self.failures[-1][1]))
+                return None
+        return run
+
+    def list_files(self, filepath, append_only=False):
+        all_files = get_files(filepath)
+        print('{} files found in {}'.format(len(all_files), filepath))
+        if self.incremental:
+            return select_pending_files(self.cur, all_files, append_only)
+        return all_files, {}
+
+    async def discover(self, filepath, kind, outbox):
+        try:
+            # log files only grow, so appended ones resume where they were loaded up to
+            all_files, resumes = await self.run_in_executor(self.list_files, filepath, kind == "log")
+            for datafile in all_files:
+                await outbox.put({"datafile": datafile, "kind": kind, "resume": resumes.get(datafile)})
+        finally:
+            await outbox.put(DONE)
+
+    async def parse(self, batch):
+        with metrics.stage("parse"):
+            batch["df"] = await self.run_in_executor(self.read_file, batch)
+        return batch
+
+    def read_file(self, batch):
+        """
+        Description: This function parses a file, a log file only from where
+        it was loaded up to and up to the size of its manifest entry, which
+        is taken first so lines appended meanwhile are left for the next load.
+        """
+        datafile = batch["datafile"]
+        if self.incremental:
+            batch["snapshot"] = file_snapshot(datafile)
+        if batch["kind"] == "log":
+            start = batch["resume"][0] if batch["resume"] else 0
+            stop = batch["snapshot"][0] if self.incremental else None
+            df = read_json_lines(datafile, start, stop, staging_events_columns)
+        else:
+            df = pd.read_json(datafile, lines = True)
+            metrics.count("bytes_read", file_stat(datafile)[0])
+        metrics.count("rows_in", len(df), source=batch_source(datafile))
+        return df
+
+    async def transform(self, batch):
+        with metrics.stage("transform"):
+            return await self.run_in_executor(self.transform_batch, batch)
+
+    def transform_batch(self, batch):
+        """
+        Description: This function turns a parsed file into the rows of every
+        table it loads (songplays are completed by the resolve stage).
+        """
+        df = batch.pop("df")
+        rows = {}
+
+        if batch["kind"] == "song":
+            rows["songs"] = df[["song_id", "title", "artist_id", "artist_name", "year", "duration"]].values.tolist()
+            rows["artists"] = df[["artist_id", "artist_name", "artist_location", "artist_latitude",
+                                  "artist_longitude"]].values.tolist()
+        else:
+            # the last event of a user sets the level, as with per-event upserts
+            df = df[df["page"] == "NextSong"].sort_values("ts", kind="stable")
+            # no cross-file time cache: a file loaded concurrently may hold the
+            # same start_time uncommitted, so every file upserts its own rows
+            rows["time"] = get_time_data(df).astype(object).values.tolist()
+            rows["users"] = dedupe_rows(df[["userId", "firstName", "lastName", "gender", "level"]].values.tolist(), 0)
+            batch["events"] = df
+
+        for table, table_rows in rows.items():
+            rows[table] = typed_rows(table, table_rows)
+        batch["rows"] = rows
+
+        if self.incremental:
+            size, mtime, content_hash, rows_read = batch.pop("snapshot")
+            rows_before = batch["resume"][1] if batch["resume"] else 0
+            batch["manifest"] = (batch["datafile"], size, mtime, content_hash, rows_read, rows_before + len(df))
+
+        return batch
+
+    async def resolve(self, batch):
+        if "events" not in batch:
+            return batch
+        with metrics.stage("lookup"):
+            return await self.run_in_executor(self.resolve_batch, batch)
+
+    def resolve_batch(self, batch):
+        df = batch.pop("events")
+        songs = self.song_index.resolve(df)
+        hits = int(songs.song_id.notna().sum())
+        metrics.count("song_lookups", hits, result="hit")
+        metrics.count("song_lookups", len(df) - hits, result="miss")
+
+        batch["rows"]["songplays"] = typed_rows("songplays", zip(df.ts, df.sessionId, df.userId, songs.song_id,
+                                                                 songs.artist_id, df.level, df.location,
+                                                                 df.userAgent))
+        return batch
+
+    async def load(self, batch):
+        with metrics.stage("insert"):
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    for table, rows in batch["rows"].items():
+                        if not rows:
+                            continue
+                        if table == "songplays":
+                            await conn.copy_records_to_table("songplays", records=rows,
+                                                             columns=list(songplay_table_columns))
+                            metrics.count("statements")
+                        else:
+                            # asyncpg pipelines executemany into one round trip
+                            await conn.executemany(UPSERTS[table], sorted(rows, key=lambda row: row[0]))
+                            metrics.count("statements", len(rows))
+                        metrics.count("round_trips")
+                        metrics.count("rows_out", len(rows), table=table)
+                    if "manifest" in batch:
+                        await conn.execute(file_manifest_upsert_numbered, *batch["manifest"])
+                        metrics.count("statements")
+                        metrics.count("round_trips")
+        metrics.count("files", source=batch["kind"] + "_data")
+        return None
+
+    async def run(self, filepath, kind):
+        """
+        Description: This function streams every file of one data directory
+        through the pipeline.
+
+        Arguments:
+            filepath: song data or log data directory.
+            kind: "song" or "log".
+
+        Returns:
+            None
+        """
+        files, parsed, transformed, resolved = (asyncio.Queue(self.queue_size) for _ in range(4))
+        await asyncio.gather(
+            self.discover(filepath, kind, files),
+            run_stage(self.guarded(self.parse), files, parsed, self.concurrency["parse"]),
+            run_stage(self.guarded(self.transform), parsed, transformed, self.concurrency["transform"]),
+            run_stage(self.guarded(self.resolve), transformed, resolved, self.concurrency["resolve"]),
+            run_stage(self.guarded(self.load), resolved, None, self.concurrency["load"]),
+        )
+
+
+def batch_source(datafile):
+    return "log_data" if "log_data" in datafile else "song_data"
+
+
+async def load_all(dsn, cur, concurrency, queue_size, incremental):
+    """
+    Description: This function loads the song files and then the log files
+    through the async pipeline.
+
+    Arguments:
+        dsn: libpq connection string.
+        cur: psycopg2 cursor for the file manifest and the song index.
+        concurrency: dict of stage name -> number of tasks.
+        queue_size: batches buffered between two stages.
+        incremental: only load new and changed files according to the file manifest.
+
+    Returns:
+        list of (file path, error message) for the files that failed.
+    """
+    try:
+        import asyncpg
+    except ImportError:
+        raise ImportError("the async pipeline needs the asyncpg package: pip install asyncpg")
+
+    workers = concurrency["parse"] + concurrency["transform"] + concurrency["resolve"] + 1
+    load_connections = min(concurrency["load"], pool_size())
+
+    with ThreadPoolExecutor(workers) as executor:
+        async with asyncpg.create_pool(database_url(dsn), min_size=1, max_size=load_connections) as pool:
+            pipeline = AsyncPipeline(pool, executor, cur, dict(concurrency, load=load_connections), queue_size,
+                                     incremental)
+            await pipeline.run('data/song_data', "song")
+
+            # every song is in the table now, so misses are final
+            pipeline.song_index = await pipeline.run_in_executor(SongIndex.from_db, cur)
+            await pipeline.run('data/log_data', "log")
+
+    return pipeline.failures
+
+
+def main(dsn=None, concurrency=None, queue_size=4, incremental=True, metrics_json=None, metrics_prom=None):
+    """
+    - loads song_data and then log_data into postgres through the asyncio
+      pipeline, overlapping parsing and database I/O
+    - concurrency maps each of STAGES to its number of tasks (load tasks
+      each hold one pooled connection)
+    - queue_size bounds the batches buffered between two stages, which
+      bounds memory when the database is the bottleneck
+    - partitions and rollups are managed as in etl.py
+    - returns the list of failed files
+    """
+    concurrency = dict({stage: 2 for stage in STAGES}, **(concurrency or {}))
+
+    conn = connect(dsn, autocommit=True)
+    cur = conn.cursor()
+
+    if compact_songplays(cur):
+        raise ValueError("the async pipeline COPYs into a plain songplays table, load a compact schema with etl.py")
+
+    interval = partition_interval(cur)
+    if interval is not None:
+        ensure_partitions(cur, conn, log_months('data/log_data'), interval)
+
+    failures = asyncio.run(load_all(get_dsn(dsn), cur, concurrency, queue_size, incremental))
+
+    # after every load committed, so the watermark cannot skip rows
+    with metrics.stage("rollup"):
+        refresh_rollups(cur)
+    mark_changed(cur, SONG_TABLES + LOG_TABLES)
+
+    conn.close()
+    write_metrics(metrics_json, metrics_prom)
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load song and log data into sparkifydb with an asyncio pipeline.")
+    for stage in STAGES:
+        parser.add_argument("--{}-tasks".format(stage), type=int, default=2,
+                            help="concurrent {} tasks".format(stage))
+    parser.add_argument("--queue-size", type=int, default=4,
+                        help="batches buffered between two stages; bounds memory")
+    parser.add_argument("--full-reload", action="store_true",
+                        help="load every file, ignoring the file manifest")
+    parser.add_argument("--dsn", default=None,
+                        help="postgres connection string (defaults to SPARKIFY_DSN or the PG* variables)")
+    parser.add_argument("--metrics-json", default=None, help="write the per-stage run report to this JSON file")
+    parser.add_argument("--metrics-prom", default=None,
+                        help="write the run metrics to this file in Prometheus text format")
+    args = parser.parse_args()
+
+    main(dsn=args.dsn, concurrency={stage: getattr(args, "{}_tasks".format(stage)) for stage in STAGES},
+         queue_size=args.queue_size, incremental=not args.full_reload,
+         metrics_json=args.metrics_json, metrics_prom=args.metrics_prom)
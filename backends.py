@@ -0,0 +1,264 @@
+import sqlite3
+import datetime
+
+import numpy as np
+import pandas as pd
+import psycopg2
+
+import db
+from sql_queries import (create_table_queries, drop_table_queries,
+                         sqlite_create_table_queries, sqlite_drop_table_queries,
+                         duckdb_create_table_queries, duckdb_drop_table_queries,
+                         songplay_table_insert, user_table_insert, song_table_insert,
+                         artist_table_insert, time_table_insert)
+from bulk_load import copy_rows
+from song_index import SongIndex
+
+
+BACKENDS = ("postgres", "sqlite", "duckdb")
+
+# table -> single-row statement carrying the table's ON CONFLICT rule
+UPSERT_QUERIES = {
+    "songplays": songplay_table_insert,
+    "users": user_table_insert,
+    "songs": song_table_insert,
+    "artists": artist_table_insert,
+    "time": time_table_insert,
+}
+
+
+class PostgresBackend:
+    """
+    The sparkifydb Postgres server: DDL from sql_queries, bulk loads with
+    COPY ... FROM STDIN, hot single-row statements as prepared statements.
+    """
+
+    name = "postgres"
+    supports_copy = True
+    # errors a single bad row can raise, caught to reject the row
+    row_errors = (psycopg2.DataError, psycopg2.IntegrityError)
+    create_table_queries = create_table_queries
+    drop_table_queries = drop_table_queries
+
+    def __init__(self, dsn=None, prepare=True):
+        self.dsn = db.get_dsn(dsn)
+        self.prepare = prepare
+
+    def connect(self, autocommit=False):
+        return db.connect(self.dsn, autocommit=autocommit)
+
+    def cursor(self, conn, wrapper=None):
+        cur = conn.cursor()
+        if wrapper:
+            cur = wrapper(cur)
+        return db.PreparedCursor(cur) if self.prepare else cur
+
+    def create_tables(self, cur, conn):
+        for query in self.create_table_queries:
+            cur.execute(query)
+            conn.commit()
+
+    def drop_tables(self, cur, conn):
+        for query in self.drop_table_queries:
+            cur.execute(query)
+            conn.commit()
+
+    def bulk_insert(self, cur, table, rows):
+        return copy_rows(cur, table, rows)
+
+    def upsert(self, cur, table, rows):
+        return copy_rows(cur, table, rows)
+
+    def song_index(self, cur):
+        return SongIndex.from_db(cur)
+
+
+def adapt_value(value):
+    """
+    Description: This function converts numpy and pandas scalars into values
+    the embedded database drivers can bind.
+
+    Arguments:
+        value: python, numpy or pandas scalar.
+
+    Returns:
+        plain python value, None for NULL / NaN.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (pd.Timestamp, datetime.datetime)):
+        return value.isoformat(sep=" ")
+    if pd.isna(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def translate(query):
+    """
+    Description: This function rewrites a sql_queries statement into the
+    dialect shared by SQLite and DuckDB.
+
+    Arguments:
+        query: Postgres statement using %s placeholders.
+
+    Returns:
+        statement using ? placeholders.
+    """
+    return query.replace("%s", "?").replace("now()", "CURRENT_TIMESTAMP")
+
+
+class EmbeddedCursor:
+    """
+    Cursor wrapper giving SQLite and DuckDB cursors the interface the ETL
+    uses on psycopg2 cursors: Postgres placeholders and numpy / pandas
+    parameters are translated on the fly, and COPY bulk loads become
+    executemany upserts.
+    """
+
+    def __init__(self, backend, cur):
+        self.backend = backend
+        self._cur = cur
+
+    def execute(self, query, vars=None):
+        if vars is None:
+            return self._cur.execute(translate(query))
+        return self._cur.execute(translate(query), [adapt_value(v) for v in vars])
+
+    def executemany(self, query, vars_list):
+        return self._cur.executemany(translate(query), [[adapt_value(v) for v in row] for row in vars_list])
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def upsert_rows(self, table, rows):
+        return self.backend.upsert(self, table, rows)
+
+    def close(self):
+        self._cur.close()
+
+
+class SQLiteBackend:
+    """
+    In-process SQLite database, for local runs and CI without a Postgres
+    container.
+    """
+
+    name = "sqlite"
+    supports_copy = False
+    row_errors = (sqlite3.DataError, sqlite3.IntegrityError)
+    create_table_queries = sqlite_create_table_queries
+    drop_table_queries = sqlite_drop_table_queries
+
+    def __init__(self, path="sparkifydb.sqlite"):
+        self.path = path
+
+    def connect(self, autocommit=False):
+        # isolation_level=None leaves sqlite3 in autocommit mode
+        if autocommit:
+            return sqlite3.connect(self.path, isolation_level=None)
+        return sqlite3.connect(self.path)
+
+    def cursor(self, conn, wrapper=None):
+        # the wrapper sees the statements the driver actually runs
+        cur = conn.cursor()
+        return EmbeddedCursor(self, wrapper(cur) if wrapper else cur)
+
+    def create_tables(self, cur, conn):
+        for query in self.create_table_queries:
+            cur.execute(query)
+        conn.commit()
+
+    def drop_tables(self, cur, conn):
+        for query in self.drop_table_queries:
+            cur.execute(query)
+        conn.commit()
+
+    def bulk_insert(self, cur, table, rows):
+        return self.upsert(cur, table, rows)
+
+    def upsert(self, cur, table, rows):
+        rows = list(rows)
+        if rows:
+            cur.executemany(UPSERT_QUERIES[table], rows)
+        return len(rows)
+
+    def song_index(self, cur):
+        return SongIndex.from_db(cur)
+
+
+class DuckDBBackend(SQLiteBackend):
+    """
+    In-process DuckDB database; its columnar storage makes ad-hoc analytics
+    on the star schema fast. Requires the optional duckdb package.
+    """
+
+    name = "duckdb"
+    # no savepoints, so a bad row fails its whole transaction
+    row_errors = ()
+    create_table_queries = duckdb_create_table_queries
+    drop_table_queries = duckdb_drop_table_queries
+
+    def __init__(self, path="sparkifydb.duckdb"):
+        self.path = path
+
+    def connect(self, autocommit=False):
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError("the duckdb backend needs the duckdb package: pip install duckdb")
+
+        return DuckDBConnection(duckdb.connect(self.path))
+
+
+class DuckDBConnection:
+    """
+    DuckDB connection with DB-API commit semantics: statements autocommit
+    unless a transaction was opened explicitly.
+    """
+
+    autocommit = True
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def cursor(self):
+        return self._conn.cursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self._conn.close()
+
+
+def get_backend(name="postgres", dsn=None, path=None, prepare=True):
+    """
+    Description: This function builds a storage backend by name.
+
+    Arguments:
+        name: one of BACKENDS.
+        dsn: libpq connection string for the postgres backend, or None to
+            read it from the environment (see db.get_dsn).
+        path: database file for the embedded backends (":memory:" for a
+            throwaway in-memory database).
+        prepare: use server-side prepared statements on postgres.
+
+    Returns:
+        backend object.
+    """
+    if name == "postgres":
+        return PostgresBackend(dsn, prepare=prepare)
+    if name == "sqlite":
+        return SQLiteBackend(path or "sparkifydb.sqlite")
+    if name == "duckdb":
+        return DuckDBBackend(path or "sparkifydb.duckdb")
+
+    raise ValueError("unknown backend {!r}, expected one of {}".format(name, BACKENDS))
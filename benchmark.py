@@ -0,0 +1,248 @@
+import io
+import json
+import time
+import argparse
+import resource
+import functools
+import contextlib
+import tracemalloc
+
+import etl
+from backends import BACKENDS, get_backend
+from create_tables import drop_tables, create_tables
+from song_index import SongIndex
+
+
+# load modes benchmarked per file; "staging" runs as a whole-tree stage
+FILE_MODES = [("insert", "query"), ("copy", "query"), ("insert", "index"), ("copy", "index")]
+
+
+class CountingCursor:
+    """
+    Cursor wrapper counting the statements (and so the round trips) sent
+    through it.
+    """
+
+    def __init__(self, cur):
+        self._cur = cur
+        self.queries = 0
+
+    def execute(self, query, vars=None):
+        self.queries += 1
+        if vars is None:
+            return self._cur.execute(query)
+        return self._cur.execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        self.queries += len(vars_list)
+        return self._cur.executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, *args, **kwargs):
+        self.queries += 1
+        return self._cur.copy_expert(sql, file, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+class NullCursor:
+    """
+    In-process stand-in for a Postgres cursor: accepts every statement and
+    matches no songs, so the client side of the ETL can be measured without
+    a database.
+    """
+
+    def execute(self, query, vars=None):
+        pass
+
+    def copy_expert(self, sql, file, *args, **kwargs):
+        file.read()
+
+    def fetchone(self):
+        return None
+
+    def fetchall(self):
+        return []
+
+
+class NullConnection:
+    autocommit = True
+
+    def cursor(self):
+        return NullCursor()
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_stage(name, cur, conn, func, num_files, trace_memory=False):
+    """
+    Description: This function runs one benchmark stage and measures it.
+
+    Arguments:
+        name: stage name for the report.
+        cur: CountingCursor counting the stage's statements.
+        conn: connection to the database.
+        func: callable taking no arguments, returning the number of rows loaded.
+        num_files: number of files the stage reads.
+        trace_memory: measure the Python heap peak of the stage with tracemalloc.
+
+    Returns:
+        dict of stage metrics.
+    """
+    cur.queries = 0
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        rows = func()
+        conn.commit()
+    elapsed = time.perf_counter() - start
+
+    heap_peak = None
+    if trace_memory:
+        heap_peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+
+    result = {
+        "stage": name,
+        "seconds": round(elapsed, 3),
+        "files": num_files,
+        "rows": rows,
+        "files_per_s": round(num_files / elapsed, 1) if elapsed else None,
+        "rows_per_s": round(rows / elapsed, 1) if elapsed and rows is not None else None,
+        "queries": cur.queries,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "heap_peak_mb": round(heap_peak, 1) if heap_peak is not None else None,
+    }
+    print(json.dumps(result))
+    return result
+
+
+def reset_schema(cur, conn, backend):
+    if backend is not None:
+        drop_tables(cur, conn, backend.drop_table_queries)
+        create_tables(cur, conn, backend.create_table_queries)
+
+
+def run(data_dir, backend_name="null", dsn=None, db_path=":memory:", trace_memory=False, chunksize=None):
+    """
+    Description: This function benchmarks process_song_file, process_log_file
+    and process_data in every load mode against one data tree.
+
+    Arguments:
+        data_dir: directory holding song_data and log_data.
+        backend_name: "null" for the in-process NullCursor stand-in, or one
+            of backends.BACKENDS.
+        dsn: libpq connection string of a throwaway postgres database.
+        db_path: database file of an embedded backend.
+        trace_memory: measure per-stage Python heap peaks.
+        chunksize: stream log files in chunks of this many lines.
+
+    Returns:
+        list of stage metric dicts.
+    """
+    song_path = "{}/song_data".format(data_dir)
+    log_path = "{}/log_data".format(data_dir)
+    song_files = etl.get_files(song_path)
+    log_files = etl.get_files(log_path)
+
+    if backend_name == "null":
+        backend = None
+        conn = NullConnection()
+        counter = cur = CountingCursor(conn.cursor())
+    else:
+        backend = get_backend(backend_name, dsn=dsn, path=db_path)
+        conn = backend.connect(autocommit=True)
+        counters = []
+
+        def counting(raw):
+            # count at the driver, below prepared statements and dialect translation
+            counters.append(CountingCursor(raw))
+            return counters[-1]
+
+        cur = backend.cursor(conn, wrapper=counting)
+        counter = counters[0]
+
+    results = []
+    for load_mode, lookup in FILE_MODES:
+        label = "{}/{}".format(load_mode, lookup)
+        reset_schema(cur, conn, backend)
+
+        song_index = SongIndex() if lookup == "index" else None
+
+        def load_songs():
+            return sum(etl.process_song_file(cur, f, load_mode=load_mode, song_index=song_index)
+                       for f in song_files)
+
+        def load_logs():
+            loaded_times = set()
+            return sum(etl.process_log_file(cur, f, load_mode=load_mode, song_index=song_index,
+                                            chunksize=chunksize, loaded_times=loaded_times)
+                       for f in log_files)
+
+        results.append(run_stage("process_song_file " + label, counter, conn, load_songs, len(song_files),
+                                 trace_memory))
+        if song_index is not None:
+            # the songs table was just loaded, so the index now covers it
+            song_index.complete = True
+        results.append(run_stage("process_log_file " + label, counter, conn, load_logs, len(log_files),
+                                 trace_memory))
+
+    for load_mode, lookup in FILE_MODES[:2]:
+        label = "{}/{}".format(load_mode, lookup)
+        reset_schema(cur, conn, backend)
+
+        def load_all():
+            etl.process_data(cur, conn, song_path, functools.partial(etl.process_song_file, load_mode=load_mode))
+            etl.process_data(cur, conn, log_path, functools.partial(etl.process_log_file, load_mode=load_mode,
+                                                                    chunksize=chunksize, loaded_times=set()))
+
+        results.append(run_stage("process_data " + label, counter, conn, load_all,
+                                 len(song_files) + len(log_files), trace_memory))
+
+    # staging tables and set-based merges are postgres only
+    if backend is None or backend.name == "postgres":
+        reset_schema(cur, conn, backend)
+        results.append(run_stage("process_data staging", counter, conn,
+                                 lambda: etl.process_data_staged(cur, conn, song_path, log_path),
+                                 len(song_files) + len(log_files), trace_memory))
+
+    conn.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the Sparkify ETL load modes.")
+    parser.add_argument("--data", default="data", help="directory holding song_data and log_data")
+    parser.add_argument("--backend", choices=("null",) + BACKENDS, default="null",
+                        help="null runs the ETL against an in-process stand-in that executes nothing; "
+                             "the other backends have their tables dropped and recreated for every mode")
+    parser.add_argument("--dsn", default=None, help="connection string of a throwaway postgres database")
+    parser.add_argument("--db-path", default=":memory:", help="database file of an embedded backend")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="report per-stage Python heap peaks (slows the run down)")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="stream log files this many lines at a time")
+    parser.add_argument("--output", default=None, help="also write the report to this JSON file")
+    args = parser.parse_args()
+
+    report = run(args.data, backend_name=args.backend, dsn=args.dsn, db_path=args.db_path,
+                 trace_memory=args.trace_memory, chunksize=args.chunksize)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,165 @@
+import io
+
+import pandas as pd
+from psycopg2.extras import execute_values
+from sql_queries import (copy_from_stdin, temp_table_create, temp_table_truncate,
+                         song_table_insert_values, artist_table_insert_values, songplay_table_columns, songplay_facts_columns, user_table_columns, song_table_columns,
+                         artist_table_columns, time_table_columns,
+                         user_table_merge, song_table_merge, artist_table_merge, time_table_merge)
+
+
+# table -> (columns, conflict key, merge query); tables without a merge
+# query are copied straight into the target.
+COPY_TARGETS = {
+    "songplays": (songplay_table_columns, None, None),
+    "songplay_facts": (songplay_facts_columns, None, None),
+    "users": (user_table_columns, "user_id", user_table_merge),
+    "songs": (song_table_columns, "song_id", song_table_merge),
+    "artists": (artist_table_columns, "artist_id", artist_table_merge),
+    "time": (time_table_columns, "start_time", time_table_merge),
+}
+
+# table -> multi-row upsert written with execute_values
+VALUES_TARGETS = {
+    "songs": song_table_insert_values,
+    "artists": artist_table_insert_values,
+}
+
+
+def format_copy_value(value):
+    """
+    Description: This function renders a single value in the text format
+    expected by COPY ... FROM STDIN.
+
+    Arguments:
+        value: python, numpy or pandas scalar.
+
+    Returns:
+        the escaped string, or \\N for NULL / NaN values.
+    """
+    if value is None or pd.isna(value):
+        return "\\N"
+
+    return (str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r"))
+
+
+def rows_to_buffer(rows):
+    """
+    Description: This function writes rows into an in-memory text buffer
+    ready to be streamed with COPY.
+
+    Arguments:
+        rows: iterable of row sequences.
+
+    Returns:
+        io.StringIO positioned at the start of the buffer.
+    """
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(format_copy_value(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
+
+
+def dedupe_rows(rows, key_index):
+    """
+    Description: This function keeps the last row seen for every key, which is
+    what a sequence of single-row upserts would have left in the table.
+
+    Arguments:
+        rows: list of row sequences.
+        key_index: position of the conflict key inside each row.
+
+    Returns:
+        list of rows with unique keys, in first-seen order.
+    """
+    latest = {}
+    for row in rows:
+        latest[row[key_index]] = row
+    return list(latest.values())
+
+
+def copy_into(cur, table, columns, rows):
+    """
+    Description: This function streams rows into a table as-is with a single
+    COPY ... FROM STDIN.
+
+    Arguments:
+        cur: the cursor object.
+        table: target table name.
+        columns: column names, in row order.
+        rows: iterable of row sequences.
+
+    Returns:
+        None
+    """
+    cur.copy_expert(copy_from_stdin.format(table=table, columns=", ".join(columns)),
+                    rows_to_buffer(rows))
+
+
+def copy_rows(cur, table, rows):
+    """
+    Description: This function bulk loads rows into one of the star schema
+    tables with a single COPY ... FROM STDIN round trip. Dimension tables go
+    through a temp table and a merge so the ON CONFLICT rules still apply.
+
+    Arguments:
+        cur: the cursor object.
+        table: target table name, one of COPY_TARGETS.
+        rows: list of row sequences in the table's column order.
+
+    Returns:
+        number of rows streamed to the database.
+    """
+    # embedded backends have no COPY and upsert through the cursor instead
+    if hasattr(cur, "upsert_rows"):
+        return cur.upsert_rows(table, rows)
+
+    columns, key, merge_query = COPY_TARGETS[table]
+    rows = list(rows)
+    if not rows:
+        return 0
+
+    if merge_query is None:
+        target = table
+    else:
+        rows = dedupe_rows(rows, columns.index(key))
+        target = "{}_load".format(table)
+        cur.execute(temp_table_create.format(temp_table=target, table=table, columns=", ".join(columns)))
+        cur.execute(temp_table_truncate.format(temp_table=target))
+
+    copy_into(cur, target, columns, rows)
+
+    if merge_query is not None:
+        cur.execute(merge_query)
+
+    return len(rows)
+
+
+def insert_values(cur, table, rows):
+    """
+    Description: This function upserts rows into a dimension table with one
+    multi-row INSERT ... VALUES statement instead of one statement per row.
+
+    Arguments:
+        cur: the cursor object.
+        table: target table name, one of VALUES_TARGETS.
+        rows: list of row sequences in the table's column order.
+
+    Returns:
+        number of rows written.
+    """
+    # embedded backends run the whole executemany in-process instead
+    if hasattr(cur, "upsert_rows"):
+        return cur.upsert_rows(table, rows)
+
+    columns, key, _ = COPY_TARGETS[table]
+    rows = dedupe_rows(list(rows), columns.index(key))
+    if rows:
+        execute_values(cur, VALUES_TARGETS[table], rows, page_size=len(rows))
+    return len(rows)
@@ -0,0 +1,135 @@
+import mmap
+import contextlib
+
+from sql_queries import (file_checkpoint_select, file_checkpoint_upsert, file_checkpoint_delete,
+                         file_checkpoint_path_delete, transaction_begin, transaction_commit, transaction_rollback)
+from manifest import file_stat
+
+
+# lines per checkpointed chunk when no chunksize is given
+CHECKPOINT_LINES = 100000
+
+
+@contextlib.contextmanager
+def mapped_file(filepath):
+    """
+    Description: This function memory maps a data file read-only, so chunks
+    are sliced out of the page cache without reading the file up to them.
+
+    Arguments:
+        filepath: data file path.
+    """
+    with open(filepath, "rb") as f:
+        # an empty file cannot be mapped
+        if not f.seek(0, 2):
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def line_chunks(data, start=0, lines=CHECKPOINT_LINES, stop=None):
+    """
+    Description: This function splits newline-delimited data into chunks of
+    whole lines, starting at a byte offset.
+
+    Arguments:
+        data: bytes or mmap.
+        start: byte offset of the first line.
+        lines: lines per chunk.
+        stop: byte offset to stop at, a line boundary (default: the end of data).
+
+    Returns:
+        iterator of (start, end) byte offsets; end is the offset to resume
+        from once the chunk is loaded.
+    """
+    size = len(data) if stop is None else min(stop, len(data))
+    while start < size:
+        end = start
+        for _ in range(lines):
+            end = data.find(b"\n", end) + 1
+            if not end or end > size:
+                # last line without a trailing newline
+                end = size
+            if end >= size:
+                break
+        yield start, end
+        start = end
+
+
+def read_checkpoint(cur, filepath, append_only=False):
+    """
+    Description: This function reads where an interrupted load of a file
+    stopped. A checkpoint of a file whose size or mtime changed since is
+    ignored, the file is loaded from the start. A file loaded to the end
+    resumes at its end, i.e. loads nothing more.
+
+    Arguments:
+        cur: the cursor object.
+        filepath: data file path.
+        append_only: the file only ever grows (a log file being tailed), so
+            its checkpoint holds as long as the file did not shrink below it.
+
+    Returns:
+        (byte offset to resume from, rows loaded before it)
+    """
+    cur.execute(file_checkpoint_select, (filepath,))
+    row = cur.fetchone()
+    if row is None:
+        return 0, 0
+
+    size, mtime, byte_offset, rows_loaded = row
+    if append_only:
+        if file_stat(filepath)[0] < byte_offset:
+            return 0, 0
+    elif (size, mtime) != file_stat(filepath):
+        return 0, 0
+    return byte_offset, rows_loaded
+
+
+def save_checkpoint(cur, filepath, byte_offset, rows_loaded):
+    """
+    Description: This function records the offset up to which a file is
+    loaded. Run it in the transaction loading the chunk before that offset.
+
+    Arguments:
+        cur: the cursor object.
+        filepath: data file path.
+        byte_offset: offset of the first line not loaded yet.
+        rows_loaded: rows loaded from the file so far.
+
+    Returns:
+        None
+    """
+    size, mtime = file_stat(filepath)
+    cur.execute(file_checkpoint_upsert, (filepath, size, mtime, byte_offset, rows_loaded))
+
+
+def clear_checkpoints(cur, paths=None):
+    # a full reload starts every file from the beginning, as does a reload
+    # of log files that were rewritten rather than appended to
+    if paths is None:
+        cur.execute(file_checkpoint_delete)
+    else:
+        for path in paths:
+            cur.execute(file_checkpoint_path_delete, (path,))
+
+
+@contextlib.contextmanager
+def transaction(cur):
+    """
+    Description: This function runs a with block as one explicit transaction
+    on a connection in autocommit mode, rolled back when the block raises.
+
+    Arguments:
+        cur: the cursor object.
+    """
+    cur.execute(transaction_begin)
+    try:
+        yield
+    except BaseException:
+        # keep the original error if the connection itself is gone
+        with contextlib.suppress(Exception):
+            cur.execute(transaction_rollback)
+        raise
+    cur.execute(transaction_commit)
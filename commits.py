@@ -0,0 +1,162 @@
+import json
+import contextlib
+
+from sql_queries import (transaction_begin, transaction_commit, transaction_rollback, savepoint_create,
+                         savepoint_rollback, savepoint_release, load_reject_insert)
+from bulk_load import copy_rows, insert_values
+import metrics
+
+
+# "statement" commits every statement on its own (autocommit); the others
+# commit explicit transactions after the file that brings them to N rows,
+# after every file, or once per run
+COMMIT_MODES = ("statement", "rows", "file", "run")
+
+# rows per transaction in "rows" mode, rounded up to whole files
+COMMIT_ROWS = 10000
+
+
+def insert_rows(cur, table, query, rows, copy=False, values=False):
+    """
+    Description: This function writes rows into a star schema table, with
+    COPY, with one multi-row INSERT or with one statement per row.
+
+    Arguments:
+        cur: the cursor object.
+        table: target table, one of bulk_load.COPY_TARGETS.
+        query: single-row statement for the table.
+        rows: list of rows in the statement's parameter order.
+        copy: bulk load with copy_rows instead.
+        values: write all rows with bulk_load.insert_values instead.
+
+    Returns:
+        number of rows written.
+    """
+    if copy:
+        return copy_rows(cur, table, rows)
+    if values:
+        return insert_values(cur, table, rows)
+    for row in rows:
+        cur.execute(query, row)
+    return len(rows)
+
+
+class CommitBatcher:
+    """
+    Commit granularity of a load on a connection in autocommit mode. In
+    "rows", "file" and "run" mode the load runs in explicit transactions,
+    committed at the end of the first file that brings them to `rows` rows
+    written, after every file, or once at the end, so the server flushes the
+    WAL once per batch instead of once per statement. Commits only happen at
+    file boundaries, where the file's manifest entry is in the same
+    transaction: a crash never leaves part of a file committed without it.
+
+    Inside a transaction every write runs under a savepoint. When it fails
+    with one of row_errors, it is rolled back to the savepoint and retried
+    row by row, each row under its own savepoint, and the rows that still
+    fail are recorded in load_rejects instead of aborting the batch.
+    """
+
+    def __init__(self, cur, conn, mode="statement", rows=COMMIT_ROWS, row_errors=()):
+        if mode not in COMMIT_MODES:
+            raise ValueError("unknown commit mode {!r}, expected one of {}".format(mode, COMMIT_MODES))
+        self.cur = cur
+        self.conn = conn
+        self.mode = mode
+        self.rows = rows
+        self.row_errors = row_errors
+        # file the rows being written come from, recorded with rejects
+        self.source = None
+        self.rejected = 0
+        self._open = False
+        self._pending = 0
+
+    def begin(self, source=None):
+        """
+        Description: This function starts writing the rows of a file,
+        opening a transaction unless one is open already.
+
+        Arguments:
+            source: data file (or directory) path the rows come from.
+
+        Returns:
+            None
+        """
+        self.source = source
+        if self.mode != "statement" and not self._open:
+            self.cur.execute(transaction_begin)
+            self._open = True
+
+    def commit(self):
+        with metrics.stage("commit"):
+            if self._open:
+                self.cur.execute(transaction_commit)
+                self._open = False
+                metrics.count("commits")
+            else:
+                self.conn.commit()
+        self._pending = 0
+
+    def rollback(self):
+        if self._open:
+            # keep the original error if the connection itself is gone
+            with contextlib.suppress(Exception):
+                self.cur.execute(transaction_rollback)
+            self._open = False
+        self._pending = 0
+
+    def end_file(self):
+        # "run" mode commits from finish
+        if self.mode in ("statement", "file") or (self.mode == "rows" and self._pending >= self.rows):
+            self.commit()
+
+    def finish(self):
+        self.commit()
+
+    def write(self, table, query, rows, copy=False, values=False):
+        """
+        Description: This function writes rows in the current transaction.
+
+        Arguments:
+            table: target table.
+            query: single-row statement for the table, also used to retry the
+                rows of a failed COPY one by one.
+            rows: list of rows in the statement's parameter order.
+            copy: bulk load with COPY.
+            values: write the rows with one multi-row INSERT.
+
+        Returns:
+            number of rows written, rejects included.
+        """
+        if not rows:
+            return 0
+
+        if self._open and self.row_errors:
+            self._write_guarded(table, query, rows, copy, values)
+        else:
+            insert_rows(self.cur, table, query, rows, copy, values)
+
+        self._pending += len(rows)
+        return len(rows)
+
+    def _write_guarded(self, table, query, rows, copy, values):
+        self.cur.execute(savepoint_create.format(name="load_write"))
+        try:
+            insert_rows(self.cur, table, query, rows, copy, values)
+        except self.row_errors:
+            self.cur.execute(savepoint_rollback.format(name="load_write"))
+            for row in rows:
+                self._write_row(table, query, row)
+        self.cur.execute(savepoint_release.format(name="load_write"))
+
+    def _write_row(self, table, query, row):
+        self.cur.execute(savepoint_create.format(name="load_row"))
+        try:
+            self.cur.execute(query, row)
+        except self.row_errors as e:
+            self.cur.execute(savepoint_rollback.format(name="load_row"))
+            self.cur.execute(load_reject_insert, (self.source, table, json.dumps(list(row), default=str),
+                                                  str(e).strip()))
+            self.rejected += 1
+            metrics.count("rows_rejected", table=table)
+        self.cur.execute(savepoint_release.format(name="load_row"))
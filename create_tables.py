@@ -1,51 +1,119 @@
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import argparse
+from sql_queries import (create_table_queries, drop_table_queries, trgm_index_queries, songplay_index_queries,
+                         songplay_index_drop_queries, songplay_key_drop, songplay_key_create, songplay_foreign_keys_drop,
+                         songplay_foreign_keys_create, songplay_foreign_keys_validate, bulk_load_tables,
+                         set_unlogged, set_logged, partitioned_create_table_queries,
+                         songplay_partition_interval_comment, songplay_partitioned_key_create,
+                         songplay_partitioned_foreign_keys_create, compact_create_table_queries)
+from backends import BACKENDS, get_backend
+from partitions import PARTITION_INTERVALS, partition_interval, list_partitions
 
 
-def create_database():
+def create_database(backend=None):
     """
-    - Creates and connects to the sparkifydb
+    - Connects to the sparkifydb (created by the pgdatabase service of
+      docker-compose, so no connection to a default database is needed)
     - Returns the connection and cursor to sparkifydb
     """
-    
-    # connect to default database
-    conn = psycopg2.connect("host=pgdatabase dbname=sparkifydb user=student password=student")
-    conn.set_session(autocommit=True)
-    cur = conn.cursor()
-    
-    # create sparkify database with UTF8 encoding
-    #cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    #cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    if backend is None:
+        backend = get_backend("postgres")
 
-    # close connection to default database
-    conn.close()    
-    
     # connect to sparkify database
-    conn = psycopg2.connect("host=pgdatabase dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
+    conn = backend.connect()
+    cur = backend.cursor(conn)
     
     return cur, conn
 
 
-def drop_tables(cur, conn):
+def drop_tables(cur, conn, queries=drop_table_queries):
     """
     Drops each table using the queries in `drop_table_queries` list.
     """
-    for query in drop_table_queries:
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, queries=create_table_queries):
     """
     Creates each table using the queries in `create_table_queries` list. 
     """
-    for query in create_table_queries:
+    for query in queries:
         cur.execute(query)
         conn.commit()
 
 
-def main():
+def persistence_queries(cur, query):
+    """
+    Description: This function builds the SET LOGGED / SET UNLOGGED
+    statements of the star schema tables. A partitioned songplays has no
+    storage of its own, so its partitions are switched instead.
+
+    Arguments:
+        cur: the cursor object.
+        query: set_logged or set_unlogged.
+
+    Returns:
+        list of statements, songplays first.
+    """
+    tables = list(bulk_load_tables)
+    if partition_interval(cur) is not None:
+        tables[:1] = [name for name, _, _, _ in list_partitions(cur)]
+
+    return [query.format(table) for table in tables]
+
+
+def begin_bulk_load(cur, conn, unlogged=False):
+    """
+    Description: This function readies the star schema for a backfill: the
+    songplays keys, foreign keys and secondary indexes are dropped, so
+    loading rows no longer checks or maintains them.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        unlogged: also switch the star schema tables to UNLOGGED, so the
+            load skips the WAL. Their contents are lost on a crash until
+            finish_bulk_load runs.
+
+    Returns:
+        None
+    """
+    create_tables(cur, conn, [songplay_foreign_keys_drop, songplay_key_drop] + songplay_index_drop_queries)
+    if unlogged:
+        create_tables(cur, conn, persistence_queries(cur, set_unlogged))
+
+
+def finish_bulk_load(cur, conn, unlogged=False):
+    """
+    Description: This function restores what begin_bulk_load removed, in
+    one pass over the loaded tables: the tables are logged again, the keys
+    and indexes are built, and the foreign keys are added NOT VALID and then
+    validated (a partitioned songplays cannot take NOT VALID foreign keys,
+    so they are validated as they are added).
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        unlogged: the tables were switched to UNLOGGED by begin_bulk_load.
+
+    Returns:
+        None
+    """
+    if unlogged:
+        # dimensions first: a logged table cannot reference an unlogged one
+        create_tables(cur, conn, persistence_queries(cur, set_logged)[::-1])
+
+    if partition_interval(cur) is not None:
+        create_tables(cur, conn, [songplay_partitioned_key_create] + songplay_index_queries +
+                      [songplay_partitioned_foreign_keys_create])
+    else:
+        create_tables(cur, conn, [songplay_key_create] + songplay_index_queries +
+                      [songplay_foreign_keys_create, songplay_foreign_keys_validate])
+
+
+def main(backend_name="postgres", path=None, dsn=None, trgm=False, bulk_load=False, unlogged=False,
+         partitioned=False, interval="month", compact=False):
     """
     - Drops (if exists) and Creates the sparkify database. 
     
@@ -57,14 +125,75 @@ def main():
     - Creates all tables needed. 
     
     - Finally, closes the connection. 
+
+    - backend_name selects the postgres server or an embedded sqlite /
+      duckdb database file at path.
+
+    - dsn overrides the postgres connection settings (see db.get_dsn).
+
+    - trgm also creates the pg_trgm extension and a trigram index on
+      songs.title for fuzzy title matching (postgres only).
+
+    - bulk_load leaves the tables without songplays keys, foreign keys and
+      secondary indexes (and UNLOGGED with unlogged) for a following
+      `etl.py --bulk-load` backfill, which builds them at the end.
+
+    - partitioned creates songplays range partitioned by start_time, one
+      partition per interval ("month" or "year"); etl.py creates
+      the partitions of the months it loads (postgres only).
+
+    - compact stores songplays in songplay_facts with integer keys for
+      songs, artists, locations and user agents, behind a songplays view
+      with the usual columns (postgres only).
     """
-    cur, conn = create_database()
+    backend = get_backend(backend_name, dsn=dsn, path=path)
+    cur, conn = create_database(backend)
     
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    drop_tables(cur, conn, backend.drop_table_queries)
+    if compact:
+        if backend.name != "postgres" or partitioned or bulk_load:
+            raise ValueError("--compact needs the postgres backend, without --partitioned or --bulk-load")
+        create_tables(cur, conn, compact_create_table_queries)
+    elif partitioned:
+        if backend.name != "postgres":
+            raise ValueError("--partitioned needs the postgres backend")
+        create_tables(cur, conn, partitioned_create_table_queries +
+                      [songplay_partition_interval_comment.format(interval=interval)])
+    else:
+        create_tables(cur, conn, backend.create_table_queries)
+    if trgm:
+        if backend.name != "postgres":
+            raise ValueError("--trgm needs the postgres backend")
+        create_tables(cur, conn, trgm_index_queries)
+    if bulk_load:
+        if backend.name != "postgres":
+            raise ValueError("--bulk-load needs the postgres backend")
+        begin_bulk_load(cur, conn, unlogged)
 
     conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create the sparkifydb star schema.")
+    parser.add_argument("--backend", choices=BACKENDS, default="postgres")
+    parser.add_argument("--db-path", default=None, help="database file of an embedded backend")
+    parser.add_argument("--dsn", default=None,
+                        help="postgres connection string (defaults to SPARKIFY_DSN or the PG* variables)")
+    parser.add_argument("--trgm", action="store_true",
+                        help="also create a pg_trgm index on songs.title for fuzzy title matching")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="create the tables without songplays keys, foreign keys and secondary indexes "
+                             "for an etl.py --bulk-load backfill")
+    parser.add_argument("--unlogged", action="store_true",
+                        help="with --bulk-load, create the star schema tables UNLOGGED")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="range partition songplays by start_time")
+    parser.add_argument("--partition-interval", choices=PARTITION_INTERVALS, default="month",
+                        help="time range of one songplays partition")
+    parser.add_argument("--compact", action="store_true",
+                        help="store songplays with integer surrogate keys and dictionary-encoded locations and "
+                             "user agents, behind a songplays view")
+    args = parser.parse_args()
+
+    main(args.backend, args.db_path, args.dsn, args.trgm, args.bulk_load, args.unlogged, args.partitioned,
+         args.partition_interval, args.compact)
@@ -0,0 +1,184 @@
+import os
+import re
+from urllib.parse import quote
+
+import psycopg2
+from psycopg2.extensions import make_dsn, parse_dsn
+
+from sql_queries import (songplay_table_insert, user_table_insert, time_table_insert, song_select,
+                         prepared_statement_select)
+
+
+# connection settings of the docker-compose pgdatabase service
+DEFAULT_DSN = "host=pgdatabase dbname=sparkifydb user=student password=student"
+
+# libpq keyword -> environment variable overriding it
+ENV_SETTINGS = {
+    "host": "PGHOST",
+    "port": "PGPORT",
+    "dbname": "PGDATABASE",
+    "user": "PGUSER",
+    "password": "PGPASSWORD",
+}
+
+# hot statements prepared once per connection: statement -> prepared name
+PREPARED_STATEMENTS = {
+    songplay_table_insert: "songplay_insert",
+    user_table_insert: "user_upsert",
+    time_table_insert: "time_insert",
+    song_select: "song_lookup",
+}
+
+
+def get_dsn(dsn=None):
+    """
+    Description: This function resolves the connection string of sparkifydb.
+    An explicit dsn wins, then SPARKIFY_DSN, then the docker-compose defaults
+    with any of the standard PGHOST / PGPORT / PGDATABASE / PGUSER /
+    PGPASSWORD variables applied on top.
+
+    Arguments:
+        dsn: libpq connection string, or None to read the environment.
+
+    Returns:
+        libpq connection string.
+    """
+    if dsn:
+        return dsn
+    if os.environ.get("SPARKIFY_DSN"):
+        return os.environ["SPARKIFY_DSN"]
+
+    overrides = {key: os.environ[var] for key, var in ENV_SETTINGS.items() if os.environ.get(var)}
+    return make_dsn(DEFAULT_DSN, **overrides)
+
+
+def session_settings(dsn, **settings):
+    """
+    Description: This function adds server settings to a connection string,
+    so they apply to every session opened with it (worker processes too).
+
+    Arguments:
+        dsn: libpq connection string.
+        settings: setting name -> value, e.g. synchronous_commit="off".
+
+    Returns:
+        libpq connection string.
+    """
+    params = parse_dsn(dsn)
+    options = [params.get("options", "")] + ["-c {}={}".format(name, value) for name, value in settings.items()]
+    return make_dsn(dsn, options=" ".join(option for option in options if option))
+
+
+def database_url(dsn=None):
+    """
+    Description: This function converts the connection settings into a
+    postgresql:// URL, as SQLAlchemy and asyncpg take them.
+
+    Arguments:
+        dsn: libpq connection string, or None to read the environment.
+
+    Returns:
+        postgresql:// URL.
+    """
+    params = parse_dsn(get_dsn(dsn))
+    credentials = quote(params.get("user", ""), safe="")
+    if params.get("password"):
+        credentials += ":" + quote(params["password"], safe="")
+    host = params.get("host", "localhost")
+    if params.get("port"):
+        host += ":" + params["port"]
+
+    return "postgresql://{}@{}/{}".format(credentials, host, params.get("dbname", ""))
+
+
+def pool_size():
+    # connections one load may hold at once, across processes and threads
+    return int(os.environ.get("SPARKIFY_POOL_SIZE", 8))
+
+
+def connect(dsn=None, autocommit=False):
+    """
+    Description: This function opens a connection to sparkifydb.
+
+    Arguments:
+        dsn: libpq connection string, or None to read the environment.
+        autocommit: put the connection in autocommit mode.
+
+    Returns:
+        psycopg2 connection.
+    """
+    conn = psycopg2.connect(get_dsn(dsn))
+    conn.autocommit = autocommit
+    return conn
+
+
+def numbered_params(query):
+    """
+    Description: This function rewrites the %s placeholders of a
+    sql_queries statement into the $1, $2, ... form of server-side
+    prepared statements (and of asyncpg).
+
+    Arguments:
+        query: statement using %s placeholders.
+
+    Returns:
+        (statement using numbered placeholders, number of parameters)
+    """
+    num_params = query.count("%s")
+    params = iter(range(1, num_params + 1))
+    return re.sub("%s", lambda match: "${}".format(next(params)), query), num_params
+
+
+def prepare_statement(name, query):
+    """
+    Description: This function turns a sql_queries statement into a
+    PREPARE statement.
+
+    Arguments:
+        name: prepared statement name.
+        query: statement using %s placeholders.
+
+    Returns:
+        (PREPARE statement, EXECUTE statement using %s placeholders)
+    """
+    body, num_params = numbered_params(query.strip().rstrip(";"))
+
+    return ("PREPARE {} AS {}".format(name, body),
+            "EXECUTE {} ({})".format(name, ", ".join(["%s"] * num_params)))
+
+
+class PreparedCursor:
+    """
+    Cursor wrapper running the PREPARED_STATEMENTS as server-side prepared
+    statements, so Postgres parses and plans each of them once per
+    connection instead of once per row. Every other statement is passed
+    through unchanged.
+
+    Prepared statements live as long as the session, so they are not usable
+    behind a transaction-pooling pgbouncer.
+    """
+
+    def __init__(self, cur, statements=PREPARED_STATEMENTS):
+        self._cur = cur
+        self._statements = statements
+        self._executes = {}
+
+    def execute(self, query, vars=None):
+        name = self._statements.get(query)
+        if name is None or vars is None:
+            if vars is None:
+                return self._cur.execute(query)
+            return self._cur.execute(query, vars)
+
+        if name not in self._executes:
+            prepare, execute = prepare_statement(name, query)
+            # another cursor of the same connection may have prepared it
+            self._cur.execute(prepared_statement_select, (name,))
+            if self._cur.fetchone() is None:
+                self._cur.execute(prepare)
+            self._executes[name] = execute
+
+        return self._cur.execute(self._executes[name], vars)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
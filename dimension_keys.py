@@ -0,0 +1,101 @@
+from sql_queries import (songplay_facts_select, song_key_select, artist_key_select, location_key_select,
+                         user_agent_key_select, location_insert, user_agent_insert)
+
+
+# natural keys remembered per dimension before its cache is reset
+KEY_CACHE_LIMIT = 1000000
+
+
+def compact_songplays(cur):
+    """
+    Description: This function tells whether songplays is the compact
+    songplay_facts table behind a view (create_tables.py --compact).
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        bool
+    """
+    cur.execute(songplay_facts_select)
+    return bool(cur.fetchone()[0])
+
+
+class KeyCache:
+    """
+    In-process natural key -> surrogate key map of one dimension. Misses are
+    resolved with one query per batch; dimensions with an insert query get
+    their new values added first (ON CONFLICT DO NOTHING, so concurrent
+    loaders agree on the keys).
+    """
+
+    def __init__(self, select, insert=None, limit=KEY_CACHE_LIMIT):
+        self._select = select
+        self._insert = insert
+        self._limit = limit
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def keys(self, cur, values):
+        """
+        Description: This function maps the values of a batch to their
+        surrogate keys.
+
+        Arguments:
+            cur: the cursor object.
+            values: list of natural keys; None, NaN and "" stay None.
+
+        Returns:
+            list of surrogate keys, in values order.
+        """
+        # natural keys are strings, anything else marks a missing value
+        values = [value if isinstance(value, str) and value else None for value in values]
+        missing = sorted({value for value in values if value is not None and value not in self._keys})
+        if missing:
+            if len(self._keys) + len(missing) > self._limit:
+                self._keys.clear()
+            if self._insert is not None:
+                cur.execute(self._insert, (missing,))
+            cur.execute(self._select, (missing,))
+            self._keys.update(cur.fetchall())
+
+        return [self._keys.get(value) for value in values]
+
+
+class SongplayEncoder:
+    """
+    Turns songplay rows in songplay_table_columns order into songplay_facts
+    rows: songs and artists become their integer surrogate keys, locations
+    and user agents their dictionary codes, and session ids integers.
+    """
+
+    def __init__(self):
+        self.songs = KeyCache(song_key_select)
+        self.artists = KeyCache(artist_key_select)
+        self.locations = KeyCache(location_key_select, location_insert)
+        self.user_agents = KeyCache(user_agent_key_select, user_agent_insert)
+
+    def reset(self):
+        # after a rollback the caches may hold keys of rows that are gone
+        self.__init__()
+
+    def encode(self, cur, rows):
+        """
+        Description: This function encodes a batch of songplay rows.
+
+        Arguments:
+            cur: the cursor object.
+            rows: list of songplay rows in songplay_table_columns order.
+
+        Returns:
+            list of rows in songplay_facts_columns order.
+        """
+        if not rows:
+            return []
+
+        start_time, session_id, user_id, song_id, artist_id, level, location, user_agent = zip(*rows)
+        return list(zip(start_time, [int(value) for value in session_id], user_id,
+                        self.songs.keys(cur, song_id), self.artists.keys(cur, artist_id), level,
+                        self.locations.keys(cur, location), self.user_agents.keys(cur, user_agent)))
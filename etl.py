@@ -1,11 +1,128 @@
+import io
 import os
-import glob
-import psycopg2
+import argparse
+import functools
+import contextlib
+import multiprocessing
+import resource
 import pandas as pd
 from sql_queries import *
+from bulk_load import copy_into
+from song_index import SongIndex
+from parse_cache import ParseCache, CACHE_MAX_BYTES
+from dimension_keys import SongplayEncoder, compact_songplays
+from checkpoints import (CHECKPOINT_LINES, mapped_file, line_chunks, read_checkpoint, save_checkpoint,
+                         clear_checkpoints, transaction)
+from manifest import file_stat, file_snapshot, pending_files, record_file, record_files
+from song_reader import (SONG_COLUMNS, ARTIST_COLUMNS, SONG_BATCH_SIZE, scan_files, read_song_batch, song_frame,
+                         song_executor)
+from backends import BACKENDS, get_backend
+from create_tables import begin_bulk_load, finish_bulk_load
+from partitions import partition_interval, log_months, ensure_partitions
+from rollups import refresh_rollups
+from queries import mark_changed
+from commits import COMMIT_MODES, COMMIT_ROWS, CommitBatcher, insert_rows
+import db
+import metrics
 
 
-def process_song_file(cur, filepath):
+LOAD_MODES = ("insert", "copy", "staging")
+
+# star schema tables written by the song and the log files, whose cached
+# query results a load invalidates
+SONG_TABLES = ("songs", "artists")
+LOG_TABLES = ("time", "users", "songplays")
+LOOKUP_MODES = ("query", "index")
+
+# start_time values remembered between batches before the cache is reset;
+# ON CONFLICT DO NOTHING still catches anything the cache has forgotten
+TIME_CACHE_LIMIT = 1000000
+
+# per-process state for process_data_parallel workers
+_worker = {}
+
+
+def read_cached(filepath, kind, parse, parse_cache=None):
+    """
+    Description: This function parses a data file, or reads its parsed frame
+    from the parse cache when the cache holds a valid entry for it.
+
+    Arguments:
+        filepath: data file path.
+        kind: what the cache entry holds, "songs" or "events".
+        parse: function parsing the file into a dataframe.
+        parse_cache: optional ParseCache.
+
+    Returns:
+        dataframe.
+    """
+    with metrics.stage("parse"):
+        df = parse_cache.get(filepath, kind) if parse_cache is not None else None
+        if df is not None:
+            metrics.count("parse_cache", result="hit")
+            return df
+
+        df = parse(filepath)
+        metrics.count("bytes_read", os.path.getsize(filepath))
+        if parse_cache is not None:
+            metrics.count("parse_cache", result="miss")
+            parse_cache.put(filepath, kind, df)
+
+    return df
+
+
+def read_log_events(filepath):
+    # NextSong events are all the ETL uses, so only those are cached
+    df = pd.read_json(filepath, lines = True)
+    metrics.count("rows_in", len(df), source="log_data")
+    return df[df["page"] == "NextSong"].reset_index(drop=True)
+
+
+def read_json_lines(filepath, start=0, stop=None, columns=()):
+    """
+    Description: This function parses the newline-delimited JSON records
+    between two line boundaries of a file.
+
+    Arguments:
+        filepath: data file path.
+        start: byte offset of the first line.
+        stop: byte offset to stop at (default: the end of the file).
+        columns: columns of the empty dataframe returned for a range
+            without records.
+
+    Returns:
+        dataframe of every record.
+    """
+    with mapped_file(filepath) as data:
+        raw = data[start:stop]
+    metrics.count("bytes_read", len(raw))
+    if not raw.strip():
+        return pd.DataFrame(columns=list(columns))
+    return pd.read_json(io.BytesIO(raw), lines = True)
+
+
+def write_rows(cur, table, query, rows, load_mode="insert", batcher=None):
+    """
+    Description: This function writes rows into a star schema table, through
+    the CommitBatcher of a batched load when there is one.
+
+    Arguments:
+        cur: the cursor object.
+        table: target table.
+        query: single-row statement for the table.
+        rows: list of rows in the statement's parameter order.
+        load_mode: "insert" for one statement per row, "copy" for COPY bulk loads.
+        batcher: optional CommitBatcher.
+
+    Returns:
+        number of rows written.
+    """
+    if batcher is not None:
+        return batcher.write(table, query, rows, copy=load_mode == "copy")
+    return insert_rows(cur, table, query, rows, copy=load_mode == "copy")
+
+
+def process_song_file(cur, filepath, load_mode="insert", song_index=None, parse_cache=None, batcher=None):
     """
     Description: This function is responsible for executing the ingest process
     for each song file and extract required data to load it to database
@@ -13,26 +130,88 @@ def process_song_file(cur, filepath):
     Arguments:
         cur: the cursor object.
         filepath: song data file path.
+        load_mode: "insert" for one statement per row, "copy" for COPY bulk loads.
+        song_index: optional SongIndex kept in sync with the songs loaded.
+        parse_cache: optional ParseCache holding parsed song files.
+        batcher: optional CommitBatcher of a batched load.
 
     Returns:
-        None
+        number of songs loaded.
     """
     # open song file
-    df = pd.read_json(filepath, lines = True)
+    df = read_cached(filepath, "songs", lambda path: pd.read_json(path, lines = True), parse_cache)
+    metrics.count("rows_in", len(df), source="song_data")
+
+    if song_index is not None:
+        song_index.add(df)
+
+    if load_mode == "copy":
+        with metrics.stage("insert"):
+            write_rows(cur, "songs", song_table_insert, df[SONG_COLUMNS].values.tolist(), load_mode, batcher)
+            write_rows(cur, "artists", artist_table_insert, df[ARTIST_COLUMNS].values.tolist(), load_mode, batcher)
+        metrics.count("rows_out", len(df), table="songs")
+        metrics.count("rows_out", len(df), table="artists")
+        return len(df)
+
+    with metrics.stage("insert"):
+        # insert song record
+        song_data = df[SONG_COLUMNS].values.tolist()[:1]
+
+        write_rows(cur, "songs", song_table_insert, song_data, load_mode, batcher)
+
+        # insert artist record
+        artist_data = df[ARTIST_COLUMNS].values.tolist()[:1]
+
+        write_rows(cur, "artists", artist_table_insert, artist_data, load_mode, batcher)
+
+    metrics.count("rows_out", 1, table="songs")
+    metrics.count("rows_out", 1, table="artists")
+    return 1
 
-    # insert song record
-    song_data = df[["song_id", "title", "artist_id", "artist_name", "year", "duration"]].values.tolist()[0]
-    
-    cur.execute(song_table_insert, song_data)
 
+def process_song_batch(cur, paths, load_mode="insert", song_index=None, executor=None, batcher=None):
+    """
+    Description: This function loads a batch of song files at once: the
+    files are parsed into plain records, and one songs / artists frame is
+    built and written for the whole batch instead of one per file.
+
+    Arguments:
+        cur: the cursor object.
+        paths: song data file paths.
+        load_mode: "insert" for one multi-row INSERT per table, "copy" for COPY bulk loads.
+        song_index: optional SongIndex kept in sync with the songs loaded.
+        executor: optional thread pool the files are read on.
+        batcher: optional CommitBatcher of a batched load.
+
+    Returns:
+        list of songs loaded per file, in path order.
+    """
+    with metrics.stage("parse"):
+        batches = read_song_batch(paths, executor)
+    metrics.count("bytes_read", sum(os.path.getsize(path) for path in paths))
+
+    with metrics.stage("transform"):
+        df = song_frame([record for records in batches for record in records])
+    metrics.count("rows_in", len(df), source="song_data")
 
+    if song_index is not None:
+        song_index.add(df)
 
-    # insert artist record
-    artist_data = df[["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]].values.tolist()[0]
+    with metrics.stage("insert"):
+        copy = load_mode == "copy"
+        if batcher is not None:
+            batcher.write("songs", song_table_insert, df[SONG_COLUMNS].values.tolist(), copy, not copy)
+            batcher.write("artists", artist_table_insert, df[ARTIST_COLUMNS].values.tolist(), copy, not copy)
+        else:
+            insert_rows(cur, "songs", song_table_insert, df[SONG_COLUMNS].values.tolist(), copy, not copy)
+            insert_rows(cur, "artists", artist_table_insert, df[ARTIST_COLUMNS].values.tolist(), copy, not copy)
+    metrics.count("rows_out", len(df), table="songs")
+    metrics.count("rows_out", len(df), table="artists")
 
-    cur.execute(artist_table_insert, artist_data)
+    return [len(records) for records in batches]
 
-def process_log_file(cur, filepath):
+def process_log_file(cur, filepath, load_mode="insert", song_index=None, chunksize=None, loaded_times=None,
+                     parse_cache=None, user_history=False, encoder=None, batcher=None, resume=None, stop=None):
     """
     Description: This function is responsible for executing the ingest process
     for each log file and extract required data to load it to database
@@ -40,56 +219,324 @@ def process_log_file(cur, filepath):
     Arguments:
         cur: the cursor object.
         filepath: log file path.
+        load_mode: "insert" for one statement per row, "copy" for COPY bulk loads.
+        song_index: optional SongIndex used instead of one song_select per event.
+        chunksize: when set, stream the file this many lines at a time instead
+            of reading it whole, so memory stays bounded by the chunk size.
+        loaded_times: optional set of start_time values already loaded, shared
+            across files so each timestamp is only sent once.
+        parse_cache: optional ParseCache holding the NextSong events of log
+            files; chunked reads use entries but do not create them.
+        user_history: also record level changes in user_level_history.
+        encoder: SongplayEncoder when songplays is the compact songplay_facts table.
+        batcher: optional CommitBatcher of a batched load.
+        resume: (byte offset, events loaded before it) of a file loaded up to
+            that offset before, e.g. one that was appended to since.
+        stop: byte offset to stop at, so lines appended while the file loads
+            are left for the next load.
 
     Returns:
-        None
+        number of NextSong events loaded from the file, the ones before
+        resume included.
     """
-    # open log file
-    df = pd.read_json(filepath, lines = True)
+    if resume is not None or stop is not None:
+        # a byte range is read through a memory map, without the parse cache
+        start, num_events = resume or (0, 0)
+        with mapped_file(filepath) as data:
+            for chunk_start, chunk_end in line_chunks(data, start, chunksize or CHECKPOINT_LINES, stop):
+                with metrics.stage("parse"):
+                    chunk = pd.read_json(io.BytesIO(data[chunk_start:chunk_end]), lines = True)
+                metrics.count("bytes_read", chunk_end - chunk_start)
+                metrics.count("rows_in", len(chunk), source="log_data")
+                if len(chunk):
+                    num_events += load_log_events(cur, chunk[chunk["page"] == "NextSong"], load_mode, song_index,
+                                                  loaded_times, user_history, encoder, batcher)
+        return num_events
 
-    # filter by NextSong action
-    df = df[df["page"] == "NextSong"]
+    if chunksize and parse_cache is not None:
+        with metrics.stage("parse"):
+            df = parse_cache.get(filepath, "events")
+        if df is not None:
+            metrics.count("parse_cache", result="hit")
+            return sum(load_log_events(cur, df.iloc[start:start + chunksize], load_mode, song_index, loaded_times,
+                                       user_history, encoder, batcher)
+                       for start in range(0, len(df), chunksize))
 
-    # insert time data records
-    t = pd.to_datetime(df.ts, unit = "ms")
+    if chunksize:
+        metrics.count("bytes_read", os.path.getsize(filepath))
+        num_events = 0
+        with pd.read_json(filepath, lines = True, chunksize = chunksize) as reader:
+            for chunk in metrics.timed(reader, "parse"):
+                metrics.count("rows_in", len(chunk), source="log_data")
+                num_events += load_log_events(cur, chunk[chunk["page"] == "NextSong"], load_mode, song_index,
+                                              loaded_times, user_history, encoder, batcher)
+        return num_events
 
-    time_data = (df.ts, t.dt.hour, t.dt.day, t.dt.isocalendar().week, t.dt.month, t.dt.year, t.dt.weekday)
-    column_labels = ('timestamp','hour','day','week','month','year','weekday')
-    
-    time_df = pd.DataFrame.from_dict(dict(zip(column_labels,time_data)))
+    # open log file, filtered by NextSong action
+    df = read_cached(filepath, "events", read_log_events, parse_cache)
 
-    for i, row in time_df.iterrows():
+    return load_log_events(cur, df, load_mode, song_index, loaded_times, user_history, encoder, batcher)
 
-        cur.execute(time_table_insert, list(row))
 
+def process_log_file_checkpointed(cur, filepath, load_mode="insert", song_index=None, chunksize=None,
+                                  loaded_times=None, user_history=False, encoder=None, resume=None, stop=None):
+    """
+    Description: This function loads a log file in chunks of whole lines read
+    through a memory map. Every chunk commits together with the byte offset
+    it ends at, so a load that fails halfway resumes from the last committed
+    offset instead of reloading (and duplicating) the songplays before it.
+    The end offset of a loaded file stays recorded, so a failure before the
+    file reaches the manifest does not reload it either.
 
-    # load user table
-    user_df = df[["userId", "firstName", "lastName", "gender", "level"]]
+    Arguments:
+        cur: the cursor object, on a connection in autocommit mode.
+        filepath: log file path.
+        load_mode: "insert" for one statement per row, "copy" for COPY bulk loads.
+        song_index: optional SongIndex used instead of one song_select per event.
+        chunksize: lines per chunk (default CHECKPOINT_LINES).
+        loaded_times: optional set of start_time values already loaded.
+        user_history: also record level changes in user_level_history.
+        encoder: SongplayEncoder when songplays is the compact songplay_facts table.
+        resume: (byte offset, events loaded before it) the file manifest
+            shows the file loaded up to, used when no checkpoint is further.
+        stop: byte offset to stop at.
 
-    # insert user records
-    for index, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
+    Returns:
+        number of NextSong events loaded from the whole file.
+    """
+    # appends leave the checkpoint of a log file valid, see select_pending_files
+    byte_offset, num_events = read_checkpoint(cur, filepath, append_only=True)
+    if resume is not None and resume[0] > byte_offset:
+        byte_offset, num_events = resume
+    if byte_offset:
+        print('resuming {} at byte {}'.format(filepath, byte_offset))
 
+    with mapped_file(filepath) as data:
+        for start, end in line_chunks(data, byte_offset, chunksize or CHECKPOINT_LINES, stop):
+            with metrics.stage("parse"):
+                chunk = pd.read_json(io.BytesIO(data[start:end]), lines = True)
+            metrics.count("bytes_read", end - start)
+            metrics.count("rows_in", len(chunk), source="log_data")
 
-    # insert songplay records
-    for index, row in df.iterrows():
+            try:
+                with transaction(cur):
+                    if len(chunk):
+                        num_events += load_log_events(cur, chunk[chunk["page"] == "NextSong"], load_mode,
+                                                      song_index, loaded_times, user_history, encoder)
+                    save_checkpoint(cur, filepath, end, num_events)
+            except Exception:
+                # the rolled back chunk's times and keys may be cached as loaded
+                if loaded_times is not None:
+                    loaded_times.clear()
+                if encoder is not None:
+                    encoder.reset()
+                raise
 
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
+    return num_events
 
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
 
+def load_log_events(cur, df, load_mode="insert", song_index=None, loaded_times=None, user_history=False,
+                    encoder=None, batcher=None):
+    """
+    Description: This function loads the time, user and songplay records for
+    a batch of NextSong events.
+
+    Arguments:
+        cur: the cursor object.
+        df: NextSong events dataframe.
+        load_mode: "insert" for one statement per row, "copy" for COPY bulk loads.
+        song_index: optional SongIndex used instead of one song_select per event.
+        loaded_times: optional set of start_time values already loaded.
+        user_history: also record level changes in user_level_history.
+        encoder: SongplayEncoder when songplays is the compact songplay_facts
+            table; the rows are written there with integer keys.
+        batcher: optional CommitBatcher of a batched load.
+
+    Returns:
+        number of events loaded.
+    """
+    if df.empty:
+        return 0
+
+    with metrics.stage("transform"):
+        # insert time data records
+        time_df = get_time_data(df, loaded_times)
 
-        # insert songplay record
-        songplay_data = tuple([row.ts, row.sessionId, row.userId, songid, artistid, row.level, row.location, row.userAgent])
-        cur.execute(songplay_table_insert, songplay_data)
+        # load user table, one row per user
+        user_df = get_user_data(df)
 
+    songplays = get_songplay_data(cur, df, song_index)
 
-def process_data(cur, conn, filepath, func):
+    songplay_table, songplay_insert = "songplays", songplay_table_insert
+    if encoder is not None:
+        with metrics.stage("lookup"):
+            songplays = encoder.encode(cur, songplays)
+        songplay_table, songplay_insert = "songplay_facts", songplay_facts_insert
+
+    metrics.count("rows_out", len(time_df), table="time")
+    metrics.count("rows_out", len(user_df), table="users")
+    metrics.count("rows_out", len(songplays), table="songplays")
+
+    with metrics.stage("insert"):
+        write_rows(cur, "time", time_table_insert, time_df.astype(object).values.tolist(), load_mode, batcher)
+
+        # insert user records
+        write_rows(cur, "users", user_table_insert, user_df.values.tolist(), load_mode, batcher)
+
+        # insert songplay records
+        write_rows(cur, songplay_table, songplay_insert, songplays, load_mode, batcher)
+
+    if user_history:
+        load_user_history(cur, df, batcher)
+
+    return len(df)
+
+
+def get_user_data(df):
+    """
+    Description: This function collapses the events of a batch into one
+    users row per user, with the level of the user's latest event by ts, so
+    a user with 500 plays is upserted once instead of 500 times. The rows
+    are ordered by user id, so concurrent loads lock users in the same order
+    and cannot deadlock on them.
+
+    Arguments:
+        df: NextSong events dataframe.
+
+    Returns:
+        dataframe in user_table_insert column order.
+    """
+    users = df[["userId", "firstName", "lastName", "gender", "level", "ts"]].sort_values("ts", kind="stable")
+    users = users.drop_duplicates(subset="userId", keep="last")
+    users = users.iloc[users["userId"].astype(str).argsort(kind="stable")]
+    return users[["userId", "firstName", "lastName", "gender", "level"]]
+
+
+def get_level_changes(df):
+    """
+    Description: This function finds the level transitions of a batch of
+    events: the first event of every user plus every event whose level
+    differs from the user's previous one.
+
+    Arguments:
+        df: NextSong events dataframe.
+
+    Returns:
+        list of (user_id, level, ts) in ts order.
+    """
+    events = df[["userId", "level", "ts"]].sort_values("ts", kind="stable")
+    changed = events["level"].ne(events.groupby("userId")["level"].shift())
+    return events[changed].values.tolist()
+
+
+def load_user_history(cur, df, batcher=None):
+    """
+    Description: This function records the level transitions of a batch of
+    events as type 2 periods (valid_from / valid_to) in user_level_history.
+    Batches must arrive in time order; events older than a user's current
+    period are ignored.
+
+    Arguments:
+        cur: the cursor object.
+        df: NextSong events dataframe.
+        batcher: optional CommitBatcher of a batched load.
+
+    Returns:
+        number of transitions checked.
+    """
+    with metrics.stage("transform"):
+        changes = get_level_changes(df)
+
+    with metrics.stage("insert"):
+        for user_id, level, ts in changes:
+            cur.execute(user_level_history_close, (ts, user_id, level, ts))
+            write_rows(cur, "user_level_history", user_level_history_open, [(user_id, level, ts, user_id)],
+                       batcher=batcher)
+
+    metrics.count("rows_out", len(changes), table="user_level_history")
+    return len(changes)
+
+
+def get_time_data(df, loaded_times=None):
+    """
+    Description: This function builds the time dimension rows for a batch of
+    events, computed once per distinct timestamp.
+
+    Arguments:
+        df: NextSong events dataframe.
+        loaded_times: optional set of start_time values already loaded this
+            run; those are skipped and the new ones are added to it.
+
+    Returns:
+        dataframe in time_table_insert column order.
+    """
+    ts = df.ts.drop_duplicates()
+
+    if loaded_times is not None:
+        ts = ts[~ts.isin(loaded_times)]
+        if len(loaded_times) + len(ts) > TIME_CACHE_LIMIT:
+            loaded_times.clear()
+        loaded_times.update(ts.tolist())
+
+    t = pd.to_datetime(ts, unit = "ms")
+
+    return pd.DataFrame({
+        "start_time": ts.values,
+        "start_timestamp": t.values,
+        "hour": t.dt.hour.astype("int16").values,
+        "day": t.dt.day.astype("int16").values,
+        "week": t.dt.isocalendar().week.astype("int16").values,
+        "month": t.dt.month.astype("int16").values,
+        "year": t.dt.year.astype("int16").values,
+        "weekday": t.dt.weekday.astype("int16").values,
+    })
+
+
+def get_songplay_data(cur, df, song_index=None):
+    """
+    Description: This function resolves song_id and artist_id for every
+    NextSong event and builds the songplay records.
+
+    Arguments:
+        cur: the cursor object.
+        df: NextSong events dataframe.
+        song_index: optional SongIndex; resolves the whole dataframe in one join.
+
+    Returns:
+        list of songplay tuples in songplay_table_insert column order.
+    """
+    if song_index is not None:
+        with metrics.stage("lookup"):
+            songs = song_index.resolve(df, cur)
+        hits = int(songs.song_id.notna().sum())
+        metrics.count("song_lookups", hits, result="hit")
+        metrics.count("song_lookups", len(df) - hits, result="miss")
+        return list(zip(df.ts, df.sessionId, df.userId, songs.song_id, songs.artist_id,
+                        df.level, df.location, df.userAgent))
+
+    songplays = []
+    with metrics.stage("lookup"):
+        for index, row in df.iterrows():
+
+            # get songid and artistid from song and artist tables
+            cur.execute(song_select, (row.song, row.artist, row.length))
+            results = cur.fetchone()
+
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
+
+            songplays.append((row.ts, row.sessionId, row.userId, songid, artistid, row.level, row.location, row.userAgent))
+
+    hits = sum(1 for songplay in songplays if songplay[3] is not None)
+    metrics.count("song_lookups", hits, result="hit")
+    metrics.count("song_lookups", len(songplays) - hits, result="miss")
+    return songplays
+
+
+def process_data(cur, conn, filepath, func, incremental=False, rollups=False, tables=(), batcher=None,
+                 append_only=False):
     """
     Description: This function is responsible for listing the files in a directory,
     and then executing the ingest process for each file according to the function
@@ -100,43 +547,616 @@ def process_data(cur, conn, filepath, func):
         conn: connection to the database.
         filepath: log data or song data file path.
         func: function that transforms the data and inserts it into the database.
+        incremental: skip files the file manifest shows as already loaded and
+            record every processed file in it.
+        rollups: fold each file's new songplays into the rollup tables in
+            the same transaction.
+        tables: star schema tables func writes, marked changed with every
+            file so cached query results are recomputed.
+        batcher: CommitBatcher deciding when the work is committed; by
+            default every file ends with conn.commit().
+        append_only: the files are log files, which only ever grow; only the
+            lines appended since their last load are loaded.
 
     Returns:
         None
     """
-    # get all files matching extension from directory
-    all_files = []
-    for root, dirs, files in os.walk(filepath):
-        files = glob.glob(os.path.join(root,'*.json'))
-        for f in files :
-            all_files.append(os.path.abspath(f))
+    batcher = batcher or CommitBatcher(cur, conn)
+    all_files = get_files(filepath)
+    resumes = {}
 
     # get total number of files found
     num_files = len(all_files)
     print('{} files found in {}'.format(num_files, filepath))
 
+    if incremental:
+        all_files, resumes = select_pending_files(cur, all_files, append_only)
+        num_files = len(all_files)
+
     # iterate over files and process
     for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
+        batcher.begin(datafile)
+        load_file(cur, func, datafile, incremental, append_only, resumes.get(datafile))
+        if rollups:
+            with metrics.stage("rollup"):
+                refresh_rollups(cur)
+        if tables:
+            mark_changed(cur, tables)
+        batcher.end_file()
+        metrics.count("files", source=os.path.basename(filepath))
         print('{}/{} files processed.'.format(i, num_files))
 
 
-def main():
+def process_song_data_batched(cur, conn, filepath, load_mode="insert", song_index=None, batch_size=SONG_BATCH_SIZE,
+                              threads=None, incremental=False, batcher=None):
+    """
+    Description: This function loads every song file batch_size files at a
+    time, with one commit per batch instead of one per file.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        filepath: song data directory.
+        load_mode: "insert" or "copy".
+        song_index: optional SongIndex kept in sync with the songs loaded.
+        batch_size: number of song files per batch.
+        threads: number of threads reading song files.
+        incremental: skip files the file manifest shows as already loaded and
+            record every processed file in it.
+        batcher: CommitBatcher deciding when the work is committed; by
+            default every batch, manifest rows included, is one transaction
+            ("file" mode).
+
+    Returns:
+        None
+    """
+    batcher = batcher or CommitBatcher(cur, conn, "file")
+    all_files = get_files(filepath)
+    num_files = len(all_files)
+    print('{} files found in {}'.format(num_files, filepath))
+
+    if incremental:
+        all_files, _ = select_pending_files(cur, all_files)
+        num_files = len(all_files)
+
+    executor = song_executor(threads)
+    try:
+        for start in range(0, num_files, batch_size):
+            paths = all_files[start:start + batch_size]
+            # rejects of a batch are recorded with the song data directory
+            batcher.begin(filepath)
+            snapshots = [file_snapshot(path) for path in paths] if incremental else None
+            loaded = process_song_batch(cur, paths, load_mode, song_index, executor, batcher)
+            if incremental:
+                record_files(cur, zip(paths, loaded, snapshots))
+            mark_changed(cur, SONG_TABLES)
+            batcher.end_file()
+            metrics.count("files", len(paths), source=os.path.basename(filepath))
+            print('{}/{} files processed.'.format(start + len(paths), num_files))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+
+def select_pending_files(cur, all_files, append_only=False):
+    """
+    Description: This function narrows a file list down to the new and
+    changed files according to the file manifest.
+
+    Arguments:
+        cur: the cursor object.
+        all_files: list of data file paths.
+        append_only: the files are log files, which only ever grow; appended
+            files are resumed where the last load stopped.
+
+    Returns:
+        (list of file paths that still need to be loaded, dict of appended
+        file path -> (byte offset, rows loaded before it) to resume from)
+    """
+    new_files, changed_files, appended, skipped = pending_files(cur, all_files, append_only)
+    print('{} new, {} changed, {} appended, {} unchanged files skipped'.format(
+        len(new_files), len(changed_files), len(appended), skipped))
+    if append_only and changed_files:
+        # songplays do not record their file, so the earlier ones stay
+        print('warning: {} log files were rewritten rather than appended to and are reloaded in full; '
+              'their earlier songplays are not removed'.format(len(changed_files)))
+        # a checkpointed load resumes from the checkpoint of a file that grew
+        clear_checkpoints(cur, changed_files)
+
+    return new_files + changed_files + sorted(appended), appended
+
+
+def load_file(cur, func, datafile, incremental=False, append_only=False, resume=None):
+    """
+    Description: This function loads one data file and records it in the
+    file manifest. The manifest entry is taken before the load, and a log
+    file is only loaded up to the size recorded there, so lines appended
+    meanwhile are picked up by the next load instead of twice.
+
+    Arguments:
+        cur: the cursor object.
+        func: function that transforms the data and inserts it into the database.
+        datafile: file path.
+        incremental: record the file in the file manifest.
+        append_only: datafile is a log file, loaded as a byte range.
+        resume: (byte offset, rows loaded before it) of an appended log file.
+
+    Returns:
+        number of rows the file contributed.
+    """
+    snapshot = file_snapshot(datafile) if incremental else None
+    if append_only:
+        stop = snapshot[0] if snapshot else file_stat(datafile)[0]
+        num_rows = func(cur, datafile, resume=resume, stop=stop)
+    else:
+        num_rows = func(cur, datafile)
+    if incremental:
+        record_file(cur, datafile, num_rows, snapshot)
+    return num_rows
+
+
+def get_files(filepath):
+    """
+    Description: This function lists every JSON file below a directory.
+
+    Arguments:
+        filepath: log data or song data directory.
+
+    Returns:
+        list of absolute file paths.
+    """
+    return [path for path, size in scan_files(filepath)]
+
+
+def _init_worker(dsn, func, lookup, incremental, prepare=True, append_only=False):
+    """
+    Description: This function opens the connection a process_data_parallel
+    worker keeps for its whole lifetime.
+
+    Arguments:
+        dsn: libpq connection string.
+        func: function that transforms the data and inserts it into the database.
+        lookup: "index" to give the worker its own SongIndex loaded from the songs table.
+        incremental: record processed files in the file manifest.
+        prepare: run the hot single-row statements as prepared statements.
+        append_only: the files are log files, loaded as byte ranges.
+
+    Returns:
+        None
+    """
+    conn = db.connect(dsn, autocommit=True)
+    cur = metrics.InstrumentedCursor(conn.cursor())
+    if prepare:
+        cur = db.PreparedCursor(cur)
+
+    # checkpointed loads commit chunk by chunk and resume from their checkpoints
+    checkpointed = getattr(func, "func", func) is process_log_file_checkpointed
+
+    if lookup == "index":
+        func = functools.partial(func, song_index=SongIndex.from_db(cur))
+
+    _worker.update(conn=conn, cur=cur, func=func, incremental=incremental, checkpointed=checkpointed,
+                   append_only=append_only)
+
+
+def _process_file(task):
+    """
+    Description: This function processes one file inside a worker process,
+    in one transaction, so a failed file leaves no rows behind. Errors are
+    returned instead of raised so one bad file does not stop the pool.
+
+    Arguments:
+        task: (file path, (byte offset, rows loaded before it) to resume an
+            appended log file from, or None)
+
+    Returns:
+        (datafile, error message or None, metrics snapshot of the file)
+    """
+    datafile, resume = task
+    error = None
+    cur = _worker["cur"]
+    try:
+        with contextlib.nullcontext() if _worker["checkpointed"] else transaction(cur):
+            load_file(cur, _worker["func"], datafile, _worker["incremental"], _worker["append_only"], resume)
+    except Exception as e:
+        error = "{}: {}".format(type(e).__name__, e)
+        # the rolled back file's times and keys may be cached as loaded, and
+        # the worker's later files would skip them
+        keywords = getattr(_worker["func"], "keywords", {})
+        if keywords.get("loaded_times") is not None:
+            keywords["loaded_times"].clear()
+        if keywords.get("encoder") is not None:
+            keywords["encoder"].reset()
+
+    # ship this file's metrics to the parent and start afresh
+    snapshot = metrics.RUN.snapshot()
+    metrics.RUN.reset()
+    return datafile, error, snapshot
+
+
+def process_data_parallel(dsn, filepath, func, workers=None, lookup="query", incremental=False, prepare=True,
+                          append_only=False):
+    """
+    Description: This function is the multi-process version of process_data.
+    Every worker opens its own connection and processes slices of the file
+    list; progress and failures are reported from the parent process. The
+    workers are capped at db.pool_size() so a load never holds more
+    connections than the configured pool.
+
+    Arguments:
+        dsn: libpq connection string used by each worker.
+        filepath: log data or song data file path.
+        func: picklable function that transforms the data and inserts it into the database.
+        workers: number of worker processes (defaults to the CPU count).
+        lookup: "index" to resolve songs through a per-worker SongIndex.
+        incremental: only load new and changed files according to the file manifest.
+        prepare: run the hot single-row statements as prepared statements.
+        append_only: the files are log files; only the lines appended since
+            their last load are loaded.
+
+    Returns:
+        list of (file path, error message) for the files that failed.
+    """
+    all_files = get_files(filepath)
+    resumes = {}
+
+    num_files = len(all_files)
+    print('{} files found in {}'.format(num_files, filepath))
+
+    if incremental:
+        conn = db.connect(dsn, autocommit=True)
+        all_files, resumes = select_pending_files(conn.cursor(), all_files, append_only)
+        conn.close()
+        num_files = len(all_files)
+
+    if not num_files:
+        return []
+
+    workers = min(workers or os.cpu_count() or 1, db.pool_size())
+    chunksize = max(1, num_files // (workers * 4))
+
+    # workers take contiguous slices of the sorted YYYY/MM paths, so with a
+    # partitioned songplays they mostly write to different partitions
+    all_files = sorted(all_files)
+
+    failures = []
+    initargs = (dsn, func, lookup, incremental, prepare, append_only)
+    tasks = [(datafile, resumes.get(datafile)) for datafile in all_files]
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=initargs) as pool:
+        results = pool.imap_unordered(_process_file, tasks, chunksize=chunksize)
+        for i, (datafile, error, snapshot) in enumerate(results, 1):
+            metrics.RUN.merge(snapshot)
+            if error is not None:
+                failures.append((datafile, error))
+                print('failed to process {}: {}'.format(datafile, error))
+            print('{}/{} files processed.'.format(i, num_files))
+
+    if failures:
+        print('{}/{} files failed in {}'.format(len(failures), num_files, filepath))
+
+    return failures
+
+
+def stage_file(cur, filepath, table, columns, start=0, stop=None):
+    """
+    Description: This function bulk loads the raw records of one song or log
+    file into its staging table.
+
+    Arguments:
+        cur: the cursor object.
+        filepath: song or log data file path.
+        table: staging table name.
+        columns: dict of source JSON key -> staging column.
+        start: byte offset of the first line to stage.
+        stop: byte offset to stop at (default: the end of the file).
+
+    Returns:
+        number of records staged.
+    """
+    with metrics.stage("parse"):
+        df = read_json_lines(filepath, start, stop)
+    metrics.count("rows_in", len(df), source=table)
+
+    with metrics.stage("transform"):
+        # nullable dtypes keep integer columns integral when they contain nulls
+        df = df.reindex(columns=list(columns)).convert_dtypes()
+    with metrics.stage("insert"):
+        copy_into(cur, table, list(columns.values()), df.values.tolist())
+    metrics.count("rows_out", len(df), table=table)
+
+    return len(df)
+
+
+def process_data_staged(cur, conn, song_filepath, log_filepath, incremental=False):
+    """
+    Description: This function stages every song and log file with COPY and
+    then builds the star schema with a handful of set-based
+    INSERT ... SELECT ... ON CONFLICT statements, so songplays are resolved
+    with one join inside the database instead of one song_select per event.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        song_filepath: song data directory.
+        log_filepath: log data directory.
+        incremental: only stage new and changed files according to the file manifest.
+
+    Returns:
+        None
+    """
+    cur.execute(staging_tables_truncate)
+
+    staged = []
+    for filepath, table, columns, append_only in ((song_filepath, "staging_songs", staging_songs_columns, False),
+                                                  (log_filepath, "staging_events", staging_events_columns, True)):
+        all_files = get_files(filepath)
+        resumes = {}
+        num_files = len(all_files)
+        print('{} files found in {}'.format(num_files, filepath))
+
+        if incremental:
+            all_files, resumes = select_pending_files(cur, all_files, append_only)
+            num_files = len(all_files)
+
+        for i, datafile in enumerate(all_files, 1):
+            # taken before staging, which stops at its size
+            snapshot = file_snapshot(datafile) if incremental else None
+            start, rows_before = resumes.get(datafile, (0, 0))
+            num_rows = stage_file(cur, datafile, table, columns, start, snapshot[0] if snapshot else None)
+            staged.append((datafile, rows_before + num_rows, snapshot))
+            print('{}/{} files staged.'.format(i, num_files))
+
+    with metrics.stage("merge"):
+        for query in staging_merge_queries:
+            cur.execute(query)
+
+    if incremental:
+        record_files(cur, staged)
+    mark_changed(cur, SONG_TABLES + LOG_TABLES)
+
+    with metrics.stage("commit"):
+        conn.commit()
+    print('{} files merged into the star schema.'.format(len(staged)))
+
+
+def peak_rss_mb():
+    """
+    Description: This function reports the peak resident set size of this
+    process and of its finished child processes.
+
+    Returns:
+        (self peak RSS, largest child peak RSS) in megabytes.
+    """
+    # ru_maxrss is in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return own, children
+
+
+def write_metrics(json_path=None, prom_path=None):
+    """
+    Description: This function prints the run metrics and writes the
+    requested run reports.
+
+    Arguments:
+        json_path: file to write the structured JSON run report to.
+        prom_path: file to write the metrics to in Prometheus text format,
+            e.g. for the node exporter textfile collector.
+
+    Returns:
+        None
+    """
+    own, children = peak_rss_mb()
+    metrics.RUN.gauge("peak_rss_mb", own)
+    if children:
+        metrics.RUN.gauge("worker_peak_rss_mb", children)
+
+    print(metrics.RUN.summary())
+
+    if json_path:
+        with open(json_path, "w") as f:
+            f.write(metrics.RUN.to_json())
+    if prom_path:
+        with open(prom_path, "w") as f:
+            f.write(metrics.RUN.to_prometheus())
+
+
+def main(load_mode="insert", lookup="query", workers=1, chunksize=None, incremental=True,
+         backend_name="postgres", db_path=None, metrics_json=None, metrics_prom=None, dsn=None, prepare=True,
+         bulk_load=False, unlogged=False, song_batch_size=None, song_threads=None, parse_cache_dir=None,
+         parse_cache_bytes=CACHE_MAX_BYTES, checkpoint=False, user_history=False, commit_mode="statement",
+         commit_rows=COMMIT_ROWS, synchronous_commit=True):
     """
     - main function to process all data files and load it to postgres db
+      (or to an embedded sqlite / duckdb database file with backend_name)
+    - load_mode selects row-by-row inserts ("insert"), COPY bulk loads ("copy")
+      or staging tables merged with set-based SQL ("staging")
+    - lookup selects one song_select per event ("query") or an in-memory
+      SongIndex built from the songs table and the song files ("index")
+    - workers > 1 loads files with a process pool; all song files are loaded
+      before any log file so songplays can resolve against them
+    - chunksize streams log files in chunks of that many lines
+    - incremental skips files already recorded in the file manifest with the
+      same content, so a nightly run only loads new and changed files
+    - metrics_json / metrics_prom write the per-stage run metrics as JSON or
+      in Prometheus text format
+    - dsn overrides the postgres connection settings (see db.get_dsn);
+      prepare runs the hot single-row statements as prepared statements
+    - bulk_load drops the songplays keys, foreign keys and secondary indexes
+      before loading and rebuilds them in one pass at the end (unlogged also
+      skips the WAL during the load); meant for full backfills
+    - song_batch_size loads song files that many at a time, parsed on
+      song_threads threads, with one write and one commit per batch
+    - parse_cache_dir caches the parsed song records and NextSong events as
+      Parquet files, so a reload of unchanged files skips JSON parsing;
+      parse_cache_bytes caps its size
+    - checkpoint loads log files in chunks (of chunksize lines) committed with
+      their byte offset, so an interrupted file resumes where it stopped
+    - user_history records every free / paid level change of a user as a
+      type 2 period in user_level_history; needs log files loaded in order
+    - on postgres the rollup tables are brought up to date after every log
+      file, or once at the end of parallel, staging and bulk loads
+    - when create_tables.py --compact made songplays a view over the
+      integer-keyed songplay_facts table, songplays are encoded and loaded
+      into songplay_facts
+    - commit_mode "statement" commits every statement on its own; "rows",
+      "file" and "run" commit explicit transactions after the file reaching
+      commit_rows rows, after every file or once at the end, and log rows that fail to
+      load_rejects under savepoints instead of failing the batch
+    - synchronous_commit=False stops postgres waiting for the WAL flush at
+      every commit; a crash may lose the last commits, so meant for backfills
     - returns None
     """
-    conn = psycopg2.connect("host=pgdatabase dbname=sparkifydb user=student password=student")
-    conn.rollback()
-    conn.autocommit=True
-    cur = conn.cursor()
+    backend = get_backend(backend_name, dsn=dsn, path=db_path, prepare=prepare)
+    if backend.name != "postgres" and (workers > 1 or load_mode == "staging" or bulk_load or not synchronous_commit):
+        raise ValueError("--workers, --load-mode staging, --bulk-load and --no-synchronous-commit need the postgres "
+                         "backend")
+    if user_history and (workers > 1 or load_mode == "staging"):
+        raise ValueError("--user-history loads log files in time order, without --workers or --load-mode staging")
+    if commit_mode != "statement" and (workers > 1 or load_mode == "staging" or checkpoint):
+        raise ValueError("--commit-mode {} batches a single-process load; --workers commit per statement, "
+                         "--load-mode staging once per run and --checkpoint per chunk".format(commit_mode))
+
+    if not synchronous_commit:
+        # on the connection string, so worker connections get it too
+        backend.dsn = db.session_settings(backend.dsn, synchronous_commit="off")
+
+    parse_cache = ParseCache(parse_cache_dir, parse_cache_bytes) if parse_cache_dir else None
+
+    conn = backend.connect(autocommit=True)
+    cur = backend.cursor(conn, wrapper=metrics.InstrumentedCursor)
+    batcher = None
+    if commit_mode != "statement":
+        batcher = CommitBatcher(cur, conn, commit_mode, commit_rows, backend.row_errors)
+
+    rollups = backend.name == "postgres"
+    if rollups:
+        # partitions are created up front so parallel loaders never race on DDL
+        interval = partition_interval(cur)
+        if interval is not None:
+            ensure_partitions(cur, conn, log_months('data/log_data'), interval)
+
+    encoder = SongplayEncoder() if rollups and compact_songplays(cur) else None
+    if encoder is not None and (load_mode == "staging" or bulk_load):
+        raise ValueError("a compact songplays schema loads with --load-mode insert or copy, without --bulk-load")
+
+    if bulk_load:
+        with metrics.stage("bulk_load"):
+            begin_bulk_load(cur, conn, unlogged)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    if checkpoint:
+        if not incremental:
+            clear_checkpoints(cur)
+        process_log = functools.partial(process_log_file_checkpointed, load_mode=load_mode, chunksize=chunksize,
+                                        loaded_times=set(), user_history=user_history, encoder=encoder)
+    else:
+        process_log = functools.partial(process_log_file, load_mode=load_mode, chunksize=chunksize,
+                                        loaded_times=set(), parse_cache=parse_cache, user_history=user_history,
+                                        encoder=encoder)
+
+    if workers > 1:
+        process_data_parallel(backend.dsn, 'data/song_data',
+                              functools.partial(process_song_file, load_mode=load_mode, parse_cache=parse_cache),
+                              workers=workers, incremental=incremental, prepare=prepare)
+        process_data_parallel(backend.dsn, 'data/log_data', process_log, workers=workers, lookup=lookup,
+                              incremental=incremental, prepare=prepare, append_only=True)
+        # once for all workers, which would otherwise queue on the same rows
+        mark_changed(cur, SONG_TABLES + LOG_TABLES)
+    elif load_mode == "staging":
+        process_data_staged(cur, conn, 'data/song_data', 'data/log_data', incremental=incremental)
+    else:
+        song_index = backend.song_index(cur) if lookup == "index" else None
+
+        if song_batch_size:
+            process_song_data_batched(cur, conn, 'data/song_data', load_mode=load_mode, song_index=song_index,
+                                      batch_size=song_batch_size, threads=song_threads, incremental=incremental,
+                                      batcher=batcher)
+        else:
+            process_data(cur, conn, filepath='data/song_data',
+                         func=functools.partial(process_song_file, load_mode=load_mode, song_index=song_index,
+                                                parse_cache=parse_cache, batcher=batcher),
+                         incremental=incremental, tables=SONG_TABLES, batcher=batcher)
+        if batcher is not None:
+            process_log = functools.partial(process_log, batcher=batcher)
+        process_data(cur, conn, filepath='data/log_data',
+                     func=functools.partial(process_log, song_index=song_index),
+                     incremental=incremental, rollups=rollups and not bulk_load, tables=LOG_TABLES, batcher=batcher,
+                     append_only=True)
+
+    if batcher is not None:
+        batcher.finish()
+        if batcher.rejected:
+            print('{} rows rejected, see load_rejects.'.format(batcher.rejected))
+
+    if bulk_load:
+        with metrics.stage("bulk_load"):
+            finish_bulk_load(cur, conn, unlogged)
+
+    if rollups:
+        # catches up after parallel, staging and bulk loads; a no-op otherwise
+        with metrics.stage("rollup"):
+            refresh_rollups(cur)
+        conn.commit()
 
     conn.close()
+    write_metrics(metrics_json, metrics_prom)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Load song and log data into sparkifydb.")
+    parser.add_argument("--load-mode", choices=LOAD_MODES, default="insert",
+                        help="row-by-row INSERTs, COPY ... FROM STDIN bulk loads, or staging tables plus set-based merges")
+    parser.add_argument("--lookup", choices=LOOKUP_MODES, default="query",
+                        help="resolve songs with one song_select per event or an in-memory index")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, each with its own connection")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="stream log files this many lines at a time to bound memory")
+    parser.add_argument("--full-reload", action="store_true",
+                        help="load every file, ignoring the file manifest")
+    parser.add_argument("--backend", choices=BACKENDS, default="postgres",
+                        help="postgres server, or an in-process sqlite / duckdb database")
+    parser.add_argument("--db-path", default=None, help="database file of an embedded backend")
+    parser.add_argument("--metrics-json", default=None, help="write the per-stage run report to this JSON file")
+    parser.add_argument("--metrics-prom", default=None,
+                        help="write the run metrics to this file in Prometheus text format")
+    parser.add_argument("--dsn", default=None,
+                        help="postgres connection string (defaults to SPARKIFY_DSN or the PG* variables)")
+    parser.add_argument("--no-prepare", action="store_true",
+                        help="send every statement as plain SQL, e.g. behind a transaction-pooling pgbouncer")
+    parser.add_argument("--bulk-load", action="store_true",
+                        help="defer the songplays keys, foreign keys and secondary indexes to the end of the load")
+    parser.add_argument("--unlogged", action="store_true",
+                        help="with --bulk-load, load into UNLOGGED tables and switch them to LOGGED afterwards")
+    parser.add_argument("--song-batch-size", type=int, default=None,
+                        help="load song files this many at a time, with one write and one commit per batch "
+                             "(e.g. {})".format(SONG_BATCH_SIZE))
+    parser.add_argument("--song-threads", type=int, default=None,
+                        help="with --song-batch-size, threads reading the song files")
+    parser.add_argument("--parse-cache", default=None, metavar="DIR",
+                        help="cache parsed song records and NextSong events as Parquet files in this directory "
+                             "(needs pyarrow)")
+    parser.add_argument("--parse-cache-mb", type=int, default=CACHE_MAX_BYTES >> 20,
+                        help="evict the least recently used parse cache entries beyond this size")
+    parser.add_argument("--checkpoint", action="store_true",
+                        help="commit log files in chunks of --chunksize lines with their byte offset, "
+                             "so an interrupted file resumes where it stopped")
+    parser.add_argument("--user-history", action="store_true",
+                        help="record the free / paid level changes of every user in user_level_history")
+    parser.add_argument("--commit-mode", choices=COMMIT_MODES, default="statement",
+                        help="commit every statement, every --commit-rows rows, every file or once per run; "
+                             "batched modes log failing rows to load_rejects")
+    parser.add_argument("--commit-rows", type=int, default=COMMIT_ROWS,
+                        help="rows per transaction with --commit-mode rows, committed at the end of a file")
+    parser.add_argument("--no-synchronous-commit", action="store_true",
+                        help="do not wait for the WAL flush at commit (backfills; a crash may lose the last commits)")
+    args = parser.parse_args()
+
+    main(load_mode=args.load_mode, lookup=args.lookup, workers=args.workers, chunksize=args.chunksize,
+         incremental=not args.full_reload, backend_name=args.backend, db_path=args.db_path,
+         metrics_json=args.metrics_json, metrics_prom=args.metrics_prom, dsn=args.dsn,
+         prepare=not args.no_prepare, bulk_load=args.bulk_load, unlogged=args.unlogged,
+         song_batch_size=args.song_batch_size, song_threads=args.song_threads, parse_cache_dir=args.parse_cache,
+         parse_cache_bytes=args.parse_cache_mb << 20, checkpoint=args.checkpoint, user_history=args.user_history,
+         commit_mode=args.commit_mode, commit_rows=args.commit_rows,
+         synchronous_commit=not args.no_synchronous_commit)
@@ -0,0 +1,285 @@
+import os
+import json
+import string
+import argparse
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+FIRST_NAMES = ["Walter", "Kaylee", "Lily", "Jacob", "Chloe", "Aleena", "Tegan", "Jayden", "Ryan", "Mohammad",
+               "Matthew", "Kate", "Sara", "Rylan", "Avery", "Jordan", "Layla", "Cecilia", "Wyatt", "Emily"]
+LAST_NAMES = ["Frye", "Summers", "Koch", "Klein", "Cuevas", "Kirby", "Levine", "Graves", "Smith", "Rodriguez",
+              "Jones", "Harrell", "Johnson", "George", "Watkins", "Bell", "Griffin", "Owens", "Scott", "Garrison"]
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "Phoenix-Mesa-Scottsdale, AZ", "Lansing-East Lansing, MI",
+             "New York-Newark-Jersey City, NY-NJ-PA", "Chicago-Naperville-Elgin, IL-IN-WI",
+             "Atlanta-Sandy Springs-Roswell, GA", "Houston-The Woodlands-Sugar Land, TX",
+             "Portland-South Portland, ME", "Tampa-St. Petersburg-Clearwater, FL", "Waterloo-Cedar Falls, IA"]
+USER_AGENTS = [
+    "\"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36\"",
+    "\"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.153 Safari/537.36\"",
+    "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0",
+    "\"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53\"",
+    "\"Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/36.0.1985.125 Chrome/36.0.1985.125 Safari/537.36\"",
+]
+WORDS = ["Love", "Night", "Heart", "Fire", "Dream", "Blue", "Road", "Rain", "Gold", "Home", "Star", "Time",
+         "Dance", "Light", "River", "Summer", "Shadow", "Wild", "City", "Ghost", "Silver", "Song", "Sky", "Dark"]
+OTHER_PAGES = ["Home", "Login", "Logout", "Settings", "About", "Help", "Upgrade", "Downgrade", "Error",
+               "Save Settings", "Submit Upgrade", "Submit Downgrade"]
+
+ID_CHARS = np.array(list(string.ascii_uppercase + string.digits))
+
+# mean events per session and seconds between events of a session
+SESSION_LENGTH = 20
+EVENT_GAP_SECONDS = 220
+
+
+def random_ids(rng, prefix, n):
+    """
+    Description: This function generates Million Song Dataset style ids
+    (two letter prefix followed by 16 upper case characters).
+
+    Arguments:
+        rng: numpy random generator.
+        prefix: id prefix, e.g. "SO", "AR" or "TR".
+        n: number of ids.
+
+    Returns:
+        list of ids.
+    """
+    chars = ID_CHARS[rng.integers(0, len(ID_CHARS), size=(n, 16))]
+    return [prefix + "".join(row) for row in chars]
+
+
+def zipf_choice(rng, n, size, a=1.2):
+    """
+    Description: This function draws indexes in [0, n) with a Zipf-like
+    skew, so a few songs and users account for most of the traffic.
+
+    Arguments:
+        rng: numpy random generator.
+        n: population size.
+        size: number of draws.
+        a: Zipf exponent.
+
+    Returns:
+        numpy array of indexes.
+    """
+    ranks = rng.zipf(a, size=size * 2)
+    ranks = ranks[ranks <= n][:size]
+    while len(ranks) < size:
+        extra = rng.zipf(a, size=size)
+        ranks = np.concatenate([ranks, extra[extra <= n]])[:size]
+    return ranks - 1
+
+
+def make_songs(rng, num_songs):
+    """
+    Description: This function builds the song and artist metadata.
+
+    Arguments:
+        rng: numpy random generator.
+        num_songs: number of songs.
+
+    Returns:
+        dataframe with the song_data JSON columns plus track_id.
+    """
+    num_artists = max(1, num_songs // 8)
+    artist_ids = np.array(random_ids(rng, "AR", num_artists))
+    artist_names = np.array(["{} {}".format(w, n) for w, n in
+                             zip(rng.choice(WORDS, num_artists), rng.choice(LAST_NAMES, num_artists))])
+    artist_locations = rng.choice(LOCATIONS + [""], num_artists)
+    has_coords = rng.random(num_artists) < 0.4
+    latitudes = np.where(has_coords, rng.uniform(-60, 70, num_artists).round(5), np.nan)
+    longitudes = np.where(has_coords, rng.uniform(-150, 150, num_artists).round(5), np.nan)
+
+    artist = zipf_choice(rng, num_artists, num_songs, a=1.5)
+    titles = [" ".join(words) for words in rng.choice(WORDS, size=(num_songs, 3))]
+
+    return pd.DataFrame({
+        "track_id": random_ids(rng, "TR", num_songs),
+        "num_songs": 1,
+        "artist_id": artist_ids[artist],
+        "artist_latitude": latitudes[artist],
+        "artist_longitude": longitudes[artist],
+        "artist_location": artist_locations[artist],
+        "artist_name": artist_names[artist],
+        "song_id": random_ids(rng, "SO", num_songs),
+        "title": titles,
+        "duration": rng.uniform(60, 600, num_songs).round(5),
+        "year": np.where(rng.random(num_songs) < 0.5, 0, rng.integers(1950, 2011, num_songs)),
+    })
+
+
+def make_users(rng, num_users):
+    """
+    Description: This function builds the user attributes repeated on every
+    log event.
+
+    Arguments:
+        rng: numpy random generator.
+        num_users: number of users.
+
+    Returns:
+        dataframe indexed by user position.
+    """
+    return pd.DataFrame({
+        "userId": np.arange(1, num_users + 1).astype(str),
+        "firstName": rng.choice(FIRST_NAMES, num_users),
+        "lastName": rng.choice(LAST_NAMES, num_users),
+        "gender": rng.choice(["M", "F"], num_users),
+        "level": rng.choice(["free", "paid"], num_users, p=[0.7, 0.3]),
+        "location": rng.choice(LOCATIONS, num_users),
+        "userAgent": rng.choice(USER_AGENTS, num_users),
+        "registration": rng.uniform(1.535e12, 1.541e12, num_users).round(),
+    })
+
+
+def write_song_files(songs, out_dir):
+    """
+    Description: This function writes one JSON file per song under
+    song_data/<track_id[2]>/<track_id[3]>/<track_id[4]>/.
+
+    Arguments:
+        songs: dataframe from make_songs.
+        out_dir: output root directory.
+
+    Returns:
+        number of files written.
+    """
+    records = songs.drop(columns=["track_id"]).astype(object).where(songs.notna(), None).to_dict("records")
+    for track_id, record in zip(songs.track_id, records):
+        song_dir = os.path.join(out_dir, "song_data", track_id[2], track_id[3], track_id[4])
+        os.makedirs(song_dir, exist_ok=True)
+        with open(os.path.join(song_dir, track_id + ".json"), "w") as f:
+            json.dump(record, f)
+    return len(records)
+
+
+def make_day_events(rng, day, num_events, songs, users, miss_rate, first_session=0):
+    """
+    Description: This function simulates one day of sessions.
+
+    Arguments:
+        rng: numpy random generator.
+        day: datetime.date of the events.
+        num_events: approximate number of events for the day.
+        songs: dataframe from make_songs.
+        users: dataframe from make_users.
+        miss_rate: share of NextSong events for songs not in song_data.
+        first_session: sessionId of the day's first session.
+
+    Returns:
+        dataframe with the log_data JSON columns, ordered by ts.
+    """
+    num_sessions = max(1, num_events // SESSION_LENGTH)
+    lengths = rng.geometric(1 / SESSION_LENGTH, num_sessions)
+    lengths = np.maximum(1, (lengths * num_events / lengths.sum()).astype(int))
+    total = int(lengths.sum())
+
+    session = np.repeat(np.arange(num_sessions), lengths)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    item = np.arange(total) - np.repeat(starts, lengths)
+
+    day_start = int(datetime.datetime(day.year, day.month, day.day, tzinfo=datetime.timezone.utc).timestamp() * 1000)
+    session_start = day_start + rng.integers(0, 86400 * 1000, num_sessions)
+    gaps = rng.integers(EVENT_GAP_SECONDS // 2, EVENT_GAP_SECONDS * 2, total) * 1000
+    ts = np.repeat(session_start, lengths) + item * gaps
+
+    session_user = zipf_choice(rng, len(users), num_sessions, a=1.1)
+    user = users.iloc[np.repeat(session_user, lengths)].reset_index(drop=True)
+
+    is_song = rng.random(total) < 0.8
+    song = songs.iloc[zipf_choice(rng, len(songs), total)].reset_index(drop=True)
+    miss = rng.random(total) < miss_rate
+
+    events = pd.DataFrame({
+        "artist": np.where(is_song, song.artist_name.values, None),
+        "auth": "Logged In",
+        "firstName": user.firstName.values,
+        "gender": user.gender.values,
+        "itemInSession": item,
+        "lastName": user.lastName.values,
+        "length": np.where(is_song, song.duration.values, np.nan),
+        "level": user.level.values,
+        "location": user.location.values,
+        "method": np.where(is_song, "PUT", "GET"),
+        "page": np.where(is_song, "NextSong", rng.choice(OTHER_PAGES, total)),
+        "registration": user.registration.values,
+        "sessionId": first_session + session,
+        "song": np.where(is_song, np.where(miss, song.title.values + " (Live)", song.title.values), None),
+        "status": 200,
+        "ts": ts,
+        "userAgent": user.userAgent.values,
+        "userId": user.userId.values,
+    })
+    return events.sort_values("ts", kind="stable").reset_index(drop=True)
+
+
+def write_log_files(rng, songs, users, num_events, start_date, num_days, out_dir, miss_rate):
+    """
+    Description: This function writes one newline-delimited JSON file per
+    day under log_data/YYYY/MM/.
+
+    Arguments:
+        rng: numpy random generator.
+        songs: dataframe from make_songs.
+        users: dataframe from make_users.
+        num_events: total number of events across all days.
+        start_date: datetime.date of the first day.
+        num_days: number of day files.
+        out_dir: output root directory.
+        miss_rate: share of NextSong events for songs not in song_data.
+
+    Returns:
+        number of events written.
+    """
+    written = 0
+    sessions = 0
+    per_day = max(1, num_events // num_days)
+    for offset in range(num_days):
+        day = start_date + datetime.timedelta(days=offset)
+        log_dir = os.path.join(out_dir, "log_data", "{:04d}".format(day.year), "{:02d}".format(day.month))
+        os.makedirs(log_dir, exist_ok=True)
+
+        events = make_day_events(rng, day, per_day, songs, users, miss_rate, sessions)
+        sessions = int(events.sessionId.max()) + 1
+        events.to_json(os.path.join(log_dir, "{}-events.json".format(day.isoformat())), orient="records", lines=True)
+        written += len(events)
+        print('{}/{} log files written.'.format(offset + 1, num_days))
+
+    return written
+
+
+def main(out_dir, num_songs, num_events, num_users, num_days, start_date, miss_rate, seed):
+    """
+    - generates song_data and log_data trees in the same layout and JSON
+      schema as data/, at the requested scale
+    - returns None
+    """
+    rng = np.random.default_rng(seed)
+
+    songs = make_songs(rng, num_songs)
+    print('{} song files written.'.format(write_song_files(songs, out_dir)))
+
+    users = make_users(rng, num_users)
+    written = write_log_files(rng, songs, users, num_events, start_date, num_days, out_dir, miss_rate)
+    print('{} events written.'.format(written))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic Sparkify song and log data.")
+    parser.add_argument("--out", default="synthetic_data", help="output directory")
+    parser.add_argument("--songs", type=int, default=10000, help="number of songs")
+    parser.add_argument("--events", type=int, default=1000000, help="number of log events")
+    parser.add_argument("--users", type=int, default=1000, help="number of users")
+    parser.add_argument("--days", type=int, default=30, help="number of daily log files")
+    parser.add_argument("--start-date", type=datetime.date.fromisoformat, default=datetime.date(2018, 11, 1),
+                        help="date of the first log file (YYYY-MM-DD)")
+    parser.add_argument("--miss-rate", type=float, default=0.1,
+                        help="share of plays for songs that are not in song_data")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    main(args.out, args.songs, args.events, args.users, args.days, args.start_date, args.miss_rate, args.seed)
@@ -0,0 +1,71 @@
+import argparse
+
+from sql_queries import index_usage_select
+from db import connect
+
+
+def index_usage(cur):
+    """
+    Description: This function reads the usage statistics and on-disk size
+    of every index in sparkifydb. The indexes of a partitioned table count
+    as one, with the statistics of all its partitions.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        list of dicts, least scanned first.
+    """
+    cur.execute(index_usage_select)
+    columns = [column[0] for column in cur.description]
+    return [dict(zip(columns, row)) for row in cur.fetchall()]
+
+
+def unused_indexes(usage, min_scans=0):
+    """
+    Description: This function picks the indexes worth pruning: scanned at
+    most min_scans times and not backing a primary key or unique constraint.
+
+    Arguments:
+        usage: output of index_usage.
+        min_scans: scan count at or below which an index counts as unused.
+
+    Returns:
+        list of dicts.
+    """
+    return [index for index in usage if index["idx_scan"] <= min_scans and not index["is_unique"]]
+
+
+def main(dsn=None, min_scans=0):
+    """
+    - prints the scans, tuples read and size of every index
+    - lists the unused non-unique indexes as prune candidates; the counters
+      are cumulative since the last pg_stat_reset(), so run it after a
+      representative workload
+    """
+    conn = connect(dsn)
+    cur = conn.cursor()
+    usage = index_usage(cur)
+    conn.close()
+
+    print("{:<12} {:<28} {:>10} {:>12} {:>10}".format("table", "index", "scans", "tuples read", "size kB"))
+    for index in usage:
+        print("{:<12} {:<28} {:>10} {:>12} {:>10.0f}".format(index["table_name"], index["index_name"], index["idx_scan"],
+                                                            index["idx_tup_read"], index["index_bytes"] / 1024))
+
+    unused = unused_indexes(usage, min_scans)
+    if unused:
+        print("\nunused indexes ({:.0f} kB):".format(sum(index["index_bytes"] for index in unused) / 1024))
+        for index in unused:
+            print("    DROP INDEX {};".format(index["index_name"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report index usage and size in sparkifydb.")
+    parser.add_argument("--dsn", default=None,
+                        help="postgres connection string (defaults to SPARKIFY_DSN or the PG* variables)")
+    parser.add_argument("--min-scans", type=int, default=0,
+                        help="report indexes scanned at most this many times as unused")
+    args = parser.parse_args()
+
+    main(args.dsn, args.min_scans)
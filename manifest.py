@@ -0,0 +1,166 @@
+import os
+import hashlib
+
+from sql_queries import file_manifest_upsert, file_manifest_touch, file_manifest_select
+
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def file_stat(filepath):
+    """
+    Description: This function returns the cheap change indicators of a file.
+
+    Arguments:
+        filepath: data file path.
+
+    Returns:
+        (size in bytes, mtime in seconds)
+    """
+    st = os.stat(filepath)
+    return st.st_size, st.st_mtime
+
+
+def file_digest(filepath, size=None):
+    """
+    Description: This function hashes a data file and counts its lines in
+    the same pass.
+
+    Arguments:
+        filepath: data file path.
+        size: only hash the first size bytes.
+
+    Returns:
+        (sha256 hex digest, number of lines)
+    """
+    digest = hashlib.sha256()
+    lines = 0
+    last = b"\n"
+    remaining = float("inf") if size is None else size
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(int(min(HASH_BLOCK_SIZE, remaining))), b""):
+            remaining -= len(block)
+            digest.update(block)
+            lines += block.count(b"\n")
+            last = block[-1:]
+
+    # a final line without a trailing newline is still a row
+    if last != b"\n":
+        lines += 1
+
+    return digest.hexdigest(), lines
+
+
+def file_snapshot(filepath):
+    """
+    Description: This function takes the manifest entry of a file before it
+    is loaded. The hash covers the bytes up to the size taken here, so lines
+    appended while the file loads are neither recorded nor loaded, as long
+    as the load stops at that size too.
+
+    Arguments:
+        filepath: data file path.
+
+    Returns:
+        (size in bytes, mtime in seconds, sha256 hex digest, number of lines)
+    """
+    size, mtime = file_stat(filepath)
+    return (size, mtime) + file_digest(filepath, size)
+
+
+def load_manifest(cur):
+    """
+    Description: This function reads the whole file manifest.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        dict of path -> (size, mtime, content hash, rows loaded)
+    """
+    cur.execute(file_manifest_select)
+    return {path: (size, mtime, content_hash, rows_loaded)
+            for path, size, mtime, content_hash, rows_loaded in cur.fetchall()}
+
+
+def pending_files(cur, all_files, append_only=False):
+    """
+    Description: This function drops the files whose content is already
+    loaded. Files with an unchanged size and mtime are skipped without being
+    read; files whose stat changed are hashed, and only reprocessed when the
+    content really differs.
+
+    Arguments:
+        cur: the cursor object.
+        all_files: list of data file paths.
+        append_only: the files only ever grow (log files). A changed file
+            that still starts with the content recorded in the manifest
+            was appended to, and only its new lines need loading.
+
+    Returns:
+        (new files, changed files, dict of appended file -> (byte offset
+        loaded up to, rows loaded before it), number of unchanged files
+        skipped)
+    """
+    manifest = load_manifest(cur)
+    new_files, changed_files, appended, skipped = [], [], {}, 0
+
+    for datafile in all_files:
+        if datafile not in manifest:
+            new_files.append(datafile)
+            continue
+
+        size, mtime = file_stat(datafile)
+        old_size, old_mtime, old_hash, old_rows = manifest[datafile]
+        if size == old_size and mtime == old_mtime:
+            skipped += 1
+            continue
+
+        if append_only and size > old_size and file_digest(datafile, old_size)[0] == old_hash:
+            appended[datafile] = (old_size, old_rows or 0)
+        elif file_digest(datafile)[0] == old_hash:
+            cur.execute(file_manifest_touch, (size, mtime, datafile))
+            skipped += 1
+        else:
+            changed_files.append(datafile)
+
+    return new_files, changed_files, appended, skipped
+
+
+def record_file(cur, filepath, rows_loaded, snapshot=None):
+    """
+    Description: This function records a successfully loaded file in the
+    manifest.
+
+    Arguments:
+        cur: the cursor object.
+        filepath: data file path.
+        rows_loaded: rows the file contributed to the star schema.
+        snapshot: file_snapshot taken before the load; taken now if None,
+            which is only right when the file cannot have changed since.
+
+    Returns:
+        None
+    """
+    size, mtime, content_hash, rows_read = snapshot or file_snapshot(filepath)
+    cur.execute(file_manifest_upsert, (filepath, size, mtime, content_hash, rows_read, rows_loaded or 0))
+
+
+def record_files(cur, loaded):
+    """
+    Description: This function records a batch of loaded files in the
+    manifest with one executemany.
+
+    Arguments:
+        cur: the cursor object.
+        loaded: iterable of (data file path, rows loaded, file_snapshot
+            taken before the load).
+
+    Returns:
+        None
+    """
+    rows = []
+    for filepath, rows_loaded, snapshot in loaded:
+        size, mtime, content_hash, rows_read = snapshot
+        rows.append((filepath, size, mtime, content_hash, rows_read, rows_loaded or 0))
+    cur.executemany(file_manifest_upsert, rows)
@@ -0,0 +1,206 @@
+import json
+import time
+import contextlib
+from collections import defaultdict
+
+
+PROMETHEUS_PREFIX = "sparkify_etl"
+
+
+class Metrics:
+    """
+    Per-run ETL instrumentation: wall time and call count per stage plus
+    labelled counters (rows, statements, round trips, bytes, song matches).
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.stage_seconds = defaultdict(float)
+        self.stage_calls = defaultdict(int)
+        self.counters = defaultdict(float)
+        self.gauges = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Description: This function times a block of code as one call of a stage.
+
+        Arguments:
+            name: stage name, e.g. "parse", "transform", "lookup", "insert", "commit".
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] += time.perf_counter() - start
+            self.stage_calls[name] += 1
+
+    def count(self, name, value=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def snapshot(self):
+        """
+        Description: This function exports the metrics as picklable plain
+        data, so worker processes can ship them to the parent.
+
+        Returns:
+            tuple of (stage seconds, stage calls, counters, gauges)
+        """
+        return dict(self.stage_seconds), dict(self.stage_calls), dict(self.counters), dict(self.gauges)
+
+    def merge(self, snapshot):
+        stage_seconds, stage_calls, counters, gauges = snapshot
+        for name, value in stage_seconds.items():
+            self.stage_seconds[name] += value
+        for name, value in stage_calls.items():
+            self.stage_calls[name] += value
+        for key, value in counters.items():
+            self.counters[key] += value
+        for name, value in gauges.items():
+            self.gauges[name] = max(value, self.gauges.get(name, value))
+
+    def total(self, name, **labels):
+        """
+        Description: This function sums a counter over every label set
+        matching the given labels.
+        """
+        wanted = set(labels.items())
+        return sum(value for (key, key_labels), value in self.counters.items()
+                   if key == name and wanted <= set(key_labels))
+
+    def song_match_rate(self):
+        hits = self.total("song_lookups", result="hit")
+        lookups = self.total("song_lookups")
+        return hits / lookups if lookups else None
+
+    def report(self):
+        """
+        Description: This function builds the structured run report.
+
+        Returns:
+            JSON-serializable dict.
+        """
+        counters = defaultdict(list)
+        for (name, labels), value in sorted(self.counters.items()):
+            counters[name].append(dict(labels, value=value))
+
+        return {
+            "stages": {name: {"seconds": round(self.stage_seconds[name], 6), "calls": self.stage_calls[name]}
+                       for name in sorted(self.stage_seconds)},
+            "counters": dict(counters),
+            "gauges": dict(self.gauges),
+            "song_match_rate": self.song_match_rate(),
+        }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2)
+
+    def to_prometheus(self):
+        """
+        Description: This function renders the metrics in the Prometheus text
+        exposition format.
+
+        Returns:
+            string.
+        """
+        lines = []
+
+        def labels_text(labels):
+            if not labels:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + "}"
+
+        lines.append("# TYPE {}_stage_seconds_total counter".format(PROMETHEUS_PREFIX))
+        for name in sorted(self.stage_seconds):
+            lines.append('{}_stage_seconds_total{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, name, self.stage_seconds[name]))
+        lines.append("# TYPE {}_stage_calls_total counter".format(PROMETHEUS_PREFIX))
+        for name in sorted(self.stage_calls):
+            lines.append('{}_stage_calls_total{{stage="{}"}} {}'.format(PROMETHEUS_PREFIX, name, self.stage_calls[name]))
+
+        for name in sorted({key for key, _ in self.counters}):
+            lines.append("# TYPE {}_{}_total counter".format(PROMETHEUS_PREFIX, name))
+            for (key, labels), value in sorted(self.counters.items()):
+                if key == name:
+                    lines.append("{}_{}_total{} {}".format(PROMETHEUS_PREFIX, name, labels_text(labels), value))
+
+        gauges = dict(self.gauges)
+        rate = self.song_match_rate()
+        if rate is not None:
+            gauges["song_match_ratio"] = rate
+        for name in sorted(gauges):
+            lines.append("# TYPE {}_{} gauge".format(PROMETHEUS_PREFIX, name))
+            lines.append("{}_{} {}".format(PROMETHEUS_PREFIX, name, gauges[name]))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Description: This function renders a short human readable summary.
+        """
+        lines = ["{:<10} {:>10.3f}s {:>8} calls".format(name, self.stage_seconds[name], self.stage_calls[name])
+                 for name in sorted(self.stage_seconds)]
+        lines.append("{:.0f} statements in {:.0f} round trips, {:.0f} bytes read".format(
+            self.total("statements"), self.total("round_trips"), self.total("bytes_read")))
+        rate = self.song_match_rate()
+        if rate is not None:
+            lines.append("song match rate {:.2%}".format(rate))
+        return "\n".join(lines)
+
+    def timed(self, iterable, name):
+        """
+        Description: This function times every step of an iterator (e.g. a
+        chunked reader) as one call of a stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+
+class InstrumentedCursor:
+    """
+    Cursor wrapper counting statements and round trips on the metrics
+    registry; every other attribute is passed through.
+    """
+
+    def __init__(self, cur, metrics=None):
+        self._cur = cur
+        self._metrics = metrics or RUN
+
+    def execute(self, query, vars=None):
+        self._metrics.count("statements")
+        self._metrics.count("round_trips")
+        if vars is None:
+            return self._cur.execute(query)
+        return self._cur.execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        # psycopg2 sends every row of an executemany as its own statement
+        self._metrics.count("statements", len(vars_list))
+        self._metrics.count("round_trips", len(vars_list))
+        return self._cur.executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, *args, **kwargs):
+        self._metrics.count("statements")
+        self._metrics.count("round_trips")
+        return self._cur.copy_expert(sql, file, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+
+# registry for the current process
+RUN = Metrics()
+stage = RUN.stage
+count = RUN.count
+timed = RUN.timed
@@ -0,0 +1,130 @@
+import os
+import hashlib
+
+import pandas as pd
+
+
+# default size cap of the parse cache directory
+CACHE_MAX_BYTES = 1 << 30
+
+
+class ParseCache:
+    """
+    On-disk cache of parsed data files as Parquet, so re-running the ETL
+    (e.g. after a schema change) reads columnar files instead of parsing the
+    JSON again. An entry is keyed by the source path, size and mtime, so a
+    changed file is parsed again; least recently used entries are evicted
+    once the cache outgrows max_bytes.
+
+    Needs pyarrow (pip install pyarrow).
+    """
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("the parse cache needs pyarrow: pip install pyarrow")
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # running estimate of the cache size, so not every put scans the directory
+        self._size = None
+
+    def entry_path(self, filepath, kind):
+        """
+        Description: This function names the cache entry of a data file.
+
+        Arguments:
+            filepath: data file path.
+            kind: what the entry holds, e.g. "songs" or "events".
+
+        Returns:
+            path of the Parquet file.
+        """
+        st = os.stat(filepath)
+        key = "{}\0{}\0{}".format(os.path.abspath(filepath), st.st_size, st.st_mtime_ns)
+        return os.path.join(self.directory, "{}-{}.parquet".format(
+            kind, hashlib.sha1(key.encode()).hexdigest()))
+
+    def get(self, filepath, kind):
+        """
+        Description: This function reads the cached frame of a data file.
+
+        Arguments:
+            filepath: data file path.
+            kind: what the entry holds.
+
+        Returns:
+            dataframe, or None when the file has no valid entry.
+        """
+        path = self.entry_path(filepath, kind)
+        try:
+            df = pd.read_parquet(path, engine="pyarrow", memory_map=True)
+        except FileNotFoundError:
+            return None
+        # the access time drives eviction, and may not be kept by the mount
+        os.utime(path)
+        return df
+
+    def put(self, filepath, kind, df):
+        """
+        Description: This function stores the parsed frame of a data file and
+        evicts old entries beyond the size cap. Frames Parquet cannot
+        represent (e.g. a column mixing strings and numbers) are not cached.
+
+        Arguments:
+            filepath: data file path.
+            kind: what the entry holds.
+            df: parsed dataframe.
+
+        Returns:
+            bool, whether the frame was cached.
+        """
+        path = self.entry_path(filepath, kind)
+        # written aside and renamed, so concurrent workers never read half a file
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            df.to_parquet(tmp_path, engine="pyarrow", index=False)
+        except (TypeError, ValueError):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+
+        if self._size is None:
+            self._size = self.evict()
+        else:
+            self._size += size
+            if self._size > self.max_bytes:
+                self._size = self.evict()
+        return True
+
+    def evict(self):
+        """
+        Description: This function removes the least recently used entries
+        until the cache fits in max_bytes.
+
+        Returns:
+            size of the cache in bytes afterwards.
+        """
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith(".parquet"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # another worker evicted it first
+                pass
+            total -= size
+
+        return total
@@ -0,0 +1,234 @@
+import os
+import gzip
+import argparse
+import datetime
+import contextlib
+
+from sql_queries import (songplay_partition_interval_select, songplay_partition_create, songplay_partitions_select,
+                         songplay_partition_detach, archive_schema_create, partition_archive, partition_export,
+                         partition_drop, songplay_default_rows_hold, songplay_default_rows_take,
+                         songplay_default_rows_restore)
+from checkpoints import transaction
+from db import connect
+
+
+PARTITION_INTERVALS = ("month", "year")
+
+
+def partition_name(year, month, interval="month"):
+    """
+    Description: This function names the songplays partition holding a month.
+
+    Arguments:
+        year: calendar year.
+        month: calendar month.
+        interval: partition interval, one of PARTITION_INTERVALS.
+
+    Returns:
+        table name, e.g. songplays_2018_11 (monthly) or songplays_2018 (yearly).
+    """
+    if interval == "year":
+        return "songplays_{:04d}".format(year)
+    return "songplays_{:04d}_{:02d}".format(year, month)
+
+
+def partition_bounds(year, month, interval="month"):
+    """
+    Description: This function computes the start_time range of the
+    partition holding a month.
+
+    Arguments:
+        year: calendar year.
+        month: calendar month.
+        interval: partition interval, one of PARTITION_INTERVALS.
+
+    Returns:
+        (inclusive start, exclusive end) in epoch milliseconds, UTC.
+    """
+    if interval == "year":
+        start, end = datetime.datetime(year, 1, 1), datetime.datetime(year + 1, 1, 1)
+    else:
+        start = datetime.datetime(year, month, 1)
+        end = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+
+    epoch = datetime.datetime(1970, 1, 1)
+    return (int((start - epoch).total_seconds() * 1000),
+            int((end - epoch).total_seconds() * 1000))
+
+
+def log_months(filepath):
+    """
+    Description: This function lists the months a log_data tree holds,
+    from its YYYY/MM directory layout.
+
+    Arguments:
+        filepath: log data directory.
+
+    Returns:
+        sorted list of (year, month).
+    """
+    months = set()
+    for root, dirs, files in os.walk(filepath):
+        parts = os.path.relpath(root, filepath).split(os.sep)
+        if len(parts) == 2 and all(part.isdigit() for part in parts) and files:
+            year, month = int(parts[0]), int(parts[1])
+            if 1 <= month <= 12:
+                months.add((year, month))
+
+    return sorted(months)
+
+
+def partition_interval(cur):
+    """
+    Description: This function tells whether songplays is partitioned.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        the partition interval, or None when songplays is a plain table.
+    """
+    cur.execute(songplay_partition_interval_select)
+    row = cur.fetchone()
+    if row is None:
+        return None
+    return row[0] or "month"
+
+
+def ensure_partitions(cur, conn, months, interval="month"):
+    """
+    Description: This function creates the songplays partitions of the given
+    months that do not exist yet. Run it before loading, so no two loaders
+    race to create the same partition. Rows of a new partition's range that
+    the default partition already holds are moved into it, in the same
+    transaction that creates it.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        months: iterable of (year, month).
+        interval: partition interval of songplays.
+
+    Returns:
+        list of partition names covering the months.
+    """
+    existing = {partition[0] for partition in list_partitions(cur)}
+    names = []
+    for year, month in sorted(set(months)):
+        name = partition_name(year, month, interval)
+        if name in names:
+            continue
+        names.append(name)
+        if name in existing:
+            continue
+
+        start, end = partition_bounds(year, month, interval)
+        with transaction(cur) if conn.autocommit else contextlib.nullcontext():
+            cur.execute(songplay_default_rows_hold)
+            cur.execute(songplay_default_rows_take, (start, end))
+            cur.execute(songplay_partition_create.format(partition=name, start=start, end=end))
+            cur.execute(songplay_default_rows_restore)
+        conn.commit()
+
+    return names
+
+
+def list_partitions(cur):
+    """
+    Description: This function lists the songplays partitions.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        list of (name, bound expression, unlogged, total bytes).
+    """
+    cur.execute(songplay_partitions_select)
+    return cur.fetchall()
+
+
+def detach_partition(cur, conn, name, archive_dir=None):
+    """
+    Description: This function takes a partition out of songplays without
+    rewriting any data. The detached table is moved to the archive schema,
+    or, with archive_dir, exported to a gzipped CSV file and dropped.
+
+    Arguments:
+        cur: the cursor object.
+        conn: connection to the database.
+        name: partition name, e.g. songplays_2018_11.
+        archive_dir: directory to export the partition to before dropping it.
+
+    Returns:
+        path of the export, or the archived table name.
+    """
+    cur.execute(songplay_partition_detach.format(partition=name))
+
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(archive_dir, "{}.csv.gz".format(name))
+        with gzip.open(path, "wt") as f:
+            cur.copy_expert(partition_export.format(partition=name), f)
+        cur.execute(partition_drop.format(partition=name))
+        conn.commit()
+        return path
+
+    cur.execute(archive_schema_create)
+    cur.execute(partition_archive.format(partition=name))
+    conn.commit()
+    return "archive." + name
+
+
+def parse_month(text):
+    year, month = text.split("-")
+    return int(year), int(month)
+
+
+def main(command, months=(), before=None, archive_dir=None, dsn=None):
+    """
+    - list: prints every songplays partition with its range and size
+    - create: creates the partitions of the given YYYY-MM months
+    - detach: detaches the partitions of the given months, or of every month
+      before the `before` month, and archives them
+    """
+    conn = connect(dsn)
+    cur = conn.cursor()
+
+    interval = partition_interval(cur)
+    if interval is None:
+        raise ValueError("songplays is not partitioned, recreate it with create_tables.py --partitioned")
+
+    if command == "list":
+        for name, bound, unlogged, size in list_partitions(cur):
+            print("{:<22} {:>10.0f} kB{}  {}".format(name, size / 1024, " unlogged" if unlogged else "", bound))
+
+    elif command == "create":
+        for name in ensure_partitions(cur, conn, [parse_month(month) for month in months], interval):
+            print("{} ready".format(name))
+
+    elif command == "detach":
+        names = {partition_name(*parse_month(month), interval) for month in months}
+        if before:
+            cutoff = partition_name(*parse_month(before), interval)
+            names.update(name for name, _, _, _ in list_partitions(cur)
+                         if name != "songplays_default" and name < cutoff)
+
+        for name in sorted(names):
+            print("{} -> {}".format(name, detach_partition(cur, conn, name, archive_dir)))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the partitions of a partitioned songplays table.")
+    parser.add_argument("command", choices=("list", "create", "detach"))
+    parser.add_argument("months", nargs="*", help="months as YYYY-MM")
+    parser.add_argument("--before", default=None, help="with detach, every partition before this YYYY-MM month")
+    parser.add_argument("--archive-dir", default=None,
+                        help="with detach, export the partitions to gzipped CSV files here and drop them "
+                             "instead of moving them to the archive schema")
+    parser.add_argument("--dsn", default=None,
+                        help="postgres connection string (defaults to SPARKIFY_DSN or the PG* variables)")
+    args = parser.parse_args()
+
+    main(args.command, args.months, args.before, args.archive_dir, args.dsn)
@@ -0,0 +1,444 @@
+import re
+import json
+import time
+import argparse
+import statistics
+
+import psycopg2
+
+import sql_queries
+from sql_queries import (explain_analyze, plan_tables_analyze, plan_table_rows_select, plan_sample_queries,
+                         plan_setup_queries, plan_generic_set, plan_statements_deallocate, statement_timeout_set,
+                         server_version_select)
+from queries import QUERIES, query_params
+from create_tables import drop_tables, create_tables
+from rollups import refresh_rollups
+from db import connect, numbered_params
+import etl
+
+
+# statements run with their sample parameters; format templates ("{name}")
+# and DDL are left out
+STATEMENT_KEYWORDS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+# statements left out, with the reason
+EXCLUDED = {
+    "song_table_insert_values": "song_table_insert for many rows; its VALUES %s only expands in execute_values",
+    "artist_table_insert_values": "artist_table_insert for many rows; its VALUES %s only expands in execute_values",
+}
+
+JOIN_NODES = ("Nested Loop", "Hash Join", "Merge Join")
+
+# a median execution time this much above the slowest baseline run is a
+# regression...
+LATENCY_THRESHOLD = 0.5
+
+# ...unless it grew by less than this many milliseconds; statements of a
+# few ms vary by more than that from run to run
+LATENCY_MIN_MS = 20.0
+
+# runs per statement; the median execution time is kept, with the range
+REPEAT = 5
+
+# table row counts this far apart make the timings incomparable
+SCALE_TOLERANCE = 0.1
+
+BASELINE_PATH = "plan_baselines.json"
+
+# name of the statement prepared by a generic plan check
+PREPARED_NAME = "plan_check"
+
+
+def statements():
+    """
+    Description: This function collects the statements to check: every DML
+    statement and query in sql_queries.py but the EXCLUDED ones, then the
+    analytical queries of queries.py, which run with their default parameters.
+
+    Arguments:
+        None
+
+    Returns:
+        dict of name -> (sql, params), where params is None, a tuple, or
+        the name of a plan_sample_queries entry.
+    """
+    analytical = {sql for sql, _, _ in QUERIES.values()}
+    found = {}
+    for name, value in sorted(vars(sql_queries).items()):
+        if not isinstance(value, str) or name.startswith("plan_") or name in EXCLUDED or value in analytical:
+            continue
+        words = value.split(None, 1)
+        if not words or words[0].upper() not in STATEMENT_KEYWORDS or "{" in value:
+            continue
+        has_params = re.search(r"%(\(\w+\))?s", value) is not None
+        found[name] = (value, name if has_params else None)
+
+    for name in sorted(QUERIES):
+        found["query:" + name] = (QUERIES[name][0], query_params(name, {}))
+    return found
+
+
+def sample_params(cur, name, sql):
+    """
+    Description: This function reads one row of realistic parameters for a
+    statement from the loaded data.
+
+    Arguments:
+        cur: the cursor object.
+        name: plan_sample_queries entry.
+        sql: the statement; named placeholders take the sample's column names.
+
+    Returns:
+        tuple or dict of parameters, or None if the data holds no sample.
+    """
+    cur.execute(plan_sample_queries[name])
+    row = cur.fetchone()
+    if row is None or all(value is None for value in row):
+        return None
+    if "%(" in sql:
+        return dict(zip((column[0] for column in cur.description), row))
+    return row
+
+
+def prepared_statement(sql, values):
+    """
+    Description: This function turns a statement and its parameters into a
+    PREPARE statement and the EXPLAIN-able EXECUTE of it.
+
+    Arguments:
+        sql: the statement, with %s or %(name)s placeholders.
+        values: tuple, or dict for named placeholders.
+
+    Returns:
+        (PREPARE statement, EXECUTE statement using %s placeholders, tuple
+        of values in placeholder order)
+    """
+    if isinstance(values, dict):
+        names = []
+
+        def number(match):
+            if match.group(1) not in names:
+                names.append(match.group(1))
+            return "${}".format(names.index(match.group(1)) + 1)
+
+        body = re.sub(r"%\((\w+)\)s", number, sql.strip().rstrip(";"))
+        values = tuple(values[name] for name in names)
+    else:
+        body, _ = numbered_params(sql.strip().rstrip(";"))
+        values = tuple(values)
+    return ("PREPARE {} AS {}".format(PREPARED_NAME, body.replace("%%", "%")),
+            "EXECUTE {} ({})".format(PREPARED_NAME, ", ".join(["%s"] * len(values))), values)
+
+
+def summarize_plan(plan):
+    """
+    Description: This function reduces an EXPLAIN (ANALYZE, BUFFERS, FORMAT
+    JSON) result to what the regression checks compare.
+
+    Arguments:
+        plan: the first element of the EXPLAIN output.
+
+    Returns:
+        dict of plan shape, scans per relation, join nodes, timings and
+        buffer counts.
+    """
+    shape = []
+    scans = {}
+    joins = []
+
+    def walk(node, depth):
+        label = node["Node Type"]
+        if "Relation Name" in node:
+            label += " on " + node["Relation Name"]
+            if "Scan" in node["Node Type"]:
+                scans.setdefault(node["Relation Name"], []).append(node["Node Type"])
+        if node["Node Type"] in JOIN_NODES:
+            joins.append("{} {}".format(node.get("Join Type", ""), node["Node Type"]).strip())
+        shape.append("  " * depth + label)
+        for child in node.get("Plans", ()):
+            walk(child, depth + 1)
+
+    root = plan["Plan"]
+    walk(root, 0)
+    return {
+        "shape": shape,
+        "scans": {relation: sorted(types) for relation, types in sorted(scans.items())},
+        "joins": sorted(joins),
+        "planning_ms": plan.get("Planning Time"),
+        "execution_ms": plan.get("Execution Time"),
+        "shared_hit_blocks": root.get("Shared Hit Blocks", 0),
+        "shared_read_blocks": root.get("Shared Read Blocks", 0),
+    }
+
+
+def explain(conn, sql, params, repeat=REPEAT, timeout_ms=None, setup=(), generic=False):
+    """
+    Description: This function runs a statement under EXPLAIN ANALYZE
+    `repeat` times, each in a transaction that is rolled back, so writes
+    leave no trace.
+
+    Arguments:
+        conn: connection to the database, not in autocommit mode.
+        sql: the statement.
+        params: None, a tuple, or the name of a plan_sample_queries entry.
+        repeat: number of runs.
+        timeout_ms: statement_timeout of each run.
+        setup: statements run first in each transaction, e.g. creating the
+            temp tables the statement reads.
+        generic: run a parameterized statement as a prepared statement with
+            plan_cache_mode = force_generic_plan, so the plan is the generic
+            one a prepared statement settles on rather than one planned for
+            the sample values.
+
+    Returns:
+        summary of the run with the median execution time, or a dict with
+        a "skipped" reason.
+    """
+    runs = []
+    cur = conn.cursor()
+    try:
+        for _ in range(repeat):
+            if timeout_ms:
+                cur.execute(statement_timeout_set, (int(timeout_ms),))
+            for query in setup:
+                cur.execute(query)
+            values = params
+            if isinstance(params, str):
+                if params not in plan_sample_queries:
+                    return {"skipped": "no sample parameters in sql_queries.plan_sample_queries"}
+                values = sample_params(cur, params, sql)
+                if values is None:
+                    return {"skipped": "no sample row in the loaded data"}
+            if generic and values is not None:
+                prepare, execute, values = prepared_statement(sql, values)
+                cur.execute(plan_generic_set)
+                cur.execute(prepare)
+                cur.execute(explain_analyze.format(query=execute), values)
+            else:
+                cur.execute(explain_analyze.format(query=sql), values)
+            runs.append(summarize_plan(cur.fetchone()[0][0]))
+            conn.rollback()
+            if generic:
+                cur.execute(plan_statements_deallocate)
+                conn.rollback()
+    except psycopg2.Error as e:
+        return {"skipped": str(e).strip().splitlines()[0]}
+    finally:
+        conn.rollback()
+        if generic:
+            cur.execute(plan_statements_deallocate)
+            conn.rollback()
+        cur.close()
+
+    summary = runs[-1]
+    summary["execution_ms"] = round(statistics.median(run["execution_ms"] for run in runs), 3)
+    summary["execution_min_ms"] = round(min(run["execution_ms"] for run in runs), 3)
+    summary["execution_max_ms"] = round(max(run["execution_ms"] for run in runs), 3)
+    summary["planning_ms"] = round(statistics.median(run["planning_ms"] for run in runs), 3)
+    return summary
+
+
+def table_rows(cur):
+    cur.execute(plan_table_rows_select)
+    return dict(cur.fetchall())
+
+
+def compare(name, base, new, threshold=LATENCY_THRESHOLD, min_ms=LATENCY_MIN_MS):
+    """
+    Description: This function compares a statement's plan with its
+    baseline.
+
+    Arguments:
+        name: statement name for the messages.
+        base: baseline summary.
+        new: current summary.
+        threshold: relative latency increase over the slowest baseline run
+            counted as a regression.
+        min_ms: absolute latency increase below which none is counted.
+
+    Returns:
+        (regressions, changes): lists of messages; changes are plan
+        differences that are not regressions by themselves.
+    """
+    regressions = []
+    changes = []
+    if "skipped" in base or "skipped" in new:
+        if "skipped" in base and "skipped" not in new:
+            changes.append("{}: no longer skipped".format(name))
+        elif "skipped" in new and "skipped" not in base:
+            regressions.append("{}: skipped ({})".format(name, new["skipped"]))
+        return regressions, changes
+
+    for relation in sorted(set(base["scans"]) | set(new["scans"])):
+        before = base["scans"].get(relation, [])
+        after = new["scans"].get(relation, [])
+        if before == after:
+            continue
+        if after.count("Seq Scan") > before.count("Seq Scan"):
+            regressions.append("{}: new Seq Scan on {} (was {})".format(name, relation,
+                                                                         ", ".join(before) or "not scanned"))
+        else:
+            changes.append("{}: {} scanned by {} (was {})".format(name, relation, ", ".join(after) or "nothing",
+                                                                  ", ".join(before) or "not scanned"))
+
+    if base["joins"] != new["joins"]:
+        regressions.append("{}: joins {} (was {})".format(name, ", ".join(new["joins"]) or "none",
+                                                          ", ".join(base["joins"]) or "none"))
+
+    # the baseline's own spread is noise, not a regression
+    slowest = base.get("execution_max_ms", base["execution_ms"])
+    increase = new["execution_ms"] - slowest
+    if increase > min_ms and new["execution_ms"] > slowest * (1 + threshold):
+        regressions.append("{}: {:.2f} ms (was {:.2f} ms, at most {:.2f} ms)".format(
+            name, new["execution_ms"], base["execution_ms"], slowest))
+
+    if not regressions and not changes and base["shape"] != new["shape"]:
+        changes.append("{}: plan shape changed".format(name))
+    return regressions, changes
+
+
+def scale_warnings(base_rows, rows, tolerance=SCALE_TOLERANCE):
+    warnings = []
+    for table in sorted(set(base_rows) | set(rows)):
+        before, after = base_rows.get(table, 0), rows.get(table, 0)
+        if abs(after - before) > tolerance * max(before, 1):
+            warnings.append("{}: {} rows (baseline {})".format(table, after, before))
+    return warnings
+
+
+def load(dsn, data_dir):
+    """
+    Description: This function rebuilds the schema and loads a data tree
+    with the staged loader, so the checks run against a known scale. The
+    load is incremental, so the file manifest holds sample rows too. Only
+    point it at a throwaway database.
+
+    Arguments:
+        dsn: libpq connection string.
+        data_dir: directory holding song_data and log_data, e.g. the output
+            of generate_data.py.
+
+    Returns:
+        None
+    """
+    conn = connect(dsn, autocommit=True)
+    cur = conn.cursor()
+    drop_tables(cur, conn)
+    create_tables(cur, conn)
+    etl.process_data_staged(cur, conn, "{}/song_data".format(data_dir), "{}/log_data".format(data_dir),
+                            incremental=True)
+    refresh_rollups(cur)
+    conn.close()
+
+
+def main(dsn=None, data_dir=None, baseline_path=BASELINE_PATH, update=False, threshold=LATENCY_THRESHOLD,
+         min_ms=LATENCY_MIN_MS, repeat=REPEAT, only=None, analyze=True, timeout_ms=None, generic=False):
+    """
+    - optionally rebuilds and loads the database from data_dir
+    - runs every statement under EXPLAIN (ANALYZE, BUFFERS) and prints its
+      median execution time, buffers and scans
+    - generic plans parameterized statements as prepared statements with
+      plan_cache_mode = force_generic_plan instead of with their sample values
+    - writes the plans as the baseline if there is none yet (or on update),
+      otherwise flags new seq scans, changed joins and slower statements
+    - returns the number of regressions
+    """
+    if data_dir:
+        load(dsn, data_dir)
+
+    conn = connect(dsn)
+    cur = conn.cursor()
+    if analyze:
+        cur.execute(plan_tables_analyze)
+        conn.commit()
+    rows = table_rows(cur)
+
+    checked = statements()
+    if only:
+        checked = {name: checked[name] for name in checked if any(pattern in name for pattern in only)}
+
+    results = {}
+    print("{:<36} {:>10} {:>8} {:>8}  {}".format("statement", "exec ms", "hit", "read", "scans"))
+    for name, (sql, params) in checked.items():
+        summary = explain(conn, sql, params, repeat, timeout_ms, plan_setup_queries.get(name, ()), generic)
+        results[name] = summary
+        if "skipped" in summary:
+            print("{:<36} skipped: {}".format(name, summary["skipped"]))
+            continue
+        scans = "; ".join("{} {}".format(relation, "/".join(types)) for relation, types in summary["scans"].items())
+        print("{:<36} {:>10.3f} {:>8} {:>8}  {}".format(name, summary["execution_ms"], summary["shared_hit_blocks"],
+                                                       summary["shared_read_blocks"], scans))
+    cur.execute(server_version_select)
+    server_version = cur.fetchone()[0]
+    conn.close()
+
+    try:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        baseline = None
+
+    regressions = []
+    if baseline is not None and not update:
+        for warning in scale_warnings(baseline["table_rows"], rows):
+            print("warning: scale differs from the baseline, timings are not comparable: " + warning)
+        if baseline["server_version"] != server_version:
+            print("warning: baseline taken on Postgres {}, now {}".format(baseline["server_version"], server_version))
+        if baseline.get("generic", False) != generic:
+            print("warning: baseline taken with {} plans, now {}".format(
+                "generic" if baseline.get("generic") else "custom", "generic" if generic else "custom"))
+
+        changes = []
+        for name, summary in results.items():
+            if name not in baseline["statements"]:
+                changes.append("{}: not in the baseline".format(name))
+                continue
+            found, changed = compare(name, baseline["statements"][name], summary, threshold, min_ms)
+            regressions += found
+            changes += changed
+
+        for change in changes:
+            print("changed:    " + change)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        print("{} statements checked, {} regressions".format(len(results), len(regressions)))
+    else:
+        if baseline is not None and only:
+            # a partial run refreshes only the statements it checked
+            results = dict(baseline["statements"], **results)
+        baseline = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "server_version": server_version,
+            "generic": generic,
+            "table_rows": rows,
+            "statements": results,
+        }
+        with open(baseline_path, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("baseline of {} statements written to {}".format(len(results), baseline_path))
+    return len(regressions)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the query plans of sql_queries.py against a baseline.")
+    parser.add_argument("--dsn", help="libpq connection string of a throwaway postgres database")
+    parser.add_argument("--load", metavar="DATA_DIR",
+                        help="drop and recreate the tables and load DATA_DIR (song_data and log_data) first")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file (default %(default)s)")
+    parser.add_argument("--update", action="store_true", help="overwrite the baseline with the current plans")
+    parser.add_argument("--threshold", type=float, default=LATENCY_THRESHOLD,
+                        help="relative latency increase counted as a regression (default %(default)s)")
+    parser.add_argument("--min-ms", type=float, default=LATENCY_MIN_MS,
+                        help="ignore latency increases below this many milliseconds (default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=REPEAT,
+                        help="runs per statement, the median is kept (default %(default)s)")
+    parser.add_argument("--only", nargs="+", metavar="NAME", help="only check statements whose name contains NAME")
+    parser.add_argument("--no-analyze", dest="analyze", action="store_false",
+                        help="do not ANALYZE the tables before planning")
+    parser.add_argument("--timeout-ms", type=int, help="statement_timeout of every run")
+    parser.add_argument("--generic", action="store_true",
+                        help="plan parameterized statements as generic plans, with PREPARE and EXPLAIN EXECUTE "
+                             "under plan_cache_mode = force_generic_plan")
+    args = parser.parse_args()
+    raise SystemExit(1 if main(args.dsn, args.load, args.baseline, args.update, args.threshold, args.min_ms,
+                               args.repeat, args.only, args.analyze, args.timeout_ms, args.generic) else 0)
@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import argparse
+from collections import OrderedDict
+
+import pandas as pd
+
+from sql_queries import (top_songs_query, top_artists_query, plays_per_hour_query, plays_per_weekday_query,
+                         active_users_by_level_query, top_users_query, data_version_bump, data_versions_select)
+from backends import BACKENDS, get_backend
+import metrics
+
+
+# name -> (query, parameters in placeholder order, tables read)
+QUERIES = {
+    "top_songs": (top_songs_query, ("start", "end", "limit"), ("songplays", "songs")),
+    "top_artists": (top_artists_query, ("start", "end", "limit"), ("songplays", "artists")),
+    "plays_per_hour": (plays_per_hour_query, ("start", "end"), ("songplays", "time")),
+    "plays_per_weekday": (plays_per_weekday_query, ("start", "end"), ("songplays", "time")),
+    "active_users_by_level": (active_users_by_level_query, ("start", "end"), ("songplays",)),
+    "top_users": (top_users_query, ("start", "end", "limit"), ("songplays", "users")),
+}
+
+DEFAULT_PARAMS = {"start": "1970-01-01", "end": "2100-01-01", "limit": 10}
+
+# seconds a cached result is served before it is recomputed anyway
+CACHE_TTL = 300
+
+CACHE_MAX_ENTRIES = 256
+
+
+def epoch_ms(value):
+    """
+    Description: This function converts a date or timestamp into the epoch
+    milliseconds of songplays.start_time.
+
+    Arguments:
+        value: date string, datetime or epoch milliseconds.
+
+    Returns:
+        int
+    """
+    if isinstance(value, int):
+        return value
+    return int(pd.Timestamp(value).value // 10 ** 6)
+
+
+def query_params(name, params):
+    """
+    Description: This function completes and orders the parameters of a
+    named query.
+
+    Arguments:
+        name: one of QUERIES.
+        params: dict of parameter -> value; missing ones take DEFAULT_PARAMS.
+
+    Returns:
+        tuple of values in placeholder order.
+    """
+    if name not in QUERIES:
+        raise ValueError("unknown query {!r}, expected one of {}".format(name, sorted(QUERIES)))
+    _, names, _ = QUERIES[name]
+    unknown = set(params) - set(names)
+    if unknown:
+        raise ValueError("{} takes {}, not {}".format(name, names, sorted(unknown)))
+
+    values = dict(DEFAULT_PARAMS, **{key: value for key, value in params.items() if value is not None})
+    return tuple(epoch_ms(values[key]) if key in ("start", "end") else int(values[key]) for key in names)
+
+
+def data_versions(cur):
+    """
+    Description: This function reads the change counter of every star
+    schema table.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        dict of table -> version.
+    """
+    cur.execute(data_versions_select)
+    return dict(cur.fetchall())
+
+
+def database_identity(cur):
+    """
+    Description: This function names the database a cursor reads, so results
+    of different databases never share a cache entry.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        string such as "postgres:127.0.0.1:5432/sparkifydb" or
+        "sqlite:/abs/path/sparkify.db".
+    """
+    # EmbeddedCursor of the sqlite and duckdb backends
+    backend = getattr(cur, "backend", None)
+    if backend is not None:
+        return "{}:{}".format(backend.name, os.path.abspath(backend.path))
+
+    params = cur.connection.get_dsn_parameters()
+    return "postgres:{}:{}/{}".format(params.get("host", ""), params.get("port", ""), params.get("dbname", ""))
+
+
+class QueryCache:
+    """
+    Result cache of the named queries. An entry is served until its TTL runs
+    out or one of the tables it read changes: loads bump the table's counter
+    in data_versions (see mark_changed), and every lookup compares the
+    counters the entry was computed at with the current ones, which is one
+    tiny query instead of an aggregation. Least recently used entries are
+    evicted beyond max_entries.
+    """
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, versions):
+        """
+        Description: This function looks up a fresh cached result.
+
+        Arguments:
+            key: (database identity, query name, parameter values).
+            versions: current dict of table -> version.
+
+        Returns:
+            list of rows, or None.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires, tables, seen, rows = entry
+        if time.time() >= expires or any(versions.get(table) != seen[table] for table in tables):
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return rows
+
+    def put(self, key, tables, versions, rows):
+        seen = {table: versions.get(table) for table in tables}
+        self._entries[key] = (time.time() + self.ttl, tables, seen, rows)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, tables=None):
+        """
+        Description: This function drops the entries that read any of the
+        given tables.
+
+        Arguments:
+            tables: iterable of table names, or None for every entry.
+
+        Returns:
+            number of entries dropped.
+        """
+        if tables is None:
+            dropped = len(self._entries)
+            self._entries.clear()
+            return dropped
+
+        tables = set(tables)
+        stale = [key for key, (_, read, _, _) in self._entries.items() if tables & set(read)]
+        for key in stale:
+            del self._entries[key]
+        return len(stale)
+
+    def load(self, path):
+        """
+        Description: This function reads the entries a cache file written by
+        an earlier process, e.g. the CLI, holds. The file is plain JSON, so
+        loading it never runs code; an unreadable file starts an empty cache.
+
+        Arguments:
+            path: cache file path.
+
+        Returns:
+            None
+        """
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except ValueError:
+            return
+
+        self._entries = OrderedDict(
+            ((database, name, tuple(values)), (expires, tuple(tables), seen, [tuple(row) for row in rows]))
+            for (database, name, values), expires, tables, seen, rows in entries)
+
+    def save(self, path):
+        # tuples are written as JSON arrays, load turns them back
+        entries = [[key, expires, tables, seen, rows] for key, (expires, tables, seen, rows) in self._entries.items()]
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(entries, f)
+        os.replace(tmp_path, path)
+
+
+# cache of the current process
+CACHE = QueryCache()
+
+
+def run_query(cur, name, cache=CACHE, **params):
+    """
+    Description: This function answers a named query, from the cache when
+    it holds a fresh result.
+
+    Arguments:
+        cur: the cursor object.
+        name: one of QUERIES.
+        cache: QueryCache, or None to always query the database.
+        params: start / end (dates or epoch milliseconds) and limit.
+
+    Returns:
+        list of rows.
+    """
+    values = query_params(name, params)
+    query, _, tables = QUERIES[name]
+    if cache is None:
+        cur.execute(query, values)
+        return cur.fetchall()
+
+    key = (database_identity(cur), name, values)
+    versions = data_versions(cur)
+    rows = cache.get(key, versions)
+    if rows is not None:
+        metrics.count("query_cache", result="hit")
+        return rows
+
+    metrics.count("query_cache", result="miss")
+    cur.execute(query, values)
+    rows = cur.fetchall()
+    cache.put(key, tables, versions, rows)
+    return rows
+
+
+def mark_changed(cur, tables):
+    """
+    Description: This function records that a load changed some tables, so
+    cached results reading them are recomputed. Run it in the transaction
+    that commits the new rows.
+
+    Arguments:
+        cur: the cursor object.
+        tables: iterable of table names.
+
+    Returns:
+        None
+    """
+    tables = sorted(set(tables))
+    for table in tables:
+        cur.execute(data_version_bump, (table,))
+    CACHE.invalidate(tables)
+
+
+def main(name, params, backend_name="postgres", db_path=None, dsn=None, cache_file=None, ttl=CACHE_TTL):
+    """
+    - prints the rows of a named query, with --list the available queries
+    - results are cached in cache_file (JSON) across runs, per database, for
+      ttl seconds or until a load changes a table the query reads
+    """
+    backend = get_backend(backend_name, dsn=dsn, path=db_path)
+    conn = backend.connect(autocommit=True)
+    cur = backend.cursor(conn)
+
+    cache = QueryCache(ttl)
+    if cache_file:
+        cache.load(cache_file)
+
+    for row in run_query(cur, name, cache, **params):
+        print("\t".join(str(value) for value in row))
+
+    if cache_file:
+        cache.save(cache_file)
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer the dashboard questions about sparkifydb, with a result cache.")
+    parser.add_argument("query", nargs="?", choices=sorted(QUERIES))
+    parser.add_argument("--list", action="store_true", help="list the named queries and their parameters")
+    parser.add_argument("--start", default=None, help="inclusive start, e.g. 2018-11-01")
+    parser.add_argument("--end", default=None, help="exclusive end, e.g. 2018-12-01")
+    parser.add_argument("--limit", type=int, default=None, help="rows of the top-N queries")
+    parser.add_argument("--backend", choices=BACKENDS, default="postgres")
+    parser.add_argument("--db-path", default=None, help="database file of an embedded backend")
+    parser.add_argument("--dsn", default=None,
+                        help="postgres connection string (defaults to SPARKIFY_DSN or the PG* variables)")
+    parser.add_argument("--cache-file", default=".query_cache.json",
+                        help="file keeping cached results between runs ('' to disable)")
+    parser.add_argument("--ttl", type=float, default=CACHE_TTL, help="seconds a cached result is served")
+    args = parser.parse_args()
+
+    if args.list or args.query is None:
+        for name, (_, names, tables) in sorted(QUERIES.items()):
+            print("{:<24} params: {:<20} reads: {}".format(name, ", ".join(names), ", ".join(tables)))
+    else:
+        _, names, _ = QUERIES[args.query]
+        params = {key: getattr(args, key) for key in names}
+        main(args.query, params, args.backend, args.db_path, args.dsn, args.cache_file, args.ttl)
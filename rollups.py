@@ -0,0 +1,224 @@
+import argparse
+import contextlib
+
+import pandas as pd
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from sql_queries import (rollup_watermark_lock, rollup_watermark_select, songplay_max_id_select,
+                         rollup_watermark_upsert, rollup_merge_queries, rollup_question, songplay_question)
+from checkpoints import transaction
+from db import connect
+
+
+# time buckets from finest to coarsest
+GRAINS = ("hour", "day", "week", "month", "year")
+
+MEASURES = ("plays", "active_users")
+
+DIMENSIONS = ("level", "user_id", "song_id", "artist_id")
+
+# song_id / artist_id are only known for matched plays, so questions grouped
+# or filtered by them count matched plays only, whoever answers them
+MATCHED_ONLY = ("song_id", "artist_id")
+
+# rollup table -> (time column, grain, grouped columns, measures). A measure
+# maps to its SQL and whether it only holds at exactly the rollup's grain
+# and grouping (distinct counts do not add up across buckets or groups).
+# Listed smallest first, the first rollup able to answer a question wins.
+ROLLUPS = {
+    "rollup_level_daily": ("day", "day", ("level",),
+                           {"plays": ("sum(plays)", False), "active_users": ("sum(users)", True)}),
+    "rollup_song_daily": ("day", "day", ("song_id", "artist_id"),
+                          {"plays": ("sum(plays)", False)}),
+    "rollup_user_hourly": ("hour", "hour", ("user_id", "level"),
+                           {"plays": ("sum(plays)", False), "active_users": ("count(DISTINCT user_id)", False)}),
+}
+
+RAW_MEASURES = {"plays": "count(*)", "active_users": "count(DISTINCT user_id)"}
+
+
+def refresh_rollups(cur):
+    """
+    Description: This function folds the songplays inserted since the last
+    refresh into the rollup tables. It runs in the caller's transaction (if
+    any), so call it before the commit of the batch that inserted the
+    songplays. On an autocommit connection outside a transaction it runs
+    in one of its own, so the watermark lock, the merges and the new
+    watermark commit together and a crash cannot fold a range in twice.
+    Concurrent loaders must refresh after their loads committed: serial ids
+    are handed out before commit, so a watermark could skip a slower
+    loader's rows.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        number of songplay ids folded in.
+    """
+    conn = cur.connection
+    idle = conn.autocommit and conn.info.transaction_status == TRANSACTION_STATUS_IDLE
+    with transaction(cur) if idle else contextlib.nullcontext():
+        cur.execute(rollup_watermark_lock)
+        row = cur.fetchone()
+        low = row[0] if row else 0
+
+        cur.execute(songplay_max_id_select)
+        high = cur.fetchone()[0]
+        if high is None or high <= low:
+            return 0
+
+        for query in rollup_merge_queries:
+            cur.execute(query, {"low": low, "high": high})
+        cur.execute(rollup_watermark_upsert, {"high": high})
+
+    return high - low
+
+
+def rollups_current(cur):
+    """
+    Description: This function checks that the rollups hold every songplay.
+
+    Arguments:
+        cur: the cursor object.
+
+    Returns:
+        bool
+    """
+    cur.execute(rollup_watermark_select)
+    row = cur.fetchone()
+    cur.execute(songplay_max_id_select)
+    high = cur.fetchone()[0]
+
+    return high is None or (row is not None and row[0] >= high)
+
+
+def aligned(timestamp, grain):
+    # a bound inside a rollup bucket would count the whole bucket
+    return timestamp == timestamp.floor("h" if grain == "hour" else "D")
+
+
+def choose_rollup(measure, by, grain, start, end, filters):
+    """
+    Description: This function picks the smallest rollup able to answer a
+    question exactly.
+
+    Arguments:
+        measure: one of MEASURES.
+        by: tuple of DIMENSIONS to group by.
+        grain: one of GRAINS.
+        start: inclusive start pandas Timestamp.
+        end: exclusive end pandas Timestamp.
+        filters: dict of dimension -> value.
+
+    Returns:
+        rollup table name, or None when only songplays can answer.
+    """
+    used = set(by) | set(filters)
+    for table, (bucket, rollup_grain, dimensions, measures) in ROLLUPS.items():
+        if measure not in measures or not used <= set(dimensions):
+            continue
+        if GRAINS.index(grain) < GRAINS.index(rollup_grain):
+            continue
+        if not (aligned(start, rollup_grain) and aligned(end, rollup_grain)):
+            continue
+        if measures[measure][1] and (grain != rollup_grain or set(by) != set(dimensions)):
+            continue
+        if table == "rollup_song_daily" and not used & set(MATCHED_ONLY):
+            continue
+        return table
+
+    return None
+
+
+def ask(cur, measure="plays", by=(), grain="day", start=None, end=None, filters=None):
+    """
+    Description: This function answers an analytical question about
+    songplays from the smallest rollup able to answer it, and from songplays
+    itself otherwise (or while the rollups lag behind it).
+
+    Arguments:
+        cur: the cursor object.
+        measure: "plays" or "active_users".
+        by: tuple of DIMENSIONS to group by besides the period.
+        grain: period of one result row, one of GRAINS.
+        start: inclusive start timestamp (default: 1970).
+        end: exclusive end timestamp (default: 2100).
+        filters: dict of dimension -> value, e.g. {"level": "paid"}.
+
+    Returns:
+        (table that answered, list of (period, *by, value) rows)
+    """
+    by = tuple(by)
+    filters = dict(filters or {})
+    if measure not in MEASURES:
+        raise ValueError("unknown measure {!r}, expected one of {}".format(measure, MEASURES))
+    if grain not in GRAINS:
+        raise ValueError("unknown grain {!r}, expected one of {}".format(grain, GRAINS))
+    unknown = (set(by) | set(filters)) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError("unknown dimensions {}, expected some of {}".format(sorted(unknown), DIMENSIONS))
+
+    start = pd.Timestamp(start or "1970-01-01")
+    end = pd.Timestamp(end or "2100-01-01")
+    params = {"start": start.to_pydatetime(), "end": end.to_pydatetime(),
+              "start_ms": int(start.value // 10 ** 6), "end_ms": int(end.value // 10 ** 6)}
+
+    conditions = []
+    for i, (dimension, value) in enumerate(sorted(filters.items())):
+        conditions.append("{} = %(filter_{})s".format(dimension, i))
+        params["filter_{}".format(i)] = value
+    dimensions = "".join(", " + dimension for dimension in by)
+
+    table = choose_rollup(measure, by, grain, start, end, filters)
+    if table is not None and rollups_current(cur):
+        bucket, _, _, measures = ROLLUPS[table]
+        query = rollup_question.format(grain=grain, bucket=bucket, dimensions=dimensions,
+                                       measure=measures[measure][0],
+                                       table=table, filters="".join("\nAND " + c for c in conditions))
+    else:
+        table = "songplays"
+        conditions += ["{} IS NOT NULL".format(d) for d in MATCHED_ONLY if d in by or d in filters]
+        query = songplay_question.format(grain=grain, dimensions=dimensions, measure=RAW_MEASURES[measure],
+                                         filters="".join("\nAND " + c for c in conditions))
+
+    cur.execute(query, params)
+    return table, cur.fetchall()
+
+
+def main(command, measure="plays", by=(), grain="day", start=None, end=None, filters=None, dsn=None):
+    """
+    - refresh: folds new songplays into the rollups
+    - ask: prints the answer to a question and the table that answered it
+    """
+    conn = connect(dsn)
+    cur = conn.cursor()
+
+    if command == "refresh":
+        print("{} songplay ids folded into the rollups".format(refresh_rollups(cur)))
+        conn.commit()
+    else:
+        table, rows = ask(cur, measure, by, grain, start, end, filters)
+        print("answered from {}".format(table))
+        for row in rows:
+            print("\t".join(str(value) for value in row))
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh and query the songplays rollups.")
+    parser.add_argument("command", choices=("refresh", "ask"))
+    parser.add_argument("--measure", choices=MEASURES, default="plays")
+    parser.add_argument("--by", choices=DIMENSIONS, action="append", default=[],
+                        help="group by this dimension (repeatable)")
+    parser.add_argument("--grain", choices=GRAINS, default="day")
+    parser.add_argument("--start", default=None, help="inclusive start, e.g. 2018-11-01")
+    parser.add_argument("--end", default=None, help="exclusive end, e.g. 2018-12-01")
+    parser.add_argument("--where", action="append", default=[], metavar="DIMENSION=VALUE",
+                        help="filter on a dimension (repeatable)")
+    parser.add_argument("--dsn", default=None,
+                        help="postgres connection string (defaults to SPARKIFY_DSN or the PG* variables)")
+    args = parser.parse_args()
+
+    main(args.command, args.measure, args.by, args.grain, args.start, args.end,
+         dict(condition.split("=", 1) for condition in args.where), args.dsn)
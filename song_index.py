@@ -0,0 +1,168 @@
+import pandas as pd
+
+from sql_queries import song_lookup_select, song_select
+
+
+KEY_COLUMNS = ["title_key", "artist_key", "duration_key"]
+
+
+def normalize_keys(title, artist, duration):
+    """
+    Description: This function builds the lookup key columns for a set of
+    songs or events. The keys compare exactly, like song_select and the
+    staged songplay merge do, so every lookup mode matches the same songs.
+
+    Arguments:
+        title: series of song titles.
+        artist: series of artist names.
+        duration: series of song durations in seconds.
+
+    Returns:
+        dataframe with title_key, artist_key and duration_key columns.
+    """
+    return pd.DataFrame({
+        "title_key": title.astype(object).values,
+        "artist_key": artist.astype(object).values,
+        "duration_key": pd.to_numeric(duration, errors="coerce").astype(float).values,
+    })
+
+
+class SongIndex:
+    """
+    In-memory (title, artist, duration) -> (song_id, artist_id) index used to
+    resolve songplays without issuing one song_select per event.
+
+    An index loaded from the songs table is complete: misses are final and
+    never go back to the database. An index built only from song files falls
+    back to song_select, and keys that could not be resolved are kept in a
+    negative cache so they are only ever looked up once; adding songs clears
+    the matching negative entries.
+    """
+
+    def __init__(self):
+        self._frame = pd.DataFrame({
+            "title_key": pd.Series(dtype=object),
+            "artist_key": pd.Series(dtype=object),
+            "duration_key": pd.Series(dtype=float),
+            "song_id": pd.Series(dtype=object),
+            "artist_id": pd.Series(dtype=object),
+        })
+        self._pending = []
+        self._misses = set()
+        self.complete = False
+
+    def __len__(self):
+        return len(self.frame)
+
+    @property
+    def frame(self):
+        """
+        Description: the index as a dataframe, with pending additions merged in.
+        """
+        if self._pending:
+            frame = pd.concat([self._frame] + self._pending, ignore_index=True)
+            # keep the first song seen per key, like song_select's fetchone()
+            self._frame = frame.drop_duplicates(subset=KEY_COLUMNS, keep="first").reset_index(drop=True)
+            self._pending = []
+        return self._frame
+
+    @property
+    def misses(self):
+        return frozenset(self._misses)
+
+    def add(self, df):
+        """
+        Description: This function adds songs to the index.
+
+        Arguments:
+            df: dataframe with song_id, title, artist_id, artist_name and duration columns.
+
+        Returns:
+            None
+        """
+        if df.empty:
+            return
+
+        keys = normalize_keys(df["title"], df["artist_name"], df["duration"])
+        keys["song_id"] = df["song_id"].values
+        keys["artist_id"] = df["artist_id"].values
+        self._pending.append(keys)
+
+        if self._misses:
+            self._misses.difference_update(keys[KEY_COLUMNS].itertuples(index=False, name=None))
+
+    def load(self, cur):
+        """
+        Description: This function adds every song already in the songs table
+        to the index with a single query.
+
+        Arguments:
+            cur: the cursor object.
+
+        Returns:
+            None
+        """
+        cur.execute(song_lookup_select)
+        rows = cur.fetchall()
+        self.add(pd.DataFrame(rows, columns=["title", "artist_name", "duration", "song_id", "artist_id"]))
+        self.complete = True
+
+    @classmethod
+    def from_db(cls, cur):
+        index = cls()
+        index.load(cur)
+        return index
+
+    def resolve(self, df, cur=None):
+        """
+        Description: This function resolves song_id and artist_id for a whole
+        events dataframe with one join against the index.
+
+        Arguments:
+            df: NextSong events dataframe with song, artist and length columns.
+            cur: optional cursor; unless the index is complete, keys missing
+                from the index and from the negative cache are looked up once
+                with song_select.
+
+        Returns:
+            dataframe aligned with df holding song_id and artist_id columns
+            (None where no song matched).
+        """
+        keys = normalize_keys(df["song"], df["artist"], df["length"])
+        resolved = keys.merge(self.frame, on=KEY_COLUMNS, how="left")
+
+        if cur is not None and not self.complete:
+            unresolved = resolved[resolved["song_id"].isna()]
+            missing = set(unresolved[KEY_COLUMNS].itertuples(index=False, name=None)) - self._misses
+            if missing:
+                self._lookup(cur, df[resolved["song_id"].isna().values], missing)
+                resolved = keys.merge(self.frame, on=KEY_COLUMNS, how="left")
+
+        resolved = resolved[["song_id", "artist_id"]].astype(object)
+        resolved = resolved.where(resolved.notna(), None)
+        resolved.index = df.index
+        return resolved
+
+    def _lookup(self, cur, df, missing):
+        """
+        Description: This function falls back to song_select for keys the index
+        does not know yet, caching hits in the index and misses in the
+        negative cache.
+        """
+        events = df.drop_duplicates(subset=["song", "artist", "length"])
+        event_keys = normalize_keys(events["song"], events["artist"], events["length"])
+
+        for key, (_, row) in zip(event_keys.itertuples(index=False, name=None), events.iterrows()):
+            if key not in missing:
+                continue
+            missing.discard(key)
+
+            cur.execute(song_select, (row.song, row.artist, row.length))
+            results = cur.fetchone()
+
+            if results:
+                songid, artistid = results
+                self.add(pd.DataFrame([[songid, row.song, artistid, row.artist, row.length]],
+                                      columns=["song_id", "title", "artist_id", "artist_name", "duration"]))
+            else:
+                self._misses.add(key)
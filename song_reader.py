@@ -0,0 +1,115 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+try:
+    # optional, several times faster than the standard library parser
+    import orjson
+except ImportError:
+    orjson = None
+
+
+SONG_COLUMNS = ["song_id", "title", "artist_id", "artist_name", "year", "duration"]
+ARTIST_COLUMNS = ["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]
+
+# song files parsed and written together
+SONG_BATCH_SIZE = 5000
+
+
+def scan_files(filepath, suffix=".json"):
+    """
+    Description: This function lists the data files below a directory in a
+    single os.scandir pass, skipping anything that does not end in suffix
+    (song_data holds stray .htm / .html files).
+
+    Arguments:
+        filepath: log data or song data directory.
+        suffix: file name extension to keep.
+
+    Returns:
+        sorted list of (absolute file path, size in bytes).
+    """
+    found = []
+    pending = [os.path.abspath(filepath)]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.endswith(suffix) and entry.is_file():
+                    # scandir already fetched the stat on most platforms
+                    found.append((entry.path, entry.stat().st_size))
+
+    return sorted(found)
+
+
+def loads(line):
+    if orjson is not None:
+        return orjson.loads(line)
+    return json.loads(line)
+
+
+def read_song_file(filepath):
+    """
+    Description: This function parses the JSON lines of one song file into
+    plain dicts, without building a dataframe per file.
+
+    Arguments:
+        filepath: song data file path.
+
+    Returns:
+        list of song records.
+    """
+    with open(filepath, "rb") as f:
+        return [loads(line) for line in f.read().splitlines() if line.strip()]
+
+
+def read_song_batch(paths, executor=None):
+    """
+    Description: This function parses a batch of song files. With an
+    executor the files are read on its threads, which overlaps the file
+    system calls of many small files.
+
+    Arguments:
+        paths: song data file paths.
+        executor: optional concurrent.futures executor.
+
+    Returns:
+        list of song record lists, one per path, in path order.
+    """
+    if executor is None:
+        return [read_song_file(path) for path in paths]
+    return list(executor.map(read_song_file, paths))
+
+
+def song_frame(records):
+    """
+    Description: This function builds one songs dataframe out of the records
+    of a whole batch of files.
+
+    Arguments:
+        records: list of song records.
+
+    Returns:
+        dataframe with the song and artist columns; missing values are None.
+    """
+    df = pd.DataFrame.from_records(records, columns=list(dict.fromkeys(SONG_COLUMNS + ARTIST_COLUMNS)))
+    # a null latitude next to a known one would otherwise turn into NaN
+    return df.astype(object).where(df.notna(), None)
+
+
+def song_executor(threads):
+    """
+    Description: This function creates the thread pool reading song files.
+
+    Arguments:
+        threads: number of reader threads; 0 or 1 reads on the calling thread.
+
+    Returns:
+        ThreadPoolExecutor, or None.
+    """
+    if threads and threads > 1:
+        return ThreadPoolExecutor(max_workers=threads, thread_name_prefix="song-reader")
+    return None
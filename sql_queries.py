@@ -5,6 +5,30 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+file_manifest_table_drop = "DROP TABLE IF EXISTS file_manifest;"
+file_checkpoint_table_drop = "DROP TABLE IF EXISTS file_checkpoint;"
+data_version_table_drop = "DROP TABLE IF EXISTS data_versions;"
+load_reject_table_drop = "DROP TABLE IF EXISTS load_rejects;"
+user_level_history_table_drop = "DROP TABLE IF EXISTS user_level_history;"
+songplay_facts_table_drop = "DROP TABLE IF EXISTS songplay_facts;"
+location_table_drop = "DROP TABLE IF EXISTS locations;"
+user_agent_table_drop = "DROP TABLE IF EXISTS user_agents;"
+
+# DROP TABLE fails on a view and DROP VIEW on a table, whichever songplays is
+songplay_view_drop = ("""
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE oid = to_regclass('songplays') AND relkind = 'v') THEN
+        DROP VIEW songplays;
+    END IF;
+END $$;
+""")
+staging_events_table_drop = "DROP TABLE IF EXISTS staging_events;"
+staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs;"
+rollup_song_daily_table_drop = "DROP TABLE IF EXISTS rollup_song_daily;"
+rollup_user_hourly_table_drop = "DROP TABLE IF EXISTS rollup_user_hourly;"
+rollup_level_daily_table_drop = "DROP TABLE IF EXISTS rollup_level_daily;"
+rollup_watermark_table_drop = "DROP TABLE IF EXISTS rollup_watermark;"
 
 # CREATE TABLES
 
@@ -17,6 +41,17 @@ CREATE TABLE IF NOT EXISTS users
                             level VARCHAR NOT NULL);
 """)
 
+# type 2 history of users.level: one row per free / paid period, valid_to
+# (epoch milliseconds, like start_time) is NULL for the current period
+user_level_history_table_create = ("""
+CREATE TABLE IF NOT EXISTS user_level_history
+                            (user_id INT NOT NULL,
+                            level VARCHAR NOT NULL,
+                            valid_from BIGINT NOT NULL,
+                            valid_to BIGINT,
+                            PRIMARY KEY (user_id, valid_from));
+""")
+
 song_table_create = ("""
 CREATE TABLE IF NOT EXISTS songs
                     (song_id VARCHAR PRIMARY KEY UNIQUE NOT NULL,
@@ -38,12 +73,13 @@ CREATE TABLE IF NOT EXISTS artists
 time_table_create = ("""
 CREATE TABLE IF NOT EXISTS time
                     (start_time BIGINT PRIMARY KEY NOT NULL,
-                    hour VARCHAR NOT NULL,
-                    day VARCHAR NOT NULL,
-                    week VARCHAR NOT NULL,
-                    month VARCHAR NOT NULL,
-                    year VARCHAR NOT NULL,
-                    weekday VARCHAR NOT NULL);
+                    start_timestamp TIMESTAMP NOT NULL,
+                    hour SMALLINT NOT NULL,
+                    day SMALLINT NOT NULL,
+                    week SMALLINT NOT NULL,
+                    month SMALLINT NOT NULL,
+                    year SMALLINT NOT NULL,
+                    weekday SMALLINT NOT NULL);
 """)
 
 songplay_table_create = ("""
@@ -63,8 +99,425 @@ CREATE TABLE IF NOT EXISTS songplays
                         FOREIGN KEY (artist_id) REFERENCES artists (artist_id));
 """)
 
+# PARTITIONED SONGPLAYS
+
+# range partitioned by start_time (epoch milliseconds); a partition key must
+# be part of the primary key, so songplay_id alone is no longer unique-indexed
+songplay_partitioned_table_create = ("""
+CREATE TABLE IF NOT EXISTS songplays
+                        (songplay_id SERIAL NOT NULL,
+                        start_time BIGINT NOT NULL,
+                        session_id VARCHAR NOT NULL,
+                        user_id INT NOT NULL,
+                        song_id VARCHAR,
+                        artist_id VARCHAR,
+                        level VARCHAR NOT NULL,
+                        location VARCHAR,
+                        user_agent VARCHAR,
+                        PRIMARY KEY (songplay_id, start_time),
+                        FOREIGN KEY (start_time) REFERENCES time (start_time),
+                        FOREIGN KEY (song_id) REFERENCES songs (song_id),
+                        FOREIGN KEY (user_id) REFERENCES users (user_id),
+                        FOREIGN KEY (artist_id) REFERENCES artists (artist_id))
+PARTITION BY RANGE (start_time);
+""")
+
+# catches rows outside every partition range; the ETL creates partitions
+# before loading, so it normally stays empty
+songplay_default_partition_create = ("""
+CREATE TABLE IF NOT EXISTS songplays_default
+PARTITION OF songplays DEFAULT;
+""")
+
+# the partition interval is kept as the table comment, e.g. 'month'
+songplay_partition_interval_comment = "COMMENT ON TABLE songplays IS '{interval}';"
+
+songplay_partition_interval_select = ("""
+SELECT obj_description(partrelid, 'pg_class')
+FROM pg_partitioned_table
+WHERE partrelid = to_regclass('songplays');
+""")
+
+songplay_partition_create = ("""
+CREATE TABLE IF NOT EXISTS {partition}
+PARTITION OF songplays
+FOR VALUES FROM ({start}) TO ({end});
+""")
+
+# rows the default partition caught for a range are moved out before the
+# range gets its partition, which could not be created over them
+songplay_default_rows_hold = ("""
+CREATE TEMP TABLE songplays_moved (LIKE songplays) ON COMMIT DROP;
+""")
+
+songplay_default_rows_take = ("""
+WITH moved AS (DELETE FROM songplays_default
+               WHERE start_time >= %s
+               AND start_time < %s
+               RETURNING *)
+INSERT INTO songplays_moved
+SELECT * FROM moved;
+""")
+
+songplay_default_rows_restore = ("""
+INSERT INTO songplays
+SELECT * FROM songplays_moved;
+""")
+
+songplay_partitions_select = ("""
+SELECT c.relname,
+       pg_get_expr(c.relpartbound, c.oid),
+       c.relpersistence = 'u' AS unlogged,
+       pg_total_relation_size(c.oid)
+FROM pg_inherits i
+JOIN pg_class c ON c.oid = i.inhrelid
+WHERE i.inhparent = to_regclass('songplays')
+ORDER BY c.relname;
+""")
+
+# detaching is a catalog change, the partition keeps its data as a plain table
+songplay_partition_detach = "ALTER TABLE songplays DETACH PARTITION {partition};"
+
+archive_schema_create = "CREATE SCHEMA IF NOT EXISTS archive;"
+partition_archive = "ALTER TABLE {partition} SET SCHEMA archive;"
+partition_export = "COPY {partition} TO STDOUT WITH (FORMAT csv, HEADER)"
+partition_drop = "DROP TABLE {partition};"
+
+# COMPACT SONGPLAYS
+
+# integer surrogate keys for songs and artists; SERIAL numbers existing rows
+song_key_add = "ALTER TABLE songs ADD COLUMN IF NOT EXISTS song_key SERIAL UNIQUE;"
+artist_key_add = "ALTER TABLE artists ADD COLUMN IF NOT EXISTS artist_key SERIAL UNIQUE;"
+
+# the few distinct locations and user agents, dictionary-encoded
+location_table_create = ("""
+CREATE TABLE IF NOT EXISTS locations
+                        (location_key SERIAL PRIMARY KEY,
+                        location VARCHAR UNIQUE NOT NULL);
+""")
+
+user_agent_table_create = ("""
+CREATE TABLE IF NOT EXISTS user_agents
+                        (user_agent_key SERIAL PRIMARY KEY,
+                        user_agent VARCHAR UNIQUE NOT NULL);
+""")
+
+# integer-only fact table; every column lines up with songplay_table_columns
+songplay_facts_table_create = ("""
+CREATE TABLE IF NOT EXISTS songplay_facts
+                        (songplay_id SERIAL PRIMARY KEY,
+                        start_time BIGINT NOT NULL,
+                        session_id INT NOT NULL,
+                        user_id INT NOT NULL,
+                        song_key INT,
+                        artist_key INT,
+                        level VARCHAR NOT NULL,
+                        location_key INT,
+                        user_agent_key INT,
+                        FOREIGN KEY (start_time) REFERENCES time (start_time),
+                        FOREIGN KEY (song_key) REFERENCES songs (song_key),
+                        FOREIGN KEY (user_id) REFERENCES users (user_id),
+                        FOREIGN KEY (artist_key) REFERENCES artists (artist_key),
+                        FOREIGN KEY (location_key) REFERENCES locations (location_key),
+                        FOREIGN KEY (user_agent_key) REFERENCES user_agents (user_agent_key));
+""")
+
+# songplays as readers know it; the joins are on unique keys, so Postgres
+# leaves out the ones a query does not use
+songplay_view_create = ("""
+CREATE OR REPLACE VIEW songplays AS
+SELECT f.songplay_id,
+       f.start_time,
+       f.session_id::VARCHAR AS session_id,
+       f.user_id,
+       s.song_id,
+       a.artist_id,
+       f.level,
+       l.location,
+       u.user_agent
+FROM songplay_facts f
+LEFT JOIN songs s ON s.song_key = f.song_key
+LEFT JOIN artists a ON a.artist_key = f.artist_key
+LEFT JOIN locations l ON l.location_key = f.location_key
+LEFT JOIN user_agents u ON u.user_agent_key = f.user_agent_key;
+""")
+
+songplay_facts_start_time_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplay_facts_start_time_brin
+ON songplay_facts USING BRIN (start_time);
+""")
+
+songplay_facts_user_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplay_facts_user_id_idx
+ON songplay_facts (user_id);
+""")
+
+songplay_facts_song_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplay_facts_song_key_idx
+ON songplay_facts (song_key);
+""")
+
+songplay_facts_artist_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplay_facts_artist_key_idx
+ON songplay_facts (artist_key);
+""")
+
+songplay_facts_select = "SELECT to_regclass('songplay_facts') IS NOT NULL;"
+
+# natural key -> surrogate key of the values a batch references
+song_key_select = "SELECT song_id, song_key FROM songs WHERE song_id = ANY(%s);"
+artist_key_select = "SELECT artist_id, artist_key FROM artists WHERE artist_id = ANY(%s);"
+location_key_select = "SELECT location, location_key FROM locations WHERE location = ANY(%s);"
+user_agent_key_select = "SELECT user_agent, user_agent_key FROM user_agents WHERE user_agent = ANY(%s);"
+
+location_insert = ("""
+INSERT INTO locations (location)
+SELECT unnest(%s::VARCHAR[])
+ON CONFLICT (location) DO NOTHING;
+""")
+
+user_agent_insert = ("""
+INSERT INTO user_agents (user_agent)
+SELECT unnest(%s::VARCHAR[])
+ON CONFLICT (user_agent) DO NOTHING;
+""")
+
+# one row per ingested data file, used to skip unchanged files on later runs
+file_manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS file_manifest
+                        (path VARCHAR PRIMARY KEY NOT NULL,
+                        size BIGINT NOT NULL,
+                        mtime DOUBLE PRECISION NOT NULL,
+                        content_hash CHAR(64) NOT NULL,
+                        rows_read INT NOT NULL,
+                        rows_loaded INT NOT NULL,
+                        loaded_at TIMESTAMP NOT NULL DEFAULT now());
+""")
+
+# last committed byte offset of a log file loaded in chunks, so a failed
+# load resumes where it stopped; a fully loaded file keeps its end offset
+file_checkpoint_table_create = ("""
+CREATE TABLE IF NOT EXISTS file_checkpoint
+                        (path VARCHAR PRIMARY KEY NOT NULL,
+                        size BIGINT NOT NULL,
+                        mtime DOUBLE PRECISION NOT NULL,
+                        byte_offset BIGINT NOT NULL,
+                        rows_loaded INT NOT NULL,
+                        updated_at TIMESTAMP NOT NULL);
+""")
+
+# a counter per star schema table, bumped whenever a load commits new rows
+# into it, so cached query results can tell they are stale
+data_version_table_create = ("""
+CREATE TABLE IF NOT EXISTS data_versions
+                        (table_name VARCHAR PRIMARY KEY NOT NULL,
+                        version BIGINT NOT NULL,
+                        updated_at TIMESTAMP NOT NULL);
+""")
+
+# rows a batched load could not write, kept instead of failing the batch
+load_reject_table_create = ("""
+CREATE TABLE IF NOT EXISTS load_rejects
+                        (file_path VARCHAR,
+                        table_name VARCHAR NOT NULL,
+                        row_data TEXT NOT NULL,
+                        error TEXT NOT NULL,
+                        rejected_at TIMESTAMP NOT NULL);
+""")
+
+# INDEXES
+
+# composite B-tree serving song_select (and the songplay merge join)
+song_lookup_index_create = ("""
+CREATE INDEX IF NOT EXISTS songs_lookup_idx
+ON songs (title, artist_name, duration);
+""")
+
+# start_time grows with the load order, so a BRIN index stays tiny and
+# still prunes time range scans on the fact table
+songplay_start_time_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplays_start_time_brin
+ON songplays USING BRIN (start_time);
+""")
+
+# FK-side indexes: joins to the dimensions and FK checks on their deletes
+songplay_user_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplays_user_id_idx
+ON songplays (user_id);
+""")
+
+songplay_song_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplays_song_id_idx
+ON songplays (song_id);
+""")
+
+songplay_artist_index_create = ("""
+CREATE INDEX IF NOT EXISTS songplays_artist_id_idx
+ON songplays (artist_id);
+""")
+
+# optional fuzzy title matching, e.g. WHERE title % 'Setanta matins'
+trgm_extension_create = "CREATE EXTENSION IF NOT EXISTS pg_trgm;"
+
+song_title_trgm_index_create = ("""
+CREATE INDEX IF NOT EXISTS songs_title_trgm_idx
+ON songs USING GIN (title gin_trgm_ops);
+""")
+
+# BULK LOAD MODE
+
+# a backfill loads songplays without its keys, foreign keys and secondary
+# indexes, then rebuilds them in one pass; the names are Postgres' defaults
+# for the constraints declared in songplay_table_create
+
+songplay_key_drop = ("""
+ALTER TABLE songplays
+    DROP CONSTRAINT IF EXISTS songplays_songplay_id_key,
+    DROP CONSTRAINT IF EXISTS songplays_pkey;
+""")
+
+songplay_key_create = ("""
+ALTER TABLE songplays
+    ADD CONSTRAINT songplays_pkey PRIMARY KEY (songplay_id),
+    ADD CONSTRAINT songplays_songplay_id_key UNIQUE (songplay_id);
+""")
+
+songplay_foreign_keys_drop = ("""
+ALTER TABLE songplays
+    DROP CONSTRAINT IF EXISTS songplays_start_time_fkey,
+    DROP CONSTRAINT IF EXISTS songplays_song_id_fkey,
+    DROP CONSTRAINT IF EXISTS songplays_user_id_fkey,
+    DROP CONSTRAINT IF EXISTS songplays_artist_id_fkey;
+""")
+
+# NOT VALID skips the check of existing rows; VALIDATE CONSTRAINT then
+# checks them with one join per key instead of one lookup per row
+songplay_foreign_keys_create = ("""
+ALTER TABLE songplays
+    ADD CONSTRAINT songplays_start_time_fkey FOREIGN KEY (start_time) REFERENCES time (start_time) NOT VALID,
+    ADD CONSTRAINT songplays_song_id_fkey FOREIGN KEY (song_id) REFERENCES songs (song_id) NOT VALID,
+    ADD CONSTRAINT songplays_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id) NOT VALID,
+    ADD CONSTRAINT songplays_artist_id_fkey FOREIGN KEY (artist_id) REFERENCES artists (artist_id) NOT VALID;
+""")
+
+# Postgres cannot add NOT VALID foreign keys to a partitioned table, so a
+# partitioned songplays gets them validated as they are added
+songplay_partitioned_key_create = ("""
+ALTER TABLE songplays
+    ADD CONSTRAINT songplays_pkey PRIMARY KEY (songplay_id, start_time);
+""")
+
+songplay_partitioned_foreign_keys_create = ("""
+ALTER TABLE songplays
+    ADD CONSTRAINT songplays_start_time_fkey FOREIGN KEY (start_time) REFERENCES time (start_time),
+    ADD CONSTRAINT songplays_song_id_fkey FOREIGN KEY (song_id) REFERENCES songs (song_id),
+    ADD CONSTRAINT songplays_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id),
+    ADD CONSTRAINT songplays_artist_id_fkey FOREIGN KEY (artist_id) REFERENCES artists (artist_id);
+""")
+
+songplay_foreign_keys_validate = ("""
+ALTER TABLE songplays VALIDATE CONSTRAINT songplays_start_time_fkey;
+ALTER TABLE songplays VALIDATE CONSTRAINT songplays_song_id_fkey;
+ALTER TABLE songplays VALIDATE CONSTRAINT songplays_user_id_fkey;
+ALTER TABLE songplays VALIDATE CONSTRAINT songplays_artist_id_fkey;
+""")
+
+# songs_lookup_idx stays, the load itself looks songs up
+songplay_index_drop_queries = [
+    "DROP INDEX IF EXISTS songplays_start_time_brin;",
+    "DROP INDEX IF EXISTS songplays_user_id_idx;",
+    "DROP INDEX IF EXISTS songplays_song_id_idx;",
+    "DROP INDEX IF EXISTS songplays_artist_id_idx;",
+]
+
+# star schema tables skipping the WAL while they are loaded; songplays is
+# switched first and back last, as a logged table cannot reference an
+# unlogged one
+bulk_load_tables = ["songplays", "users", "songs", "artists", "time"]
+
+set_unlogged = "ALTER TABLE {} SET UNLOGGED;"
+set_logged = "ALTER TABLE {} SET LOGGED;"
+
+set_unlogged_queries = [set_unlogged.format(table) for table in bulk_load_tables]
+set_logged_queries = [set_logged.format(table) for table in reversed(bulk_load_tables)]
+
+# scans, tuples read and size of every index, to prune the unused ones
+# the indexes of songplays partitions cannot be dropped on their own, so
+# their statistics are summed up under the partitioned index they belong to
+index_usage_select = ("""
+SELECT t.relname AS table_name,
+       r.relname AS index_name,
+       sum(s.idx_scan)::BIGINT AS idx_scan,
+       sum(s.idx_tup_read)::BIGINT AS idx_tup_read,
+       sum(s.idx_tup_fetch)::BIGINT AS idx_tup_fetch,
+       sum(pg_relation_size(s.indexrelid))::BIGINT AS index_bytes,
+       i.indisunique OR i.indisprimary AS is_unique,
+       count(*) AS partitions
+FROM pg_stat_user_indexes s
+JOIN pg_class r ON r.oid = coalesce(pg_partition_root(s.indexrelid), s.indexrelid)
+JOIN pg_index i ON i.indexrelid = r.oid
+JOIN pg_class t ON t.oid = i.indrelid
+GROUP BY t.relname, r.relname, i.indisunique, i.indisprimary
+ORDER BY 3, 6 DESC;
+""")
+
+# STAGING TABLES
+
+# raw song and log records, bulk loaded as-is and merged into the star schema
+# with set-based SQL; unlogged since they are rebuilt on every run
+
+staging_events_table_create = ("""
+CREATE UNLOGGED TABLE IF NOT EXISTS staging_events
+                        (artist VARCHAR,
+                        auth VARCHAR,
+                        first_name VARCHAR,
+                        gender CHAR,
+                        item_in_session INT,
+                        last_name VARCHAR,
+                        length FLOAT8,
+                        level VARCHAR,
+                        location VARCHAR,
+                        method VARCHAR,
+                        page VARCHAR,
+                        registration FLOAT8,
+                        session_id INT,
+                        song VARCHAR,
+                        status INT,
+                        ts BIGINT,
+                        user_agent VARCHAR,
+                        user_id VARCHAR);
+""")
+
+staging_songs_table_create = ("""
+CREATE UNLOGGED TABLE IF NOT EXISTS staging_songs
+                        (num_songs INT,
+                        artist_id VARCHAR,
+                        artist_latitude FLOAT8,
+                        artist_longitude FLOAT8,
+                        artist_location VARCHAR,
+                        artist_name VARCHAR,
+                        song_id VARCHAR,
+                        title VARCHAR,
+                        duration FLOAT8,
+                        year INT);
+""")
+
 # INSERT RECORDS
 
+songplay_facts_insert = ("""
+INSERT INTO songplay_facts
+    (start_time,
+    session_id,
+    user_id,
+    song_key,
+    artist_key,
+    level,
+    location_key,
+    user_agent_key)
+VALUES
+        (%s, %s, %s, %s, %s, %s, %s, %s);
+""")
+
 songplay_table_insert = ("""
 INSERT INTO songplays
     (start_time,
@@ -95,6 +548,31 @@ DO UPDATE SET level = excluded.level;
 """)
 
 
+# level changes: close the user's current period if it has another level,
+# then open one unless a period is still open; events older than the open
+# period (a reloaded file) change nothing
+user_level_history_close = ("""
+UPDATE user_level_history
+SET valid_to = %s
+WHERE user_id = %s
+AND valid_to IS NULL
+AND level <> %s
+AND valid_from < %s;
+""")
+
+user_level_history_open = ("""
+INSERT INTO user_level_history
+    (user_id,
+    level,
+    valid_from)
+SELECT %s, %s, %s
+WHERE NOT EXISTS (SELECT 1
+                  FROM user_level_history
+                  WHERE user_id = %s
+                  AND valid_to IS NULL);
+""")
+
+
 # song table insertion
 song_table_insert = ("""
 INSERT INTO songs
@@ -126,10 +604,40 @@ DO UPDATE SEt name = excluded.name;
 """)
 
 
+# multi-row song and artist upserts, for psycopg2.extras.execute_values;
+# the rows of one statement need unique keys
+song_table_insert_values = ("""
+INSERT INTO songs
+    (song_id,
+    title,
+    artist_id,
+    artist_name,
+    year,
+    duration)
+VALUES %s
+ON CONFLICT (song_id)
+DO UPDATE SET duration = excluded.duration;
+""")
+
+
+artist_table_insert_values = ("""
+INSERT INTO artists
+      (artist_id,
+      name,
+      location,
+      latitude,
+      longitude)
+VALUES %s
+ON CONFLICT (artist_id)
+DO UPDATE SET name = excluded.name;
+""")
+
+
 # time table insert
 time_table_insert = ("""
 INSERT INTO time
     (start_time,
+    start_timestamp,
     hour,
     day,
     week,
@@ -137,22 +645,779 @@ INSERT INTO time
     year,
     weekday)
 VALUES
-    (%s, %s, %s, %s, %s, %s, %s);
+    (%s, %s, %s, %s, %s, %s, %s, %s)
+ON CONFLICT (start_time)
+DO NOTHING;
 """)
 
 # FIND SONGS
 
+# equality (not LIKE) so the lookup is served by songs_lookup_idx
 song_select = ("""
 SELECT song_id, artist_id
 FROM songs
-WHERE title LIKE %s
-AND artist_name LIKE %s
+WHERE title = %s
+AND artist_name = %s
 AND duration = %s
 GROUP BY song_id,
          artist_id;
 """)
 
+# every song with the columns the in-memory song index is keyed on
+song_lookup_select = ("""
+SELECT title, artist_name, duration, song_id, artist_id
+FROM songs;
+""")
+
+# file manifest upsert
+file_manifest_upsert = ("""
+INSERT INTO file_manifest
+    (path,
+    size,
+    mtime,
+    content_hash,
+    rows_read,
+    rows_loaded,
+    loaded_at)
+VALUES
+    (%s, %s, %s, %s, %s, %s, now())
+ON CONFLICT (path)
+DO UPDATE SET size = excluded.size,
+              mtime = excluded.mtime,
+              content_hash = excluded.content_hash,
+              rows_read = excluded.rows_read,
+              rows_loaded = excluded.rows_loaded,
+              loaded_at = excluded.loaded_at;
+""")
+
+# a touched but unchanged file only needs its stat refreshed
+file_manifest_touch = ("""
+UPDATE file_manifest
+SET size = %s,
+    mtime = %s
+WHERE path = %s;
+""")
+
+file_manifest_select = ("""
+SELECT path, size, mtime, content_hash, rows_loaded
+FROM file_manifest;
+""")
+
+file_checkpoint_select = ("""
+SELECT size, mtime, byte_offset, rows_loaded
+FROM file_checkpoint
+WHERE path = %s;
+""")
+
+file_checkpoint_upsert = ("""
+INSERT INTO file_checkpoint
+    (path,
+    size,
+    mtime,
+    byte_offset,
+    rows_loaded,
+    updated_at)
+VALUES
+    (%s, %s, %s, %s, %s, now())
+ON CONFLICT (path)
+DO UPDATE SET size = excluded.size,
+              mtime = excluded.mtime,
+              byte_offset = excluded.byte_offset,
+              rows_loaded = excluded.rows_loaded,
+              updated_at = excluded.updated_at;
+""")
+
+file_checkpoint_delete = ("""
+DELETE FROM file_checkpoint;
+""")
+
+file_checkpoint_path_delete = ("""
+DELETE FROM file_checkpoint
+WHERE path = %s;
+""")
+
+data_version_bump = ("""
+INSERT INTO data_versions
+    (table_name,
+    version,
+    updated_at)
+VALUES
+    (%s, 1, now())
+ON CONFLICT (table_name)
+DO UPDATE SET version = data_versions.version + 1,
+              updated_at = excluded.updated_at;
+""")
+
+data_versions_select = ("""
+SELECT table_name, version
+FROM data_versions;
+""")
+
+# explicit transactions around a chunk and its checkpoint, on connections
+# otherwise in autocommit mode
+transaction_begin = "BEGIN;"
+transaction_commit = "COMMIT;"
+transaction_rollback = "ROLLBACK;"
+
+# savepoints inside such a transaction, around one write or one row
+savepoint_create = "SAVEPOINT {name};"
+savepoint_rollback = "ROLLBACK TO SAVEPOINT {name};"
+savepoint_release = "RELEASE SAVEPOINT {name};"
+
+load_reject_insert = ("""
+INSERT INTO load_rejects
+    (file_path,
+    table_name,
+    row_data,
+    error,
+    rejected_at)
+VALUES
+    (%s, %s, %s, %s, now());
+""")
+
+# PREPARED STATEMENTS
+
+# hot statements are prepared once per session; a cursor checks for an
+# existing one before preparing it again
+prepared_statement_select = ("""
+SELECT 1
+FROM pg_prepared_statements
+WHERE name = %s;
+""")
+
+# BULK (COPY) LOADS
+
+# rows are streamed into a session-local temp table first, then merged into
+# the target so the ON CONFLICT behaviour of the single-row inserts is kept.
+
+copy_from_stdin = ("""
+COPY {table} ({columns}) FROM STDIN;
+""")
+
+# only the loaded columns, so defaulted ones like song_key stay out of it
+temp_table_create = ("""
+CREATE TEMP TABLE IF NOT EXISTS {temp_table} AS
+SELECT {columns} FROM {table} WITH NO DATA;
+""")
+
+temp_table_truncate = ("""
+TRUNCATE {temp_table};
+""")
+
+songplay_table_columns = ("start_time", "session_id", "user_id", "song_id", "artist_id", "level", "location", "user_agent")
+songplay_facts_columns = ("start_time", "session_id", "user_id", "song_key", "artist_key", "level", "location_key", "user_agent_key")
+user_table_columns = ("user_id", "first_name", "last_name", "gender", "level")
+song_table_columns = ("song_id", "title", "artist_id", "artist_name", "year", "duration")
+artist_table_columns = ("artist_id", "name", "location", "latitude", "longitude")
+time_table_columns = ("start_time", "start_timestamp", "hour", "day", "week", "month", "year", "weekday")
+
+user_table_merge = ("""
+INSERT INTO users
+    (user_id,
+    first_name,
+    last_name,
+    gender,
+    level)
+SELECT user_id, first_name, last_name, gender, level
+FROM users_load
+ON CONFLICT (user_id)
+DO UPDATE SET level = excluded.level;
+""")
+
+song_table_merge = ("""
+INSERT INTO songs
+    (song_id,
+    title,
+    artist_id,
+    artist_name,
+    year,
+    duration)
+SELECT song_id, title, artist_id, artist_name, year, duration
+FROM songs_load
+ON CONFLICT (song_id)
+DO UPDATE SET duration = excluded.duration;
+""")
+
+artist_table_merge = ("""
+INSERT INTO artists
+      (artist_id,
+      name,
+      location,
+      latitude,
+      longitude)
+SELECT artist_id, name, location, latitude, longitude
+FROM artists_load
+ON CONFLICT (artist_id)
+DO UPDATE SET name = excluded.name;
+""")
+
+time_table_merge = ("""
+INSERT INTO time
+    (start_time,
+    start_timestamp,
+    hour,
+    day,
+    week,
+    month,
+    year,
+    weekday)
+SELECT start_time, start_timestamp, hour, day, week, month, year, weekday
+FROM time_load
+ON CONFLICT (start_time)
+DO NOTHING;
+""")
+
+# STAGING LOADS
+
+# source JSON keys -> staging column, in staging table column order
+staging_events_columns = {
+    "artist": "artist",
+    "auth": "auth",
+    "firstName": "first_name",
+    "gender": "gender",
+    "itemInSession": "item_in_session",
+    "lastName": "last_name",
+    "length": "length",
+    "level": "level",
+    "location": "location",
+    "method": "method",
+    "page": "page",
+    "registration": "registration",
+    "sessionId": "session_id",
+    "song": "song",
+    "status": "status",
+    "ts": "ts",
+    "userAgent": "user_agent",
+    "userId": "user_id",
+}
+
+staging_songs_columns = {
+    "num_songs": "num_songs",
+    "artist_id": "artist_id",
+    "artist_latitude": "artist_latitude",
+    "artist_longitude": "artist_longitude",
+    "artist_location": "artist_location",
+    "artist_name": "artist_name",
+    "song_id": "song_id",
+    "title": "title",
+    "duration": "duration",
+    "year": "year",
+}
+
+staging_tables_truncate = ("""
+TRUNCATE staging_events, staging_songs;
+""")
+
+staging_song_table_merge = ("""
+INSERT INTO songs
+    (song_id,
+    title,
+    artist_id,
+    artist_name,
+    year,
+    duration)
+SELECT DISTINCT ON (song_id)
+       song_id, title, artist_id, artist_name, year, duration
+FROM staging_songs
+WHERE song_id IS NOT NULL
+ORDER BY song_id
+ON CONFLICT (song_id)
+DO UPDATE SET duration = excluded.duration;
+""")
+
+staging_artist_table_merge = ("""
+INSERT INTO artists
+      (artist_id,
+      name,
+      location,
+      latitude,
+      longitude)
+SELECT DISTINCT ON (artist_id)
+       artist_id, artist_name, artist_location, artist_latitude, artist_longitude
+FROM staging_songs
+WHERE artist_id IS NOT NULL
+ORDER BY artist_id
+ON CONFLICT (artist_id)
+DO UPDATE SET name = excluded.name;
+""")
+
+# latest level per user wins, as with one upsert per event in ts order
+staging_user_table_merge = ("""
+INSERT INTO users
+    (user_id,
+    first_name,
+    last_name,
+    gender,
+    level)
+SELECT DISTINCT ON (user_id::INT)
+       user_id::INT, first_name, last_name, gender, level
+FROM staging_events
+WHERE page = 'NextSong'
+AND user_id <> ''
+ORDER BY user_id::INT, ts DESC
+ON CONFLICT (user_id)
+DO UPDATE SET level = excluded.level;
+""")
+
+staging_time_table_merge = ("""
+INSERT INTO time
+    (start_time,
+    start_timestamp,
+    hour,
+    day,
+    week,
+    month,
+    year,
+    weekday)
+SELECT ts,
+       t,
+       EXTRACT(hour FROM t)::SMALLINT,
+       EXTRACT(day FROM t)::SMALLINT,
+       EXTRACT(week FROM t)::SMALLINT,
+       EXTRACT(month FROM t)::SMALLINT,
+       EXTRACT(year FROM t)::SMALLINT,
+       EXTRACT(isodow FROM t)::SMALLINT - 1
+FROM (SELECT DISTINCT ts, to_timestamp(ts / 1000.0) AT TIME ZONE 'UTC' AS t
+      FROM staging_events
+      WHERE page = 'NextSong') AS events
+ON CONFLICT (start_time)
+DO NOTHING;
+""")
+
+# one hash join against songs replaces a song_select per event
+staging_songplay_table_merge = ("""
+INSERT INTO songplays
+    (start_time,
+    session_id,
+    user_id,
+    song_id,
+    artist_id,
+    level,
+    location,
+    user_agent)
+SELECT e.ts,
+       e.session_id,
+       e.user_id::INT,
+       s.song_id,
+       s.artist_id,
+       e.level,
+       e.location,
+       e.user_agent
+FROM staging_events e
+LEFT JOIN (SELECT DISTINCT ON (title, artist_name, duration)
+                  title, artist_name, duration, song_id, artist_id
+           FROM songs
+           ORDER BY title, artist_name, duration, song_id) s
+       ON s.title = e.song
+      AND s.artist_name = e.artist
+      AND s.duration = e.length
+WHERE e.page = 'NextSong'
+AND e.user_id <> '';
+""")
+
+# ROLLUPS
+
+# pre-aggregated songplays, kept up to date incrementally: every refresh
+# folds in only the songplays above the watermark. All rollups are additive,
+# so new counts are added onto the existing rows.
+
+# plays per matched song per day (plays without a song_id are not counted)
+rollup_song_daily_table_create = ("""
+CREATE TABLE IF NOT EXISTS rollup_song_daily
+                        (day DATE NOT NULL,
+                        song_id VARCHAR NOT NULL,
+                        artist_id VARCHAR,
+                        plays BIGINT NOT NULL,
+                        PRIMARY KEY (day, song_id));
+""")
+
+# one row per user active in an hour, so distinct active users stay exact
+rollup_user_hourly_table_create = ("""
+CREATE TABLE IF NOT EXISTS rollup_user_hourly
+                        (hour TIMESTAMP NOT NULL,
+                        user_id INT NOT NULL,
+                        level VARCHAR NOT NULL,
+                        plays BIGINT NOT NULL,
+                        PRIMARY KEY (hour, user_id, level));
+""")
+
+# free vs paid listening per day
+rollup_level_daily_table_create = ("""
+CREATE TABLE IF NOT EXISTS rollup_level_daily
+                        (day DATE NOT NULL,
+                        level VARCHAR NOT NULL,
+                        plays BIGINT NOT NULL,
+                        users BIGINT NOT NULL,
+                        PRIMARY KEY (day, level));
+""")
+
+rollup_watermark_table_create = ("""
+CREATE TABLE IF NOT EXISTS rollup_watermark
+                        (source VARCHAR PRIMARY KEY NOT NULL,
+                        last_songplay_id BIGINT NOT NULL,
+                        refreshed_at TIMESTAMP NOT NULL DEFAULT now());
+""")
+
+rollup_watermark_seed = ("""
+INSERT INTO rollup_watermark
+    (source,
+    last_songplay_id)
+VALUES
+    ('songplays', 0)
+ON CONFLICT (source)
+DO NOTHING;
+""")
+
+rollup_watermark_select = ("""
+SELECT last_songplay_id
+FROM rollup_watermark
+WHERE source = 'songplays';
+""")
+
+# locks the watermark row, so concurrent refreshes apply each songplay once
+rollup_watermark_lock = ("""
+SELECT last_songplay_id
+FROM rollup_watermark
+WHERE source = 'songplays'
+FOR UPDATE;
+""")
+
+songplay_max_id_select = ("""
+SELECT max(songplay_id)
+FROM songplays;
+""")
+
+rollup_watermark_upsert = ("""
+INSERT INTO rollup_watermark
+    (source,
+    last_songplay_id,
+    refreshed_at)
+VALUES
+    ('songplays', %(high)s, now())
+ON CONFLICT (source)
+DO UPDATE SET last_songplay_id = excluded.last_songplay_id,
+              refreshed_at = excluded.refreshed_at;
+""")
+
+# start_time is epoch milliseconds in UTC, like time.start_timestamp
+rollup_song_daily_merge = ("""
+INSERT INTO rollup_song_daily
+    (day,
+    song_id,
+    artist_id,
+    plays)
+SELECT (to_timestamp(start_time / 1000.0) AT TIME ZONE 'UTC')::DATE,
+       song_id,
+       max(artist_id),
+       count(*)
+FROM songplays
+WHERE songplay_id > %(low)s
+AND songplay_id <= %(high)s
+AND song_id IS NOT NULL
+GROUP BY 1, 2
+ON CONFLICT (day, song_id)
+DO UPDATE SET plays = rollup_song_daily.plays + excluded.plays;
+""")
+
+rollup_user_hourly_merge = ("""
+INSERT INTO rollup_user_hourly
+    (hour,
+    user_id,
+    level,
+    plays)
+SELECT date_trunc('hour', to_timestamp(start_time / 1000.0) AT TIME ZONE 'UTC'),
+       user_id,
+       level,
+       count(*)
+FROM songplays
+WHERE songplay_id > %(low)s
+AND songplay_id <= %(high)s
+GROUP BY 1, 2, 3
+ON CONFLICT (hour, user_id, level)
+DO UPDATE SET plays = rollup_user_hourly.plays + excluded.plays;
+""")
+
+# users is not additive across batches, so it is recounted for the touched
+# days from rollup_user_hourly, which already holds the new rows
+rollup_level_daily_merge = ("""
+INSERT INTO rollup_level_daily
+    (day,
+    level,
+    plays,
+    users)
+SELECT d.day,
+       h.level,
+       sum(h.plays),
+       count(DISTINCT h.user_id)
+FROM (SELECT DISTINCT (to_timestamp(start_time / 1000.0) AT TIME ZONE 'UTC')::DATE AS day
+      FROM songplays
+      WHERE songplay_id > %(low)s
+      AND songplay_id <= %(high)s) d
+JOIN rollup_user_hourly h
+  ON h.hour >= d.day::TIMESTAMP
+ AND h.hour < d.day::TIMESTAMP + INTERVAL '1 day'
+GROUP BY 1, 2
+ON CONFLICT (day, level)
+DO UPDATE SET plays = excluded.plays,
+              users = excluded.users;
+""")
+
+# rollup_user_hourly first, rollup_level_daily is derived from it
+rollup_merge_queries = [rollup_song_daily_merge, rollup_user_hourly_merge, rollup_level_daily_merge]
+
+# question routing: {bucket} is the rollup's time column, {dimensions} a
+# leading comma plus the grouped columns
+rollup_question = ("""
+SELECT date_trunc('{grain}', {bucket}::TIMESTAMP) AS period{dimensions},
+       {measure}
+FROM {table}
+WHERE {bucket} >= %(start)s
+AND {bucket} < %(end)s{filters}
+GROUP BY 1{dimensions}
+ORDER BY 1{dimensions};
+""")
+
+songplay_question = ("""
+SELECT date_trunc('{grain}', to_timestamp(start_time / 1000.0) AT TIME ZONE 'UTC') AS period{dimensions},
+       {measure}
+FROM songplays
+WHERE start_time >= %(start_ms)s
+AND start_time < %(end_ms)s{filters}
+GROUP BY 1{dimensions}
+ORDER BY 1{dimensions};
+""")
+
+# ANALYTICAL QUERIES
+
+# the dashboard questions; start / end are epoch milliseconds, like start_time
+
+top_songs_query = ("""
+SELECT s.title, s.artist_name, count(*) AS plays
+FROM songplays p
+JOIN songs s ON s.song_id = p.song_id
+WHERE p.start_time >= %s
+AND p.start_time < %s
+GROUP BY s.title, s.artist_name
+ORDER BY plays DESC, s.title
+LIMIT %s;
+""")
+
+top_artists_query = ("""
+SELECT a.name, count(*) AS plays
+FROM songplays p
+JOIN artists a ON a.artist_id = p.artist_id
+WHERE p.start_time >= %s
+AND p.start_time < %s
+GROUP BY a.name
+ORDER BY plays DESC, a.name
+LIMIT %s;
+""")
+
+plays_per_hour_query = ("""
+SELECT t.hour, count(*) AS plays
+FROM songplays p
+JOIN time t ON t.start_time = p.start_time
+WHERE p.start_time >= %s
+AND p.start_time < %s
+GROUP BY t.hour
+ORDER BY t.hour;
+""")
+
+plays_per_weekday_query = ("""
+SELECT t.weekday, count(*) AS plays
+FROM songplays p
+JOIN time t ON t.start_time = p.start_time
+WHERE p.start_time >= %s
+AND p.start_time < %s
+GROUP BY t.weekday
+ORDER BY t.weekday;
+""")
+
+active_users_by_level_query = ("""
+SELECT p.level, count(DISTINCT p.user_id) AS users, count(*) AS plays
+FROM songplays p
+WHERE p.start_time >= %s
+AND p.start_time < %s
+GROUP BY p.level
+ORDER BY p.level;
+""")
+
+top_users_query = ("""
+SELECT u.user_id, u.first_name, u.last_name, u.level, count(*) AS plays
+FROM songplays p
+JOIN users u ON u.user_id = p.user_id
+WHERE p.start_time >= %s
+AND p.start_time < %s
+GROUP BY u.user_id, u.first_name, u.last_name, u.level
+ORDER BY plays DESC, u.user_id
+LIMIT %s;
+""")
+
+# PLAN CHECKS
+
+# run inside a transaction that is rolled back, since ANALYZE executes writes
+explain_analyze = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}"
+
+plan_tables_analyze = "ANALYZE songplays, songs, artists, users, time;"
+
+statement_timeout_set = "SET LOCAL statement_timeout = %s;"
+
+# plan a prepared statement the way a server-side prepared statement runs
+# once its custom plans stop paying off: without looking at the parameters
+plan_generic_set = "SET LOCAL plan_cache_mode = force_generic_plan;"
+
+# prepared statements outlive the rolled back transaction
+plan_statements_deallocate = "DEALLOCATE ALL;"
+
+server_version_select = "SHOW server_version;"
+
+plan_table_rows_select = ("""
+SELECT relname, reltuples::BIGINT
+FROM pg_class
+WHERE relname IN ('songplays', 'songplay_facts', 'songs', 'artists', 'users', 'time')
+AND relkind IN ('r', 'p');
+""")
+
+# statement -> query returning one row of its parameters, taken from the
+# loaded data so the plans see realistic selectivity; named parameters take
+# the column names
+plan_sample_queries = {
+    "song_select": "SELECT title, artist_name, duration FROM songs ORDER BY song_id LIMIT 1;",
+    "songplay_table_insert": "SELECT {} FROM songplays ORDER BY songplay_id DESC LIMIT 1;".format(
+        ", ".join(songplay_table_columns)),
+    "songplay_facts_insert": "SELECT {} FROM songplay_facts ORDER BY songplay_id DESC LIMIT 1;".format(
+        ", ".join(songplay_facts_columns)),
+    "user_table_insert": "SELECT {} FROM users ORDER BY user_id LIMIT 1;".format(", ".join(user_table_columns)),
+    "song_table_insert": "SELECT {} FROM songs ORDER BY song_id LIMIT 1;".format(", ".join(song_table_columns)),
+    "artist_table_insert": "SELECT {} FROM artists ORDER BY artist_id LIMIT 1;".format(
+        ", ".join(artist_table_columns)),
+    "time_table_insert": "SELECT {} FROM time ORDER BY start_time DESC LIMIT 1;".format(
+        ", ".join(time_table_columns)),
+    # bookkeeping tables may be empty, e.g. without --user-history or
+    # --checkpoint; their parameters then come from the rows the loader
+    # would pass, which plan the same
+    "user_level_history_close": ("SELECT start_time, user_id, level, start_time FROM songplays "
+                                 "ORDER BY songplay_id DESC LIMIT 1;"),
+    "user_level_history_open": ("SELECT user_id, level, start_time, user_id FROM songplays "
+                                "ORDER BY songplay_id DESC LIMIT 1;"),
+    "song_key_select": "SELECT array_agg(song_id) FROM (SELECT song_id FROM songs ORDER BY song_id LIMIT 100) s;",
+    "artist_key_select": ("SELECT array_agg(artist_id) FROM (SELECT artist_id FROM artists "
+                          "ORDER BY artist_id LIMIT 100) a;"),
+    "location_key_select": "SELECT array_agg(DISTINCT location) FROM songplays;",
+    "location_insert": "SELECT array_agg(DISTINCT location) FROM songplays;",
+    "user_agent_key_select": "SELECT array_agg(DISTINCT user_agent) FROM songplays;",
+    "user_agent_insert": "SELECT array_agg(DISTINCT user_agent) FROM songplays;",
+    "file_manifest_upsert": ("SELECT path, size, mtime, content_hash, rows_read, rows_loaded FROM file_manifest "
+                             "ORDER BY path LIMIT 1;"),
+    "file_manifest_touch": "SELECT size, mtime, path FROM file_manifest ORDER BY path LIMIT 1;",
+    "file_checkpoint_select": "SELECT path FROM file_manifest ORDER BY path LIMIT 1;",
+    "file_checkpoint_upsert": "SELECT path, size, mtime, size, rows_loaded FROM file_manifest ORDER BY path LIMIT 1;",
+    "data_version_bump": "SELECT 'songplays';",
+    "load_reject_insert": "SELECT NULL, 'songplays', '[]', 'plan check';",
+    "prepared_statement_select": "SELECT 'songplay_insert';",
+    # an incremental refresh folds in the last file or so of songplays
+    "rollup_watermark_upsert": "SELECT max(songplay_id) AS high FROM songplays;",
+    "rollup_song_daily_merge": ("SELECT greatest(max(songplay_id) - 1000, 0) AS low, max(songplay_id) AS high "
+                                "FROM songplays;"),
+    "rollup_user_hourly_merge": ("SELECT greatest(max(songplay_id) - 1000, 0) AS low, max(songplay_id) AS high "
+                                 "FROM songplays;"),
+    "rollup_level_daily_merge": ("SELECT greatest(max(songplay_id) - 1000, 0) AS low, max(songplay_id) AS high "
+                                 "FROM songplays;"),
+    "file_checkpoint_path_delete": "SELECT path FROM file_manifest ORDER BY path LIMIT 1;",
+    "songplay_default_rows_take": "SELECT min(start_time), max(start_time) + 1 FROM songplays;",
+}
+
+plan_load_sample = "INSERT INTO {temp_table} SELECT {columns} FROM {table} ORDER BY 1 LIMIT 100;"
+
+# statement -> statements run before it in the same transaction, creating
+# the temp tables it reads: the *_load tables of bulk_load.copy_rows, filled
+# with rows of their target table, and the songplays_moved table of
+# partitions.ensure_partitions
+plan_setup_queries = {
+    name: [query.format(temp_table=table + "_load", table=table, columns=", ".join(columns))
+           for query in (temp_table_create, plan_load_sample)]
+    for name, table, columns in (("user_table_merge", "users", user_table_columns),
+                                 ("song_table_merge", "songs", song_table_columns),
+                                 ("artist_table_merge", "artists", artist_table_columns),
+                                 ("time_table_merge", "time", time_table_columns))
+}
+plan_setup_queries["songplay_default_rows_take"] = [songplay_default_rows_hold]
+# negative ids keep the restored sample clear of the rows it was copied from
+plan_setup_queries["songplay_default_rows_restore"] = [
+    songplay_default_rows_hold,
+    "INSERT INTO songplays_moved SELECT * FROM songplays ORDER BY songplay_id DESC LIMIT 100;",
+    "UPDATE songplays_moved SET songplay_id = -songplay_id;",
+]
+
+# EMBEDDED (SQLITE / DUCKDB) DDL
+
+# the dimension tables are portable as-is; only the serial key, the
+# manifest's load-time default and the staging tables need their own DDL
+
+sqlite_songplay_table_create = ("""
+CREATE TABLE IF NOT EXISTS songplays
+                        (songplay_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        start_time BIGINT NOT NULL,
+                        session_id VARCHAR NOT NULL,
+                        user_id INT NOT NULL,
+                        song_id VARCHAR,
+                        artist_id VARCHAR,
+                        level VARCHAR NOT NULL,
+                        location VARCHAR,
+                        user_agent VARCHAR,
+                        FOREIGN KEY (start_time) REFERENCES time (start_time),
+                        FOREIGN KEY (song_id) REFERENCES songs (song_id),
+                        FOREIGN KEY (user_id) REFERENCES users (user_id),
+                        FOREIGN KEY (artist_id) REFERENCES artists (artist_id));
+""")
+
+duckdb_songplay_id_seq_create = ("""
+CREATE SEQUENCE IF NOT EXISTS songplay_id_seq;
+""")
+
+# DuckDB cannot upsert a key referenced by a foreign key, so the fact table
+# keeps its columns but not the constraints
+duckdb_songplay_table_create = ("""
+CREATE TABLE IF NOT EXISTS songplays
+                        (songplay_id BIGINT PRIMARY KEY DEFAULT nextval('songplay_id_seq'),
+                        start_time BIGINT NOT NULL,
+                        session_id VARCHAR NOT NULL,
+                        user_id INT NOT NULL,
+                        song_id VARCHAR,
+                        artist_id VARCHAR,
+                        level VARCHAR NOT NULL,
+                        location VARCHAR,
+                        user_agent VARCHAR);
+""")
+
+duckdb_songplay_id_seq_drop = "DROP SEQUENCE IF EXISTS songplay_id_seq;"
+
+embedded_file_manifest_table_create = ("""
+CREATE TABLE IF NOT EXISTS file_manifest
+                        (path VARCHAR PRIMARY KEY NOT NULL,
+                        size BIGINT NOT NULL,
+                        mtime DOUBLE PRECISION NOT NULL,
+                        content_hash CHAR(64) NOT NULL,
+                        rows_read INT NOT NULL,
+                        rows_loaded INT NOT NULL,
+                        loaded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP);
+""")
+
 # QUERY LISTS
 
-create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
+songplay_index_queries = [songplay_start_time_index_create, songplay_user_index_create, songplay_song_index_create, songplay_artist_index_create]
+create_index_queries = [song_lookup_index_create] + songplay_index_queries
+songplay_facts_index_queries = [songplay_facts_start_time_index_create, songplay_facts_user_index_create, songplay_facts_song_index_create, songplay_facts_artist_index_create]
+rollup_create_table_queries = [rollup_song_daily_table_create, rollup_user_hourly_table_create, rollup_level_daily_table_create, rollup_watermark_table_create, rollup_watermark_seed]
+trgm_index_queries = [trgm_extension_create, song_title_trgm_index_create]
+
+create_table_queries = [user_table_create, user_level_history_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create, file_manifest_table_create, file_checkpoint_table_create, data_version_table_create, load_reject_table_create, staging_events_table_create, staging_songs_table_create] + create_index_queries + rollup_create_table_queries
+partitioned_create_table_queries = [user_table_create, user_level_history_table_create, song_table_create, artist_table_create, time_table_create, songplay_partitioned_table_create, songplay_default_partition_create, file_manifest_table_create, file_checkpoint_table_create, data_version_table_create, load_reject_table_create, staging_events_table_create, staging_songs_table_create] + create_index_queries + rollup_create_table_queries
+compact_create_table_queries = [user_table_create, user_level_history_table_create, song_table_create, artist_table_create, time_table_create, song_key_add, artist_key_add, location_table_create, user_agent_table_create, songplay_facts_table_create, songplay_view_create, file_manifest_table_create, file_checkpoint_table_create, data_version_table_create, load_reject_table_create, staging_events_table_create, staging_songs_table_create, song_lookup_index_create] + songplay_facts_index_queries + rollup_create_table_queries
+drop_table_queries = [songplay_view_drop, songplay_table_drop, songplay_facts_table_drop, location_table_drop, user_agent_table_drop, user_table_drop, user_level_history_table_drop, song_table_drop, artist_table_drop, time_table_drop, file_manifest_table_drop, file_checkpoint_table_drop, data_version_table_drop, load_reject_table_drop, staging_events_table_drop, staging_songs_table_drop, rollup_song_daily_table_drop, rollup_user_hourly_table_drop, rollup_level_daily_table_drop, rollup_watermark_table_drop]
+staging_merge_queries = [staging_song_table_merge, staging_artist_table_merge, staging_user_table_merge, staging_time_table_merge, staging_songplay_table_merge]
+
+sqlite_create_table_queries = [user_table_create, user_level_history_table_create, song_table_create, artist_table_create, time_table_create, sqlite_songplay_table_create, embedded_file_manifest_table_create, file_checkpoint_table_create, data_version_table_create, load_reject_table_create, song_lookup_index_create, songplay_user_index_create, songplay_song_index_create, songplay_artist_index_create]
+sqlite_drop_table_queries = [songplay_table_drop, user_table_drop, user_level_history_table_drop, song_table_drop, artist_table_drop, time_table_drop, file_manifest_table_drop, file_checkpoint_table_drop, data_version_table_drop, load_reject_table_drop]
+duckdb_create_table_queries = [user_table_create, user_level_history_table_create, song_table_create, artist_table_create, time_table_create, duckdb_songplay_id_seq_create, duckdb_songplay_table_create, embedded_file_manifest_table_create, file_checkpoint_table_create, data_version_table_create, load_reject_table_create, song_lookup_index_create]
+duckdb_drop_table_queries = [songplay_table_drop, duckdb_songplay_id_seq_drop, user_table_drop, user_level_history_table_drop, song_table_drop, artist_table_drop, time_table_drop, file_manifest_table_drop, file_checkpoint_table_drop, data_version_table_drop, load_reject_table_drop]
@@ -0,0 +1,506 @@
+import io
+import os
+import time
+import signal
+import argparse
+
+import pandas as pd
+
+from etl import LOG_TABLES, LOAD_MODES, LOOKUP_MODES, load_log_events, write_metrics
+from backends import BACKENDS, get_backend
+from song_reader import scan_files, loads
+from checkpoints import mapped_file, read_checkpoint, save_checkpoint
+from commits import CommitBatcher
+from manifest import file_stat, file_snapshot, load_manifest, record_file
+from partitions import partition_interval, ensure_partitions
+from dimension_keys import SongplayEncoder, compact_songplays
+from rollups import refresh_rollups
+from queries import mark_changed
+import metrics
+
+try:
+    # optional, Linux only; without it the tree is polled
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+
+# seconds the first buffered line may wait before its micro-batch is loaded
+MAX_LATENCY = 1.0
+
+# buffered lines that load a micro-batch before MAX_LATENCY is up
+BATCH_LINES = 5000
+
+# seconds between two scans of the tree when polling
+POLL_INTERVAL = 1.0
+
+
+class FileTail:
+    """
+    Read position of one log file. Only whole lines are read: a last line
+    without a newline is read once it is a complete JSON object (the sample
+    files end that way), one still being written stays in the file.
+    """
+
+    def __init__(self, path, offset=0, rows=0):
+        self.path = path
+        # read up to here, loaded up to committed
+        self.offset = offset
+        self.committed = offset
+        self.rows = rows
+        # file size the file manifest was last brought up to
+        self.recorded = None
+
+    def read(self, max_lines):
+        """
+        Description: This function reads the whole lines appended since the
+        last read.
+
+        Arguments:
+            max_lines: most lines to read.
+
+        Returns:
+            (bytes read, number of lines, byte offset after them)
+        """
+        size = os.path.getsize(self.path)
+        if size < self.offset:
+            print('{} shrank below byte {}, reading it again from the start'.format(self.path, self.offset))
+            self.offset = self.committed = self.rows = 0
+        if size == self.offset:
+            return b"", 0, self.offset
+
+        with mapped_file(self.path) as data:
+            end, lines = self.offset, 0
+            while lines < max_lines:
+                newline = data.find(b"\n", end)
+                if newline < 0:
+                    if end < size and complete_line(data[end:size]):
+                        end, lines = size, lines + 1
+                    break
+                end, lines = newline + 1, lines + 1
+            chunk = bytes(data[self.offset:end])
+
+        self.offset = end
+        return chunk, lines, end
+
+
+def complete_line(line):
+    # a line cut off mid-write is not valid JSON
+    try:
+        return isinstance(loads(line), dict)
+    except ValueError:
+        return False
+
+
+class PollingWatcher:
+    """
+    Finds new and growing files by scanning the tree every interval seconds.
+    """
+
+    name = "polling"
+
+    def __init__(self, root, interval=POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self._sizes = {}
+
+    def wait(self, timeout):
+        """
+        Description: This function waits up to timeout seconds for files to
+        change.
+
+        Arguments:
+            timeout: seconds to wait at most.
+
+        Returns:
+            set of paths that may have new lines.
+        """
+        time.sleep(max(0, min(timeout, self.interval)))
+        changed = set()
+        for path, size in scan_files(self.root):
+            if self._sizes.get(path) != size:
+                self._sizes[path] = size
+                changed.add(path)
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    """
+    Finds new and growing files through inotify, so appended lines are seen
+    as soon as they are written instead of at the next scan. inotify watches
+    single directories, so every YYYY/MM directory gets its own watch, and
+    new ones are watched as they appear.
+    """
+
+    name = "inotify"
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self._inotify = inotify_simple.INotify()
+        self._dirs = {}
+        self.watch(self.root)
+
+    def watch(self, directory):
+        # watches first, then the scan, so no file slips in between
+        flags = inotify_simple.flags
+        mask = flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO
+        for path, _, _ in os.walk(directory):
+            self._dirs[self._inotify.add_watch(path, mask)] = path
+        return {path for path, _ in scan_files(directory)}
+
+    def wait(self, timeout):
+        """
+        Description: This function waits up to timeout seconds for files to
+        change.
+
+        Arguments:
+            timeout: seconds to wait at most.
+
+        Returns:
+            set of paths that may have new lines.
+        """
+        flags = inotify_simple.flags
+        changed = set()
+        for event in self._inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                # events were dropped, every file may have changed
+                changed.update(path for path, _ in scan_files(self.root))
+                continue
+            directory = self._dirs.get(event.wd)
+            if directory is None or not event.name:
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                changed.update(self.watch(path))
+            elif event.name.endswith(".json"):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        self._inotify.close()
+
+
+def get_watcher(root, polling=False, interval=POLL_INTERVAL):
+    """
+    Description: This function picks how the log data tree is watched.
+
+    Arguments:
+        root: log data directory.
+        polling: poll even when inotify is available.
+        interval: seconds between two scans when polling.
+
+    Returns:
+        InotifyWatcher, or PollingWatcher without inotify_simple.
+    """
+    if not polling and inotify_simple is not None:
+        return InotifyWatcher(root)
+    return PollingWatcher(root, interval)
+
+
+class LogStream:
+    """
+    Long-running tail of the log data tree. Lines appended to any log file
+    are buffered and loaded in micro-batches through etl.load_log_events:
+    a batch is loaded once max_latency seconds passed since its first line
+    was read, or earlier once it holds batch_lines lines. Every batch is
+    one transaction together with the byte offsets it reached (in
+    file_checkpoint), so a restarted stream continues where the last commit
+    left off. Rows that fail to load go to load_rejects (see CommitBatcher)
+    instead of stopping the stream.
+    """
+
+    def __init__(self, cur, conn, root, watcher, load_mode="insert", song_index=None, max_latency=MAX_LATENCY,
+                 batch_lines=BATCH_LINES, user_history=False, encoder=None, rollups=False, interval=None,
+                 row_errors=()):
+        self.cur = cur
+        self.conn = conn
+        self.batcher = CommitBatcher(cur, conn, "file", row_errors=row_errors)
+        self.root = root
+        self.watcher = watcher
+        self.load_mode = load_mode
+        self.song_index = song_index
+        self.max_latency = max_latency
+        self.batch_lines = batch_lines
+        self.user_history = user_history
+        self.encoder = encoder
+        self.rollups = rollups
+        self.interval = interval
+        self.loaded_times = set()
+        self.tails = {}
+        self._months = set()
+        # (tail, bytes, end offset) read but not loaded yet
+        self._buffer = []
+        self._lines = 0
+        self._first_read = None
+        # files with more lines than the last read took
+        self._backlog = set()
+
+    def start_offset(self, path, manifest):
+        """
+        Description: This function finds where a file is loaded up to: at
+        its stream checkpoint, else at the size etl.py recorded for it in the
+        file manifest (log files only grow), else at its start.
+
+        Arguments:
+            path: log file path.
+            manifest: file manifest, as returned by load_manifest.
+
+        Returns:
+            FileTail
+        """
+        byte_offset, rows = read_checkpoint(self.cur, path, append_only=True)
+        if not byte_offset and path in manifest and manifest[path][0] <= os.path.getsize(path):
+            byte_offset, rows = manifest[path][0], manifest[path][3] or 0
+        return FileTail(path, byte_offset, rows)
+
+    def read(self, paths):
+        """
+        Description: This function buffers the lines appended to the given
+        files, up to what the current micro-batch still takes.
+
+        Arguments:
+            paths: paths that may have new lines.
+
+        Returns:
+            number of lines buffered.
+        """
+        manifest = None
+        buffered = 0
+        for path in sorted(paths):
+            if path not in self.tails:
+                if manifest is None:
+                    manifest = load_manifest(self.cur)
+                self.tails[path] = self.start_offset(path, manifest)
+
+            room = self.batch_lines - self._lines
+            if room <= 0:
+                self._backlog.add(path)
+                continue
+
+            tail = self.tails[path]
+            with metrics.stage("read"):
+                chunk, lines, end = tail.read(room)
+            if lines == room:
+                self._backlog.add(path)
+            else:
+                self._backlog.discard(path)
+            if not lines:
+                continue
+
+            if self._first_read is None:
+                self._first_read = time.monotonic()
+            self._buffer.append((tail, chunk, end))
+            self._lines += lines
+            buffered += lines
+            metrics.count("bytes_read", len(chunk))
+
+        return buffered
+
+    def due(self):
+        # whether the buffered micro-batch should be loaded now
+        if not self._buffer:
+            return False
+        return self._lines >= self.batch_lines or time.monotonic() - self._first_read >= self.max_latency
+
+    def timeout(self, idle):
+        if self._backlog:
+            return 0
+        if self._buffer:
+            return max(0, self._first_read + self.max_latency - time.monotonic())
+        return idle
+
+    def flush(self):
+        """
+        Description: This function loads the buffered micro-batch in one
+        transaction with the byte offsets it reaches.
+
+        Returns:
+            number of NextSong events loaded.
+        """
+        if not self._buffer:
+            return 0
+
+        frames, reached = [], {}
+        for tail, chunk, end in self._buffer:
+            with metrics.stage("parse"):
+                df = pd.read_json(io.BytesIO(chunk), lines = True)
+            metrics.count("rows_in", len(df), source="log_data")
+            events = df[df["page"] == "NextSong"] if len(df) else df
+            # read_json types userId per chunk, int or str; one type for the whole batch
+            frames.append(events.astype({"userId": str}) if len(events) else events)
+            _, rows = reached.get(tail, (tail.committed, tail.rows))
+            reached[tail] = (end, rows + len(events))
+
+        events = pd.concat(frames, ignore_index=True)
+        if self.interval is not None and len(events):
+            # the months the batch plays in get their partitions before it loads
+            t = pd.to_datetime(events.ts, unit="ms")
+            months = set(zip(t.dt.year.tolist(), t.dt.month.tolist()))
+            if not months <= self._months:
+                ensure_partitions(self.cur, self.conn, months - self._months, self.interval)
+                self._months |= months
+
+        # rejects of a batch spanning several files are recorded with the directory
+        self.batcher.begin(next(iter(reached)).path if len(reached) == 1 else self.root)
+        try:
+            num_events = load_log_events(self.cur, events, self.load_mode, self.song_index, self.loaded_times,
+                                         self.user_history, self.encoder, self.batcher) if len(events) else 0
+            for tail, (end, rows) in reached.items():
+                save_checkpoint(self.cur, tail.path, end, rows)
+            mark_changed(self.cur, LOG_TABLES)
+            if self.rollups:
+                with metrics.stage("rollup"):
+                    refresh_rollups(self.cur)
+            self.batcher.end_file()
+        except BaseException:
+            self.batcher.rollback()
+            # the rolled back batch's times and keys may be cached as loaded
+            self.loaded_times.clear()
+            if self.encoder is not None:
+                self.encoder.reset()
+            raise
+
+        for tail, (end, rows) in reached.items():
+            tail.committed, tail.rows = end, rows
+        lag = time.monotonic() - self._first_read
+        metrics.count("micro_batches")
+        print('{} events from {} files loaded, {:.2f}s after their first line was read.'.format(
+            num_events, len(reached), lag))
+
+        self._buffer, self._lines, self._first_read = [], 0, None
+        return num_events
+
+    def record_idle(self):
+        """
+        Description: This function brings the file manifest up to date for
+        the files loaded to their end, so a batch etl.py run skips them.
+        Only runs while the stream is idle, since it hashes whole files.
+
+        Returns:
+            None
+        """
+        for tail in self.tails.values():
+            size, _ = file_stat(tail.path)
+            if tail.committed == size and tail.recorded != size:
+                # a line appended since the stat must not be covered by the entry
+                snapshot = file_snapshot(tail.path)
+                if snapshot[0] == tail.committed:
+                    record_file(self.cur, tail.path, tail.rows, snapshot)
+                    tail.recorded = size
+
+    def run(self, idle_exit=None, idle=POLL_INTERVAL):
+        """
+        Description: This function tails the log data tree until interrupted,
+        or until no line arrived for idle_exit seconds.
+
+        Arguments:
+            idle_exit: seconds without new lines after which to stop.
+            idle: seconds to wait for changes when nothing is buffered.
+
+        Returns:
+            None
+        """
+        self.read(path for path, _ in scan_files(self.root))
+        last_line = time.monotonic()
+        try:
+            while True:
+                if self.due():
+                    self.flush()
+
+                paths = self.watcher.wait(self.timeout(idle)) | self._backlog
+                if self.read(paths):
+                    last_line = time.monotonic()
+                elif not self._buffer:
+                    self.record_idle()
+                    if idle_exit is not None and time.monotonic() - last_line >= idle_exit:
+                        break
+        except KeyboardInterrupt:
+            print('stopping, loading the lines read so far')
+        self.flush()
+
+
+def stop(signum, frame):
+    # systemd and docker stop with SIGTERM; finish like on Ctrl-C
+    raise KeyboardInterrupt
+
+
+def main(log_data="data/log_data", load_mode="insert", lookup="query", max_latency=MAX_LATENCY,
+         batch_lines=BATCH_LINES, polling=False, poll_interval=POLL_INTERVAL, idle_exit=None, user_history=False,
+         backend_name="postgres", db_path=None, dsn=None, prepare=True, metrics_json=None, metrics_prom=None):
+    """
+    - tails log_data for new and growing event files and loads appended
+      lines in micro-batches, so plays reach songplays within seconds
+    - max_latency / batch_lines trade latency for batch size: a micro-batch
+      loads max_latency seconds after its first line, or once it holds
+      batch_lines lines
+    - files are watched with inotify (pip install inotify_simple), or the
+      tree is scanned every poll_interval seconds with polling or without it
+    - songs must be loaded first (etl.py); the song lookup, load modes,
+      user history, compact schema, partitions and rollups work as in etl.py
+    - runs until SIGINT / SIGTERM, or until idle_exit seconds pass without
+      a new line
+    """
+    backend = get_backend(backend_name, dsn=dsn, path=db_path, prepare=prepare)
+    if load_mode == "staging":
+        raise ValueError("the stream loads with --load-mode insert or copy")
+
+    conn = backend.connect(autocommit=True)
+    cur = backend.cursor(conn, wrapper=metrics.InstrumentedCursor)
+
+    rollups = backend.name == "postgres"
+    interval = partition_interval(cur) if rollups else None
+    encoder = SongplayEncoder() if rollups and compact_songplays(cur) else None
+    song_index = backend.song_index(cur) if lookup == "index" else None
+
+    watcher = get_watcher(log_data, polling, poll_interval)
+    print('watching {} ({})'.format(log_data, watcher.name))
+
+    signal.signal(signal.SIGTERM, stop)
+    stream = LogStream(cur, conn, log_data, watcher, load_mode, song_index, max_latency, batch_lines, user_history,
+                       encoder, rollups, interval, backend.row_errors)
+    try:
+        stream.run(idle_exit, min(poll_interval, max_latency))
+    finally:
+        watcher.close()
+        conn.close()
+    write_metrics(metrics_json, metrics_prom)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tail log_data and load new plays into sparkifydb in micro-batches.")
+    parser.add_argument("--log-data", default="data/log_data", help="log data directory to watch")
+    parser.add_argument("--load-mode", choices=LOAD_MODES[:2], default="insert",
+                        help="row-by-row INSERTs or COPY ... FROM STDIN per micro-batch")
+    parser.add_argument("--lookup", choices=LOOKUP_MODES, default="query",
+                        help="resolve songs with one song_select per event or an in-memory index")
+    parser.add_argument("--max-latency", type=float, default=MAX_LATENCY,
+                        help="seconds the first line of a micro-batch waits for more lines")
+    parser.add_argument("--batch-lines", type=int, default=BATCH_LINES,
+                        help="lines that load a micro-batch before --max-latency is up")
+    parser.add_argument("--polling", action="store_true", help="scan the tree even when inotify is available")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                        help="seconds between two scans when polling")
+    parser.add_argument("--idle-exit", type=float, default=None,
+                        help="stop after this many seconds without a new line (default: run until stopped)")
+    parser.add_argument("--user-history", action="store_true",
+                        help="record the free / paid level changes of every user in user_level_history")
+    parser.add_argument("--backend", choices=BACKENDS, default="postgres",
+                        help="postgres server, or an in-process sqlite / duckdb database")
+    parser.add_argument("--db-path", default=None, help="database file of an embedded backend")
+    parser.add_argument("--dsn", default=None,
+                        help="postgres connection string (defaults to SPARKIFY_DSN or the PG* variables)")
+    parser.add_argument("--no-prepare", action="store_true",
+                        help="send every statement as plain SQL, e.g. behind a transaction-pooling pgbouncer")
+    parser.add_argument("--metrics-json", default=None, help="write the per-stage run report to this JSON file")
+    parser.add_argument("--metrics-prom", default=None,
+                        help="write the run metrics to this file in Prometheus text format")
+    args = parser.parse_args()
+
+    main(log_data=args.log_data, load_mode=args.load_mode, lookup=args.lookup, max_latency=args.max_latency,
+         batch_lines=args.batch_lines, polling=args.polling, poll_interval=args.poll_interval,
+         idle_exit=args.idle_exit, user_history=args.user_history, backend_name=args.backend,
+         db_path=args.db_path, dsn=args.dsn, prepare=not args.no_prepare, metrics_json=args.metrics_json,
+         metrics_prom=args.metrics_prom)